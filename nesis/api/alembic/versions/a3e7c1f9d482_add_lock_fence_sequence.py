@@ -0,0 +1,33 @@
+"""add lock fence sequence
+
+Revision ID: a3e7c1f9d482
+Revises: f2b6d9a4c835
+Create Date: 2024-08-28 11:42:05.310544
+
+"""
+
+import time
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "a3e7c1f9d482"
+down_revision: Union[str, None] = "f2b6d9a4c835"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Tokens start from the clock, in milliseconds, above those handed out by the memcache backend and saved with
+    # the files
+    op.execute(
+        sa.schema.CreateSequence(
+            sa.Sequence("lock_fence_seq", start=int(time.time() * 1000))
+        )
+    )
+
+
+def downgrade() -> None:
+    op.execute(sa.schema.DropSequence(sa.Sequence("lock_fence_seq")))
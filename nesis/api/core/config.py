@@ -1,6 +1,12 @@
+import json
 import os
+from typing import Optional
+
+import yaml
 from tzlocal import get_localzone
 
+import nesis.api.core.util as util
+
 default = {
     "server": {
         "port": os.environ.get("NESIS_API_SERVER_PORT", "6000"),
@@ -22,9 +28,83 @@ default = {
         },
         "timezone": os.environ.get("NESIS_API_TASKS_TIMEZONE", str(get_localzone())),
         "executors": {"default_size": 30, "pool_size": 3},
+        # Task status transitions are written in batches of up to batch_size, waiting at most linger seconds
+        "status": {
+            "batch_size": os.environ.get("NESIS_API_TASKS_STATUS_BATCH_SIZE") or 100,
+            "linger": os.environ.get("NESIS_API_TASKS_STATUS_LINGER") or 0.5,
+        },
+        # Share one pool of workers out between the datasources being ingested, in proportion to their task's
+        # priority. Each datasource uses at most its max_in_flight of the workers.
+        "fair_share": {
+            "enabled": os.environ.get(
+                "NESIS_API_TASKS_FAIR_SHARE_ENABLED", "true"
+            ).lower()
+            == "true",
+            "workers": os.environ.get("NESIS_API_TASKS_FAIR_SHARE_WORKERS") or 64,
+        },
+        # Run ingestion in separate worker processes, see nesis.api.core.worker. The API then only queues the runs.
+        # Each worker runs up to concurrency runs at once and holds each for lease seconds between renewals.
+        "worker": {
+            "enabled": os.environ.get("NESIS_API_TASKS_WORKER_ENABLED", "false").lower()
+            == "true",
+            "concurrency": os.environ.get("NESIS_API_TASKS_WORKER_CONCURRENCY") or 3,
+            "lease": os.environ.get("NESIS_API_TASKS_WORKER_LEASE") or 60,
+            "poll_interval": os.environ.get("NESIS_API_TASKS_WORKER_POLL_INTERVAL")
+            or 5,
+        },
+        # Counters of a task run are written to its record at most every interval seconds
+        "progress": {
+            "interval": os.environ.get("NESIS_API_TASKS_PROGRESS_INTERVAL") or 5,
+        },
+        # A running task checks at most every interval seconds whether its task was deleted or disabled, and stops
+        # once it has run for time_budget seconds, unless the task sets its own budget. No budget by default.
+        "cancellation": {
+            "interval": os.environ.get("NESIS_API_TASKS_CANCELLATION_INTERVAL") or 5,
+            "time_budget": os.environ.get("NESIS_API_TASKS_CANCELLATION_TIME_BUDGET"),
+        },
+        # Datasource notifications waiting for the datasource's in-flight ingestion are coalesced, up to
+        # max_pending records, beyond which notifications are refused
+        "events": {
+            "max_pending": os.environ.get("NESIS_API_TASKS_EVENTS_MAX_PENDING")
+            or 10000,
+        },
+        # Datasources synced incrementally from a change log are fully listed at least every interval seconds, to
+        # reconcile the changes the log missed
+        "reconciliation": {
+            "interval": os.environ.get("NESIS_API_TASKS_RECONCILIATION_INTERVAL")
+            or 86400,
+        },
+        # Partition each datasource's objects across the API replicas by consistent hashing. Ignored when ingestion
+        # runs on workers, which each take a datasource's run whole.
+        "sharding": {
+            "enabled": os.environ.get(
+                "NESIS_API_TASKS_SHARDING_ENABLED", "false"
+            ).lower()
+            == "true",
+            "ttl": os.environ.get("NESIS_API_TASKS_SHARDING_TTL") or 60,
+            "heartbeat": os.environ.get("NESIS_API_TASKS_SHARDING_HEARTBEAT") or 20,
+        },
     },
     "rag": {
         "endpoint": os.environ.get("NESIS_API_RAG_ENDPOINT", "http://localhost:8080"),
+        # Files no larger than max_file_size can be uploaded in batches of up to max_files to the bulk ingest
+        # endpoint, which only rag services of this release serve. Off by default, every file being uploaded on its
+        # own; set max_files above 1, e.g. 16, to turn batching on.
+        "batch": {
+            "max_files": os.environ.get("NESIS_API_RAG_BATCH_MAX_FILES") or 1,
+            "max_file_size": os.environ.get("NESIS_API_RAG_BATCH_MAX_FILE_SIZE")
+            or 1024 * 1024,
+            "max_bytes": os.environ.get("NESIS_API_RAG_BATCH_MAX_BYTES")
+            or 8 * 1024 * 1024,
+            "linger": os.environ.get("NESIS_API_RAG_BATCH_LINGER") or 0.5,
+        },
+    },
+    # Locks taken on files while they are processed. The backend is "memcache" or "postgres"
+    "locks": {
+        "backend": os.environ.get("NESIS_API_LOCKS_BACKEND") or "memcache",
+        "ttl": os.environ.get("NESIS_API_LOCKS_TTL") or 60,
+        # The memcache backend reserves fencing tokens fence_block at a time
+        "fence_block": os.environ.get("NESIS_API_LOCKS_FENCE_BLOCK") or 100,
     },
     "memcache": {
         "hosts": [os.environ.get("NESIS_MEMCACHE_HOSTS", "127.0.0.1:11211")],
@@ -35,10 +115,66 @@ default = {
             "timeout_default": 300,
         },
     },
+    # Authorization decisions are cached in process, up to size of them, in front of memcache where they expire
+    # after expiry seconds. Role changes reach the other replicas within version_interval seconds.
+    "authorization": {
+        "cache": {
+            "enabled": os.environ.get(
+                "NESIS_API_AUTHORIZATION_CACHE_ENABLED", "true"
+            ).lower()
+            == "true",
+            "size": os.environ.get("NESIS_API_AUTHORIZATION_CACHE_SIZE") or 10000,
+            "expiry": os.environ.get("NESIS_API_AUTHORIZATION_CACHE_EXPIRY") or 300,
+            "version_interval": os.environ.get(
+                "NESIS_API_AUTHORIZATION_CACHE_VERSION_INTERVAL"
+            )
+            or 1,
+        },
+    },
     "apps": {
         "session": {"expiry": os.environ.get("NESIS_API_APPS_SESSION_EXPIRY") or 1800}
     },
     "http": {
         "workers": {"count": os.environ.get("NESIS_API_HTTP_WORKERS_COUNT", 10)},
+        "client": {
+            "connect_timeout": os.environ.get("NESIS_API_HTTP_CLIENT_CONNECT_TIMEOUT")
+            or 10,
+            "read_timeout": os.environ.get("NESIS_API_HTTP_CLIENT_READ_TIMEOUT") or 300,
+            "retries": os.environ.get("NESIS_API_HTTP_CLIENT_RETRIES") or 3,
+            "backoff_factor": os.environ.get("NESIS_API_HTTP_CLIENT_BACKOFF_FACTOR")
+            or 0.5,
+            # Adaptive bound on the concurrent uploads to each rag endpoint
+            "limiter": {
+                "initial": os.environ.get("NESIS_API_HTTP_CLIENT_LIMITER_INITIAL")
+                or 10,
+                "min": os.environ.get("NESIS_API_HTTP_CLIENT_LIMITER_MIN") or 1,
+                "max": os.environ.get("NESIS_API_HTTP_CLIENT_LIMITER_MAX"),
+                "decrease_factor": os.environ.get(
+                    "NESIS_API_HTTP_CLIENT_LIMITER_DECREASE_FACTOR"
+                )
+                or 0.5,
+                "latency_tolerance": os.environ.get(
+                    "NESIS_API_HTTP_CLIENT_LIMITER_LATENCY_TOLERANCE"
+                )
+                or 2.0,
+                # Uploads larger than size_unit bytes are timed per size_unit bytes
+                "size_unit": os.environ.get("NESIS_API_HTTP_CLIENT_LIMITER_SIZE_UNIT")
+                or 1024 * 1024,
+            },
+        },
     },
 }
+
+
+def load_config(config_file: Optional[str]) -> dict:
+    """
+    Load a yaml or json configuration file over the defaults
+    """
+    config = {}
+    if config_file:
+        with open(config_file) as fh:
+            if config_file.endswith(".json"):
+                config = json.load(fh)
+            else:
+                config = yaml.load(fh, yaml.Loader)
+    return util.merge(config, default)
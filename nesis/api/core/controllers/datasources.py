@@ -242,3 +242,69 @@ def operate_datasource(datasource_id):
     except:
         _LOG.exception("Error getting user")
         return jsonify(error_message("Server error")), 500
+
+
+@app.route(
+    "/v1/datasources/<datasource_id>/events",
+    methods=[controllers.POST],
+)
+def operate_datasource_events(datasource_id):
+    """Receive change notifications for a datasource.
+    ---
+    post:
+      summary: Ingest the objects referenced in a MinIO bucket notification.
+      parameters:
+        - in: header
+          name: Authorization
+          schema:
+            type: string
+          required: true
+          description: The authentication token obtained from a POST /session or POST /apps.
+        - in: path
+          name: datasource_id
+          schema:
+            type: string
+          required: true
+          description: The datasource the notification is for
+      requestBody:
+        required: true
+        content:
+          application/json:
+            schema:
+              type: object
+      responses:
+        202:
+            description: Accepted
+        400:
+          content:
+            application/json:
+              schema: MessageSchema
+        401:
+          content:
+            application/json:
+              schema: MessageSchema
+        403:
+          content:
+            application/json:
+              schema: MessageSchema
+        500:
+          content:
+            application/json:
+              schema: MessageSchema
+    """
+    token = get_bearer_token(request.headers.get("Authorization"))
+
+    try:
+        services.task_service.ingest_events(
+            token=token, datasource_id=datasource_id, events=request.json
+        )
+        return jsonify(success=True), 202
+    except util.ServiceException as se:
+        return jsonify(error_message(str(se))), 400
+    except util.UnauthorizedAccess:
+        return jsonify(error_message("Unauthorized access")), 401
+    except util.PermissionException as ex:
+        return jsonify(error_message(str(ex))), 403
+    except:
+        _LOG.exception("Error receiving datasource events")
+        return jsonify(error_message("Server error")), 500
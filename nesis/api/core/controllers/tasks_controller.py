@@ -220,3 +220,61 @@ def operate_task(task_id):
     except:
         _LOG.exception("Error getting user")
         return jsonify(error_message("Server error")), 500
+
+
+@app.route("/v1/tasks/<task_id>/runs", methods=[controllers.GET])
+def operate_task_runs(task_id):
+    """Get the runs of a task.
+    ---
+    get:
+      summary: Get the latest runs of a task with their progress. A running task's counters are updated as it goes.
+      parameters:
+        - in: header
+          name: Authorization
+          schema:
+            type: string
+          required: true
+          description: The authentication token obtained from a POST /session or POST /apps.
+        - in: path
+          name: task_id
+          schema:
+            type: string
+          required: true
+          description: The task id to get the runs of
+        - in: query
+          name: limit
+          schema:
+            type: integer
+          required: false
+          description: The number of runs to get, 20 by default
+      responses:
+        200:
+          content:
+            application/json:
+              schema: TaskRunsSchema
+        401:
+          content:
+            application/json:
+              schema: MessageSchema
+        403:
+          content:
+            application/json:
+              schema: MessageSchema
+    """
+    token = get_bearer_token(request.headers.get("Authorization"))
+    try:
+        results = services.task_service.get_runs(
+            token=token,
+            task_id=task_id,
+            limit=request.args.get("limit", type=int),
+        )
+        return jsonify({"items": [item.to_dict() for item in results]})
+    except util.ServiceException as se:
+        return jsonify(error_message(str(se))), 400
+    except util.UnauthorizedAccess:
+        return jsonify(error_message("Unauthorized access")), 401
+    except util.PermissionException as ex:
+        return jsonify(error_message(str(ex))), 403
+    except:
+        _LOG.exception("Error getting task runs")
+        return jsonify(error_message("Server error")), 500
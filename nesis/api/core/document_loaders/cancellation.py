@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from nesis.api.core.services.util import get_task
+from nesis.api.core.tasks.queue import holds_task
+
+_LOG = logging.getLogger(__name__)
+
+
+class TaskCancelled(Exception):
+    """
+    Raised in place of processing a file once the run has been told to stop.
+    """
+
+
+class TaskCancellation(object):
+    """
+    Tells a running task when to stop. A run stops when it is cancelled, when its task is deleted or disabled, which
+    is checked at most every interval seconds, or once it has run for time_budget seconds. The listing and processing
+    loops check it between files, so the files being processed finish and the checkpoints are left for the next run
+    to resume from. Without a task, only cancel and the time budget stop the run. A run taken from the queue by
+    worker_id also stops once another worker has reclaimed it, so that the two do not process the datasource at once.
+    """
+
+    def __init__(
+        self,
+        task_id: Optional[str] = None,
+        time_budget: Optional[float] = None,
+        interval: float = 5.0,
+        queued_task_id: Optional[str] = None,
+        worker_id: Optional[str] = None,
+    ):
+        self._task_id = task_id
+        self._queued_task_id = queued_task_id
+        self._worker_id = worker_id
+        self._interval = interval
+        self._deadline = None if not time_budget else time.monotonic() + time_budget
+        self._lock = threading.Lock()
+        self._last_check = time.monotonic()
+        self._reason: Optional[str] = None
+        self._stopped = threading.Event()
+
+    @property
+    def reason(self) -> Optional[str]:
+        return self._reason
+
+    @property
+    def stopped(self) -> bool:
+        """
+        Whether the run has been told to stop, without checking the task or the time budget again
+        """
+        return self._stopped.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        if self._stopped.is_set():
+            return True
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            self.cancel(reason="time budget exceeded")
+        elif time.monotonic() - self._last_check >= self._interval:
+            self._check_task()
+        return self._stopped.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            self._reason = reason
+            self._stopped.set()
+        _LOG.info(f"Stopping run of task {self._task_id} - {reason}")
+
+    def _check_task(self) -> None:
+        if self._task_id is None:
+            return
+        # One worker checking the task covers the others
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._last_check < self._interval:
+                return
+            self._last_check = time.monotonic()
+            try:
+                task = get_task(task_id=self._task_id)
+                held = self._queued_task_id is None or holds_task(
+                    queued_task_id=self._queued_task_id, worker_id=self._worker_id
+                )
+            except:
+                _LOG.warning(f"Error checking task {self._task_id}", exc_info=True)
+                return
+        finally:
+            self._lock.release()
+
+        if task is None:
+            self.cancel(reason="task deleted")
+        elif not task.enabled:
+            self.cancel(reason="task disabled")
+        elif not held:
+            self.cancel(reason="lease lost")
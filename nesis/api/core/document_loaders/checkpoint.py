@@ -0,0 +1,49 @@
+import copy
+import logging
+import threading
+from typing import Dict, Any, Optional
+
+from nesis.api.core.services.util import get_task_checkpoint, save_task_checkpoint
+
+_LOG = logging.getLogger(__name__)
+
+
+class TaskCheckpoint(object):
+    """
+    Progress markers of a task run, keyed by the unit of work they track, for example a bucket prefix.
+    Every change is written to the task record so that an interrupted run resumes from the last marker.
+    Without a task, the checkpoint only lives for the duration of the run.
+    """
+
+    def __init__(self, task_id: Optional[str] = None):
+        self._task_id = task_id
+        self._lock = threading.Lock()
+        self._checkpoint: Dict[str, Any] = {}
+        if task_id is not None:
+            self._checkpoint = copy.deepcopy(get_task_checkpoint(task_id=task_id) or {})
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._checkpoint.get(key)
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._checkpoint[key] = value
+            self._save()
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            if self._checkpoint.pop(key, None) is not None:
+                self._save()
+
+    def _save(self) -> None:
+        if self._task_id is None:
+            return
+        try:
+            save_task_checkpoint(
+                task_id=self._task_id, checkpoint=copy.deepcopy(self._checkpoint)
+            )
+        except:
+            _LOG.warning(
+                f"Error saving checkpoint for task {self._task_id}", exc_info=True
+            )
@@ -0,0 +1,178 @@
+import datetime
+import logging
+import threading
+from typing import Dict, Any, Optional, NamedTuple, Iterator, Callable
+
+from nesis.api.core.models.entities import Datasource
+from nesis.api.core.services.util import stream_documents, get_document
+
+_LOG = logging.getLogger(__name__)
+
+
+class IndexedDocument(NamedTuple):
+    """
+    A lightweight, detached view of a Document record. It carries just enough to decide whether a file has changed
+    and to remove it from the rag engine.
+    """
+
+    id: int
+    uuid: str
+    base_uri: str
+    filename: str
+    last_modified: Optional[datetime.datetime]
+    store_metadata: Optional[Dict[str, Any]]
+    rag_metadata: Optional[Dict[str, Any]]
+
+    @property
+    def etag(self) -> Optional[str]:
+        return (self.store_metadata or {}).get("etag")
+
+
+class DocumentIndex(object):
+    """
+    A per-run, in-memory index of the documents of a datasource keyed by the document uuid.
+    The index is loaded lazily, in one streamed query, the first time it is consulted. This turns the
+    two point queries per listed object into a single query for the whole run.
+    The documents are those of the Document table unless stream is given, which returns the rows of another store
+    in the field order of IndexedDocument, and fetch, which returns the records of a document in that store.
+    Runs that only touch a few documents, such as notifications, switch to point_lookups so that they do not load
+    the whole datasource.
+    """
+
+    def __init__(
+        self,
+        datasource: Datasource,
+        stream: Callable[[], Iterator] = None,
+        fetch: Callable[[str], list] = None,
+    ):
+        self._datasource = datasource
+        self._stream = stream
+        self._fetch = fetch
+        self._prefetch = True
+        self._documents: Dict[str, IndexedDocument] = {}
+        # store_metadata key -> value -> uuid -> document, see lookup
+        self._lookups: Dict[str, Dict[Any, Dict[str, IndexedDocument]]] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            documents = {}
+            rows = (
+                stream_documents(
+                    datasource_id=self._datasource.uuid,
+                    base_uri=self._datasource.connection.get("endpoint"),
+                )
+                if self._stream is None
+                else self._stream()
+            )
+            for row in rows:
+                documents[row.uuid] = IndexedDocument(*row)
+            self._documents = documents
+            self._loaded = True
+            _LOG.debug(
+                f"Loaded {len(documents)} documents for datasource {self._datasource.name}"
+            )
+
+    def point_lookups(self) -> None:
+        """
+        Look documents up one query at a time, caching them for the rest of the run, rather than loading the
+        whole datasource on first use.
+        """
+        self._prefetch = False
+
+    def get(self, document_id: str) -> Optional[IndexedDocument]:
+        if self._prefetch:
+            self._load()
+            return self._documents.get(document_id)
+
+        with self._lock:
+            if document_id in self._documents:
+                return self._documents[document_id]
+        if self._fetch is None:
+            document = get_document(document_id=document_id)
+            records = [] if document is None else [document]
+        else:
+            records = self._fetch(document_id)
+        if not records:
+            return None
+        indexed = _indexed(records[0])
+        with self._lock:
+            return self._documents.setdefault(document_id, indexed)
+
+    def lookup(self, key: str, value: Any) -> list[IndexedDocument]:
+        """
+        The documents whose store_metadata has key set to value. The documents are indexed by key the first time
+        it is looked up, so that each lookup is a dictionary access rather than a scan of the whole index.
+        """
+        self._load()
+        with self._lock:
+            lookup = self._lookups.get(key)
+            if lookup is None:
+                lookup = {}
+                for document in self._documents.values():
+                    self._index(lookup, key, document)
+                self._lookups[key] = lookup
+            return list((lookup.get(value) or {}).values())
+
+    def put(self, document) -> None:
+        if self._prefetch:
+            self._load()
+        indexed = _indexed(document)
+        with self._lock:
+            self._unindex(self._documents.get(document.uuid))
+            self._documents[document.uuid] = indexed
+            for key, lookup in self._lookups.items():
+                self._index(lookup, key, indexed)
+
+    def remove(self, document_id: str) -> None:
+        with self._lock:
+            self._unindex(self._documents.pop(document_id, None))
+
+    @staticmethod
+    def _index(lookup: Dict, key: str, document: IndexedDocument) -> None:
+        value = (document.store_metadata or {}).get(key)
+        if value is not None:
+            lookup.setdefault(value, {})[document.uuid] = document
+
+    def _unindex(self, document: Optional[IndexedDocument]) -> None:
+        if document is None:
+            return
+        for key, lookup in self._lookups.items():
+            value = (document.store_metadata or {}).get(key)
+            documents = lookup.get(value)
+            if documents is not None:
+                documents.pop(document.uuid, None)
+                if not documents:
+                    lookup.pop(value)
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self._documents)
+
+    def __iter__(self) -> Iterator[IndexedDocument]:
+        self._load()
+        return iter(list(self._documents.values()))
+
+
+def _indexed(document) -> IndexedDocument:
+    """
+    The IndexedDocument of a Document or of an extracted record, which carries extract_metadata instead.
+    """
+    try:
+        rag_metadata = document.rag_metadata
+    except AttributeError:
+        rag_metadata = document.extract_metadata
+    return IndexedDocument(
+        id=getattr(document, "id", None),
+        uuid=document.uuid,
+        base_uri=document.base_uri,
+        filename=document.filename,
+        last_modified=document.last_modified,
+        store_metadata=document.store_metadata,
+        rag_metadata=rag_metadata,
+    )
@@ -1,25 +1,47 @@
+import concurrent.futures
 import datetime
+import hashlib
 import json
 import logging
+import os
+import shutil
+import tempfile
 import uuid
-from typing import Optional, Dict, Any, Callable
+from typing import Optional, Dict, Any, Callable, BinaryIO
 
 import nesis.api.core.util.http as http
+from nesis.api.core.document_loaders.cancellation import (
+    TaskCancellation,
+    TaskCancelled,
+)
+from nesis.api.core.document_loaders.index import DocumentIndex, IndexedDocument
+from nesis.api.core.document_loaders.progress import TaskProgress
 from nesis.api.core.document_loaders.runners import (
     IngestRunner,
     ExtractRunner,
     RagRunner,
 )
 from nesis.api.core.models.entities import Document, Datasource
-from nesis.api.core.services.util import delete_document
+from nesis.api.core.services.util import delete_document, ConflictException
 from nesis.api.core.services.util import (
     get_document,
 )
-from nesis.api.core.util.constants import DEFAULT_DATETIME_FORMAT
+from nesis.api.core.util import sharding, locks
+from nesis.api.core.util.concurrency import (
+    BlockingThreadPoolExecutor,
+    FairShareQueue,
+    fair_share_executor,
+)
+from nesis.api.core.util.constants import DEFAULT_DATETIME_FORMAT, DEFAULT_MAX_IN_FLIGHT
 from nesis.api.core.util.dateutil import strptime
 
 _LOG = logging.getLogger(__name__)
 
+# The size of the chunks read when hashing a file
+_HASH_CHUNK_SIZE = 1024 * 1024
+# Streamed files up to this size are spooled in memory while they are hashed, larger ones go to disk
+_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
 
 def upload_document_to_llm(upload_document, file_metadata, rag_endpoint, http_client):
     return _upload_document(upload_document, file_metadata, rag_endpoint, http_client)
@@ -64,14 +86,80 @@ def _upload_document(upload_document, file_metadata, rag_endpoint, http_client):
     return json.loads(response)
 
 
+class _HashingReader(object):
+    """
+    Wraps a file like object, hashing the content as it is read.
+    """
+
+    def __init__(self, body):
+        self._body = body
+        self._hash = hashlib.sha256()
+        self.complete = False
+        self.size = 0
+
+    def read(self, size=-1) -> bytes:
+        chunk = self._body.read(size)
+        if chunk:
+            self._hash.update(chunk)
+            self.size += len(chunk)
+        if not chunk or size is None or size < 0:
+            self.complete = True
+        return chunk
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._body, name)
+
+
+class _SpoolReader(object):
+    """
+    A view of a spooled file that reads it from the start and leaves it open when closed, so that it can be read
+    again if an upload is retried.
+    """
+
+    def __init__(self, spool):
+        self._spool = spool
+        self._spool.seek(0)
+
+    def read(self, size=-1) -> bytes:
+        return self._spool.read(size)
+
+    def close(self) -> None:
+        pass
+
+
+def _hash_file(file_path: str) -> str:
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as file_handle:
+        while True:
+            chunk = file_handle.read(_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
 class DocumentProcessor(object):
     def __init__(
         self,
         config,
         http_client: http.HttpClient,
         datasource: Datasource,
+        cache_client=None,
+        progress: TaskProgress = None,
+        priority: int = 0,
+        cancellation: TaskCancellation = None,
     ):
         self._datasource = datasource
+        self._progress = progress or TaskProgress()
+        self._cancellation = cancellation or TaskCancellation()
+        # The run's share of the ingestion workers, when they are shared out between datasources
+        self._fair_share = fair_share_executor(config)
+        self._weight = 1 + max(priority or 0, 0)
+        # Every file is processed under a single lock on its self_link, see _lock
+        self._locks = locks.lock_manager(config=config, cache_client=cache_client)
 
         # This is left package public for testing
         self._extract_runner: ExtractRunner = Optional[None]
@@ -85,17 +173,180 @@ class DocumentProcessor(object):
             )
 
         self._mode = self._datasource.connection.get("mode") or "ingest"
+        self._max_in_flight = int(
+            self._datasource.connection.get("max_in_flight") or DEFAULT_MAX_IN_FLIGHT
+        )
+
+        # The documents seen while listing the datasource. If the listing completes, unsync computes the
+        # deletions as a set difference instead of probing the datasource for every document.
+        self._listed_documents: set[str] = set()
+        self._listing_complete = False
+
+        # When sharding is enabled, each full listing takes a snapshot of the hash ring and this replica only
+        # processes, and unsyncs, the documents it owns. Without a snapshot, e.g. for notifications, it owns them all.
+        self._membership = sharding.membership(config)
+        self._ring: Optional[sharding.HashRing] = None
 
         match self._mode:
             case "ingest":
                 self._ingest_runners: list[RagRunner] = [_ingest_runner]
+                self._documents = DocumentIndex(datasource=datasource)
             case "extract":
                 self._ingest_runners: list[RagRunner] = [self._extract_runner]
+                # Extracted files are recorded in the destination rather than in the Document table
+                self._documents = DocumentIndex(
+                    datasource=datasource,
+                    stream=lambda: self._extract_runner.stream(datasource),
+                    fetch=lambda document_id: self._extract_runner.get(
+                        document_id=document_id
+                    ),
+                )
             case _:
                 raise ValueError(
                     f"Invalid mode {self._mode}. Expected 'ingest' or 'extract'"
                 )
 
+    def _work_queue(self) -> BlockingThreadPoolExecutor | FairShareQueue:
+        """
+        A bounded work queue for the objects of this run. At most max_in_flight objects are processed and at most
+        max_in_flight are queued, so submitting blocks the listing until a worker frees up. This keeps memory flat
+        regardless of how many objects the datasource has. With fair sharing, the objects are processed by the
+        workers shared by all the datasources, max_in_flight being the datasource's quota of them.
+        """
+        if self._fair_share is not None:
+            return self._fair_share.queue(
+                key=self._datasource.uuid,
+                weight=self._weight,
+                quota=self._max_in_flight,
+                queue_size=self._max_in_flight,
+            )
+        return BlockingThreadPoolExecutor(
+            max_workers=self._max_in_flight,
+            queue_size=self._max_in_flight,
+            thread_name_prefix=f"{self.__class__.__name__}-{self._datasource.name}",
+        )
+
+    def _submit(
+        self,
+        work_queue: BlockingThreadPoolExecutor | FairShareQueue,
+        fn,
+        *args,
+        **kwargs,
+    ) -> concurrent.futures.Future:
+        """
+        Submit an item to the work queue. Failures are logged and counted once it completes. Items still queued
+        when the run is told to stop are not processed, their future raising TaskCancelled instead.
+        """
+        future = work_queue.submit(self._process_unless_cancelled, fn, *args, **kwargs)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def _process_unless_cancelled(self, fn, *args, **kwargs):
+        if self._cancelled():
+            raise TaskCancelled()
+        return fn(*args, **kwargs)
+
+    def _log_failure(self, future) -> None:
+        if future.exception() is not None and not isinstance(
+            future.exception(), TaskCancelled
+        ):
+            _LOG.warning(future.exception())
+            self._progress.add("failed")
+
+    def _cancelled(self) -> bool:
+        """
+        Whether the run has been told to stop, see TaskCancellation. A stopped run has not listed the whole
+        datasource, so its listing is marked partial.
+        """
+        if not self._cancellation.cancelled:
+            return False
+        self._partial_listing()
+        return True
+
+    def _begin_listing(self) -> None:
+        self._listed_documents = set()
+        self._listing_complete = True
+        if self._membership is not None:
+            self._ring = self._membership.ring()
+            _LOG.debug(
+                f"Listing datasource {self._datasource.name} as one of {len(self._ring)} replicas"
+            )
+
+    def _owns(self, document_id: str) -> bool:
+        return (
+            self._ring is None
+            or self._ring.owner(document_id) == self._membership.member_id
+        )
+
+    def _listed(self, self_link: str) -> bool:
+        """
+        Record that self_link was listed. Returns False if self_link belongs to another replica's shard, in which
+        case it must be skipped.
+        """
+        document_id = self._document_id(self_link)
+        if not self._owns(document_id):
+            return False
+        self._listed_documents.add(document_id)
+        self._progress.add("listed")
+        return True
+
+    def _partial_listing(self) -> None:
+        self._listing_complete = False
+
+    def _lock(self, self_link: str):
+        """
+        Lock self_link across workers and replicas for the duration of a with block. The block receives the lease,
+        to be passed on to sync, or None if the file is already being processed.
+        """
+        return self._locks.lock(self_link)
+
+    def _document_id(self, self_link: str) -> str:
+        return str(
+            uuid.uuid5(uuid.NAMESPACE_DNS, f"{self._datasource.uuid}:{self_link}")
+        )
+
+    def is_unchanged(
+        self,
+        self_link: str,
+        last_modified: datetime.datetime,
+        store_metadata: Dict[str, Any],
+    ) -> bool:
+        """
+        Decide, from the listing metadata alone, whether a file is unchanged since it was last synced. This allows
+        processors to skip the download of unchanged files entirely. Only the keys present in both the listing and
+        the stored store_metadata (size, etag, version_id) are compared. When in doubt, we return False and let the
+        runners decide after the download.
+        """
+        document = self._documents.get(document_id=self._document_id(self_link))
+        if document is None or document.base_uri != self._datasource.connection.get(
+            "endpoint"
+        ):
+            return False
+
+        stored_metadata = document.store_metadata or {}
+        document_last_modified = document.last_modified
+        if document_last_modified is None and stored_metadata.get("last_modified"):
+            document_last_modified = strptime(
+                date_string=stored_metadata["last_modified"]
+            ).replace(tzinfo=None)
+        if document_last_modified is None:
+            return False
+
+        if last_modified.replace(tzinfo=None).replace(
+            microsecond=0
+        ) > document_last_modified.replace(microsecond=0):
+            return False
+
+        for key in ["size", "etag", "version_id"]:
+            if (
+                store_metadata.get(key) is not None
+                and stored_metadata.get(key) is not None
+                and store_metadata[key] != stored_metadata[key]
+            ):
+                return False
+        self._progress.add("skipped")
+        return True
+
     def sync(
         self,
         endpoint: str,
@@ -103,60 +354,240 @@ class DocumentProcessor(object):
         last_modified: datetime.datetime,
         metadata: Dict[str, Any],
         store_metadata: Dict[str, Any],
+        file_stream: Callable[[], BinaryIO] = None,
+        lease: locks.Lease = None,
     ) -> None:
         """
         Here we check if this file has been updated.
-        If the file has been updated, we delete it from the vector store and re-ingest the new updated file
+        If the file has been updated, we delete it from the vector store and re-ingest the new updated file.
+        If file_stream is supplied, it opens the file contents which are streamed to the rag engine, and file_path
+        is only used for its name. If the lease on the file has been lost, for example during a long download,
+        another worker may now own the file and we leave it to that worker.
+        A sha256 of the content is kept in store_metadata as content_hash so that a file whose timestamp changed but
+        whose content did not is not re-ingested.
         """
-        document_id = str(
-            uuid.uuid5(
-                uuid.NAMESPACE_DNS, f"{self._datasource.uuid}:{metadata['self_link']}"
+        document_id = self._document_id(self_link=metadata["self_link"])
+        document: IndexedDocument = self._documents.get(document_id=document_id)
+
+        spool = None
+        readers: list[_HashingReader] = []
+        store_metadata = {**store_metadata}
+        if file_stream is None:
+            try:
+                with self._progress.stage("hash"):
+                    store_metadata["content_hash"] = _hash_file(file_path)
+                self._progress.add("downloaded_bytes", os.path.getsize(file_path))
+            except OSError:
+                _LOG.debug(f"Could not hash {file_path}", exc_info=True)
+        elif document is not None and (document.store_metadata or {}).get(
+            "content_hash"
+        ):
+            # The runners compare the content hash with the stored one before uploading, so the content is
+            # hashed first, spooled as it is downloaded and uploaded from the spool if it has changed.
+            try:
+                with self._progress.stage("download"):
+                    spool, store_metadata["content_hash"], size = self._spool(
+                        file_stream
+                    )
+            except Exception:
+                self._progress.add("failed")
+                raise
+            self._progress.add("downloaded_bytes", size)
+
+            def file_stream():
+                return _SpoolReader(spool)
+
+        else:
+            # Nothing to compare against, the content is hashed as it is uploaded
+            _file_stream = file_stream
+
+            def file_stream():
+                reader = _HashingReader(_file_stream())
+                readers.append(reader)
+                return reader
+
+        try:
+            self._sync(
+                endpoint=endpoint,
+                file_path=file_path,
+                last_modified=last_modified,
+                metadata=metadata,
+                store_metadata=store_metadata,
+                file_stream=file_stream,
+                lease=lease,
+                document_id=document_id,
+                document=document,
+                readers=readers,
             )
-        )
-        document: Document = get_document(document_id=document_id)
+        except Exception:
+            self._progress.add("failed")
+            raise
+        finally:
+            self._progress.add("downloaded_bytes", sum(r.size for r in readers))
+            if spool is not None:
+                spool.close()
+
+    @staticmethod
+    def _spool(file_stream: Callable[[], BinaryIO]):
+        spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+        body = _HashingReader(file_stream())
+        try:
+            shutil.copyfileobj(body, spool, _HASH_CHUNK_SIZE)
+        except Exception:
+            spool.close()
+            raise
+        finally:
+            body.close()
+            if hasattr(body, "release_conn"):
+                body.release_conn()
+        return spool, body.hexdigest(), body.size
+
+    def _sync(
+        self,
+        endpoint: str,
+        file_path: str,
+        last_modified: datetime.datetime,
+        metadata: Dict[str, Any],
+        store_metadata: Dict[str, Any],
+        file_stream: Optional[Callable[[], BinaryIO]],
+        lease: Optional[locks.Lease],
+        document_id: str,
+        document: Optional[IndexedDocument],
+        readers: list,
+    ) -> None:
+        if lease is not None:
+            # Saving is refused once a worker that took the lock over saved the file, see locks.Lease
+            store_metadata["lock_token"] = lease.token
         for _ingest_runner in self._ingest_runners:
-            try:
-                response_json = _ingest_runner.run(
-                    file_path=file_path,
-                    metadata=metadata,
-                    document_id=None if document is None else document.uuid,
-                    last_modified=last_modified.replace(tzinfo=None).replace(
-                        microsecond=0
-                    ),
-                    datasource=self._datasource,
+            if lease is not None and not lease.held:
+                _LOG.warning(
+                    f"Lost the lock on {metadata['self_link']} (token {lease.token}), skipping it"
                 )
+                return
+            try:
+                with self._progress.stage("upload"):
+                    response_json = _ingest_runner.run(
+                        file_path=file_path,
+                        metadata=metadata,
+                        document_id=None if document is None else document.uuid,
+                        last_modified=last_modified.replace(tzinfo=None).replace(
+                            microsecond=0
+                        ),
+                        datasource=self._datasource,
+                        document=document,
+                        documents=self._documents,
+                        file_stream=file_stream,
+                        size=store_metadata.get("size"),
+                        store_metadata=store_metadata,
+                    )
             except ValueError:
                 _LOG.warning(f"File {file_path} ingestion failed", exc_info=True)
-                response_json = None
-            except UserWarning:
-                _LOG.warning(f"File {file_path} is already processing")
+                self._progress.add("failed")
                 continue
+            except ConflictException:
+                _LOG.warning(
+                    f"File {metadata['self_link']} was taken over by another worker, skipping it"
+                )
+                self._progress.add("skipped")
+                return
 
             if response_json is None:
+                # The runner found the file unchanged
                 _LOG.warning("No response from ingest runner received")
+                self._progress.add("skipped")
                 continue
 
-            _ingest_runner.save(
-                document_id=document_id,
-                datasource_id=self._datasource.uuid,
-                filename=store_metadata["filename"],
-                base_uri=endpoint,
-                rag_metadata=response_json,
-                store_metadata=store_metadata,
-                last_modified=last_modified,
-            )
+            if readers and readers[-1].complete:
+                store_metadata["content_hash"] = readers[-1].hexdigest()
+
+            with self._progress.stage("save"):
+                try:
+                    saved_document = _ingest_runner.save(
+                        document_id=document_id,
+                        datasource_id=self._datasource.uuid,
+                        filename=store_metadata["filename"],
+                        base_uri=endpoint,
+                        rag_metadata=response_json,
+                        store_metadata=store_metadata,
+                        last_modified=last_modified,
+                    )
+                except ConflictException:
+                    _LOG.warning(
+                        f"File {metadata['self_link']} was saved by another worker since, discarding this ingestion"
+                    )
+                    _ingest_runner.discard(rag_metadata=response_json)
+                    self._progress.add("skipped")
+                    return
+            self._progress.add("uploaded")
+            if isinstance(saved_document, Document):
+                self._documents.put(saved_document)
+
+    def remove(self, self_link: str) -> None:
+        """
+        Remove a single document, for example when we are notified that it was deleted from the datasource.
+        """
+        self.remove_document(document_id=self._document_id(self_link=self_link))
+
+    def flush(self) -> None:
+        """
+        Write out what the runners buffered, such as extracted records. Processors flush at the end of a run.
+        """
+        for _ingest_runner in self._ingest_runners:
+            try:
+                _ingest_runner.flush()
+            except:
+                _LOG.warning("Error flushing ingest runner", exc_info=True)
+
+    def remove_document(self, document_id: str) -> None:
+        for _ingest_runner in self._ingest_runners:
+            for document in _ingest_runner.get(document_id=document_id):
+                try:
+                    rag_metadata = document.rag_metadata
+                except AttributeError:
+                    rag_metadata = document.extract_metadata
+                _ingest_runner.delete(document=document, rag_metadata=rag_metadata)
+                self._progress.add("deleted")
+        self._documents.remove(document_id)
 
     def unsync(self, clean: Callable) -> None:
+        """
+        Remove documents that no longer exist in the datasource. When the sync pass listed the whole datasource,
+        a document of this datasource is deleted if it was not listed. Otherwise, and for documents without a
+        datasource_id, we fall back to probing the datasource with clean. When sharding is enabled, only the documents
+        in this replica's shard are considered.
+        """
+        if self._cancelled():
+            _LOG.info(
+                f"Skipping unsync of datasource {self._datasource.name} - {self._cancellation.reason}"
+            )
+            return
+        with self._progress.stage("unsync"):
+            self._unsync(clean=clean)
+
+    def _unsync(self, clean: Callable) -> None:
         endpoint = self._datasource.connection.get("endpoint")
 
         for _ingest_runner in self._ingest_runners:
             documents = _ingest_runner.get(base_uri=endpoint)
             for document in documents:
+                if self._cancelled():
+                    return
+                if not self._owns(document.uuid):
+                    continue
                 store_metadata = document.store_metadata
                 try:
                     rag_metadata = document.rag_metadata
                 except AttributeError:
                     rag_metadata = document.extract_metadata
 
-                if clean(store_metadata=store_metadata):
+                if (
+                    self._listing_complete
+                    and document.datasource_id == self._datasource.uuid
+                ):
+                    is_deleted = document.uuid not in self._listed_documents
+                else:
+                    is_deleted = clean(store_metadata=store_metadata)
+
+                if is_deleted:
                     _ingest_runner.delete(document=document, rag_metadata=rag_metadata)
+                    self._progress.add("deleted")
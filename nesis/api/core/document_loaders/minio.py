@@ -1,20 +1,22 @@
+import collections
+import concurrent.futures
 import logging
-import logging
-import os
-import tempfile
-from typing import Dict, Any
+from typing import Dict, Any, List
+from urllib.parse import unquote_plus
 
 import memcache
 from minio import Minio
 
 import nesis.api.core.util.http as http
+from nesis.api.core.document_loaders.cancellation import (
+    TaskCancellation,
+    TaskCancelled,
+)
+from nesis.api.core.document_loaders.checkpoint import TaskCheckpoint
 from nesis.api.core.document_loaders.loader_helper import DocumentProcessor
+from nesis.api.core.document_loaders.progress import TaskProgress
 from nesis.api.core.models.entities import Datasource
-from nesis.api.core.util import clean_control, isblank
-from nesis.api.core.util.concurrency import (
-    IOBoundPool,
-    as_completed,
-)
+from nesis.api.core.util import isblank
 from nesis.api.core.util.constants import DEFAULT_DATETIME_FORMAT
 
 _LOG = logging.getLogger(__name__)
@@ -27,27 +29,30 @@ class MinioProcessor(DocumentProcessor):
         http_client: http.HttpClient,
         cache_client: memcache.Client,
         datasource: Datasource,
+        checkpoint: TaskCheckpoint = None,
+        progress: TaskProgress = None,
+        priority: int = 0,
+        cancellation: TaskCancellation = None,
     ):
-        super().__init__(config, http_client, datasource)
+        super().__init__(
+            config,
+            http_client,
+            datasource,
+            cache_client=cache_client,
+            progress=progress,
+            priority=priority,
+            cancellation=cancellation,
+        )
         self._config = config
         self._http_client = http_client
         self._cache_client = cache_client
         self._datasource = datasource
+        self._checkpoint = checkpoint or TaskCheckpoint()
 
     def run(self, metadata: Dict[str, Any]):
         connection: Dict[str, str] = self._datasource.connection
         try:
-            endpoint = connection.get("endpoint")
-            access_key = connection.get("user")
-            secret_key = connection.get("password")
-
-            endpoint_parts = endpoint.split("://")
-            _minio_client = Minio(
-                endpoint=endpoint_parts[1].split("/")[0],
-                access_key=access_key,
-                secret_key=secret_key,
-                secure=endpoint_parts[0] == "https",
-            )
+            _minio_client = _create_client(connection=connection)
 
             self._sync_documents(
                 client=_minio_client,
@@ -59,6 +64,58 @@ class MinioProcessor(DocumentProcessor):
             )
         except:
             _LOG.exception("Error fetching sharepoint documents")
+        finally:
+            self.flush()
+
+    def process_events(
+        self, records: List[Dict[str, Any]], metadata: Dict[str, Any]
+    ) -> None:
+        """
+        Sync only the objects in a bucket notification, in the S3 event notification format. Created objects take
+        the same path as a listed object while removed objects are removed from the rag engine. The scheduled full
+        scan remains as a low frequency reconciliation.
+        """
+        connection: Dict[str, str] = self._datasource.connection
+        endpoint = connection["endpoint"]
+        bucket_names = [
+            bucket_name.strip() for bucket_name in connection["dataobjects"].split(",")
+        ]
+        client = _create_client(connection=connection)
+        # A notification names a few objects, so they are looked up one by one rather than loading the datasource
+        self._documents.point_lookups()
+
+        for record in records:
+            event_name = record.get("eventName") or ""
+            try:
+                bucket_name = record["s3"]["bucket"]["name"]
+                # Object keys in notifications are URL encoded
+                object_name = unquote_plus(record["s3"]["object"]["key"])
+            except (KeyError, TypeError):
+                _LOG.warning(f"Skipping invalid {event_name} notification record")
+                continue
+
+            if bucket_name not in bucket_names:
+                _LOG.debug(f"Skipping notification for unsynced bucket {bucket_name}")
+                continue
+
+            try:
+                if event_name.startswith("s3:ObjectCreated:"):
+                    item = client.stat_object(
+                        bucket_name=bucket_name, object_name=object_name
+                    )
+                    self._process_object(
+                        bucket_name, client, self._datasource, item, metadata
+                    )
+                elif event_name.startswith("s3:ObjectRemoved:"):
+                    self.remove(self_link=f"{endpoint}/{bucket_name}/{object_name}")
+                else:
+                    _LOG.debug(f"Ignoring {event_name} notification on {object_name}")
+            except:
+                _LOG.warning(
+                    f"Error processing {event_name} notification on {object_name}",
+                    exc_info=True,
+                )
+        self.flush()
 
     def _sync_documents(
         self,
@@ -73,34 +130,88 @@ class MinioProcessor(DocumentProcessor):
             bucket_names = connection.get("dataobjects")
 
             bucket_names_parts = bucket_names.split(",")
-            futures = []
-
-            for bucket_name in bucket_names_parts:
-                try:
-                    bucket_objects = client.list_objects(bucket_name, recursive=True)
-                except:
-                    _LOG.warning(f"Failed to list objects in bucket {bucket_name}")
-                    continue
-
-                for bucket_object in bucket_objects:
-                    futures.append(
-                        IOBoundPool.submit(
-                            self._process_object,
-                            bucket_name,
-                            client,
-                            datasource,
-                            bucket_object,
-                            metadata,
-                        )
+            work_queue = self._work_queue()
+            self._begin_listing()
+
+            try:
+                for bucket_name in bucket_names_parts:
+                    if self._cancelled():
+                        break
+                    self._list_objects(
+                        client=client,
+                        datasource=datasource,
+                        metadata=metadata,
+                        work_queue=work_queue,
+                        bucket_name=bucket_name,
                     )
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except:
-                    _LOG.warning(future.exception())
+            finally:
+                work_queue.shutdown(wait=True)
         except:
+            self._partial_listing()
             _LOG.warning("Error fetching and updating documents", exc_info=True)
 
+    def _list_objects(
+        self, client: Minio, datasource: Datasource, metadata, work_queue, bucket_name
+    ) -> None:
+        """
+        List a bucket and queue its objects for processing. Objects are listed in key order, so if the run is told
+        to stop, the bucket is checkpointed with the last key before which every object was processed and the next
+        run resumes after it.
+        """
+        list_kwargs = {"recursive": True}
+        start_after = (self._checkpoint.get(bucket_name) or {}).get("start_after")
+        if start_after is not None:
+            _LOG.info(f"Resuming listing of bucket {bucket_name} after {start_after}")
+            list_kwargs["start_after"] = start_after
+            # Objects before the checkpoint are not listed in this run
+            self._partial_listing()
+
+        try:
+            bucket_objects = client.list_objects(bucket_name, **list_kwargs)
+        except:
+            _LOG.warning(f"Failed to list objects in bucket {bucket_name}")
+            self._partial_listing()
+            return
+
+        pending = collections.deque()
+        for bucket_object in bucket_objects:
+            if self._cancelled():
+                break
+            future = self._submit(
+                work_queue,
+                self._process_object,
+                bucket_name,
+                client,
+                datasource,
+                bucket_object,
+                metadata,
+            )
+            pending.append((future, bucket_object.object_name))
+            start_after = self._processed_until(pending, start_after)
+
+        if not self._cancelled():
+            self._checkpoint.remove(bucket_name)
+            return
+
+        concurrent.futures.wait([future for future, _ in pending])
+        start_after = self._processed_until(pending, start_after)
+        if start_after is not None:
+            self._checkpoint.put(bucket_name, {"start_after": start_after})
+
+    @staticmethod
+    def _processed_until(pending, start_after):
+        """
+        Drop the processed objects at the head of pending, returning the key of the last one. Objects that were
+        not processed because the run stopped hold the head back.
+        """
+        while pending and pending[0][0].done():
+            future, object_name = pending[0]
+            if isinstance(future.exception(), TaskCancelled):
+                break
+            pending.popleft()
+            start_after = object_name
+        return start_after
+
     def _process_object(self, bucket_name, client, datasource, item, metadata):
         connection = datasource.connection
         endpoint = connection["endpoint"]
@@ -110,24 +221,36 @@ class MinioProcessor(DocumentProcessor):
             "file_name": f"{bucket_name}/{item.object_name}",
             "self_link": self_link,
         }
-        """
-        We use memcache's add functionality to implement a shared lock to allow for multiple instances
-        operating 
-        """
-        _lock_key = clean_control(f"{__name__}/locks/{self_link}")
-        if self._cache_client.add(key=_lock_key, val=_lock_key, time=30 * 60):
-            try:
-                self._sync_document(
-                    client=client,
-                    datasource=datasource,
-                    metadata=_metadata,
-                    bucket_name=bucket_name,
-                    item=item,
-                )
-            finally:
-                self._cache_client.delete(_lock_key)
-        else:
-            _LOG.info(f"Document {self_link} is already processing")
+        if not self._listed(self_link):
+            # The object belongs to another replica's shard
+            return
+
+        if self.is_unchanged(
+            self_link=self_link,
+            last_modified=item.last_modified,
+            store_metadata={
+                "size": item.size,
+                "etag": item.etag,
+                "version_id": item.version_id,
+            },
+        ):
+            _LOG.debug(
+                f"Skipping unchanged object {item.object_name} in bucket {bucket_name}"
+            )
+            return
+
+        with self._lock(self_link) as lease:
+            if lease is None:
+                _LOG.info(f"Document {self_link} is already processing")
+                return
+            self._sync_document(
+                client=client,
+                datasource=datasource,
+                metadata=_metadata,
+                bucket_name=bucket_name,
+                item=item,
+                lease=lease,
+            )
 
     def _sync_document(
         self,
@@ -136,27 +259,26 @@ class MinioProcessor(DocumentProcessor):
         metadata: dict,
         bucket_name: str,
         item,
+        lease=None,
     ):
         connection = datasource.connection
         endpoint = connection["endpoint"]
         _metadata = metadata
-        tmp_file = tempfile.NamedTemporaryFile(delete=False)
         try:
             _LOG.info(
                 f"Starting {self._mode}ing object {item.object_name} in bucket {bucket_name}"
             )
-            file_path = f"{tmp_file.name}-{item.object_name}"
 
-            # Write item to file
-            client.fget_object(
-                bucket_name=bucket_name,
-                object_name=item.object_name,
-                file_path=file_path,
-            )
+            def file_stream():
+                # The object body is piped straight into the upload so no temporary file is written
+                return client.get_object(
+                    bucket_name=bucket_name,
+                    object_name=item.object_name,
+                )
 
             self.sync(
                 endpoint,
-                file_path,
+                item.object_name,
                 item.last_modified,
                 metadata,
                 store_metadata={
@@ -168,7 +290,10 @@ class MinioProcessor(DocumentProcessor):
                         DEFAULT_DATETIME_FORMAT
                     ),
                     "version_id": item.version_id,
+                    "etag": item.etag,
                 },
+                file_stream=file_stream,
+                lease=lease,
             )
 
             _LOG.info(
@@ -179,9 +304,6 @@ class MinioProcessor(DocumentProcessor):
                 f"Error when getting and ingesting document {item.object_name} - {ex}",
                 exc_info=True,
             )
-        finally:
-            tmp_file.close()
-            os.unlink(tmp_file.name)
 
     def _unsync_documents(
         self,
@@ -209,8 +331,30 @@ class MinioProcessor(DocumentProcessor):
             _LOG.warning("Error fetching and updating documents", exc_info=True)
 
 
+def _create_client(connection: Dict[str, Any]) -> Minio:
+    endpoint = connection.get("endpoint")
+    access_key = connection.get("user")
+    secret_key = connection.get("password")
+
+    endpoint_parts = endpoint.split("://")
+    return Minio(
+        endpoint=endpoint_parts[1].split("/")[0],
+        access_key=access_key,
+        secret_key=secret_key,
+        secure=endpoint_parts[0] == "https",
+    )
+
+
 def validate_connection_info(connection: Dict[str, Any]) -> Dict[str, Any]:
-    _valid_keys = ["endpoint", "user", "password", "dataobjects", "destination", "mode"]
+    _valid_keys = [
+        "endpoint",
+        "user",
+        "password",
+        "dataobjects",
+        "destination",
+        "mode",
+        "max_in_flight",
+    ]
     assert not isblank(connection.get("endpoint")), "An endpoint must be supplied"
     assert not isblank(
         connection.get("dataobjects")
@@ -0,0 +1,111 @@
+import contextlib
+import datetime
+import logging
+import threading
+import time
+from typing import Dict, Optional, Iterator
+
+from nesis.api.core.models.objects import TaskStatus
+from nesis.api.core.services.util import update_task_run
+
+_LOG = logging.getLogger(__name__)
+
+COUNTERS = ["listed", "skipped", "downloaded_bytes", "uploaded", "failed", "deleted"]
+
+
+class TaskProgress(object):
+    """
+    Counters and stage timings of a task run. Workers add to the counters in memory and, at most every interval
+    seconds, whoever crosses the interval writes what was added since the last write to the task run record in one
+    update. Without a task run, the progress only lives for the duration of the run.
+    """
+
+    def __init__(self, task_run_id: Optional[str] = None, interval: float = 5.0):
+        self._task_run_id = task_run_id
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._counters: Dict[str, int] = {counter: 0 for counter in COUNTERS}
+        self._pending: Dict[str, int] = {counter: 0 for counter in COUNTERS}
+        self._timings: Dict[str, float] = {}
+        self._last_write = time.monotonic()
+
+    @property
+    def task_run_id(self) -> Optional[str]:
+        return self._task_run_id
+
+    def add(self, counter: str, value: int = 1) -> None:
+        if not value:
+            return
+        with self._lock:
+            self._counters[counter] += value
+            self._pending[counter] += value
+        self._write_due()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Add the time spent in a with block to the stage's timing.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._timings[name] = self._timings.get(name, 0.0) + elapsed
+            self._write_due()
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {**self._counters, "timings": {**self._timings}}
+
+    def flush(self) -> None:
+        with self._write_lock:
+            self._write()
+
+    def finish(self, status: TaskStatus = TaskStatus.COMPLETED) -> None:
+        """
+        Write out the remaining progress and close the task run with status.
+        """
+        with self._write_lock:
+            self._write(status=status, end_date=datetime.datetime.utcnow())
+
+    def _write_due(self) -> None:
+        if self._task_run_id is None:
+            return
+        if time.monotonic() - self._last_write < self._interval:
+            return
+        # A worker already writing covers what the others just added
+        if not self._write_lock.acquire(blocking=False):
+            return
+        try:
+            self._write()
+        finally:
+            self._write_lock.release()
+
+    def _write(self, **kwargs) -> None:
+        if self._task_run_id is None:
+            return
+        with self._lock:
+            counters = {
+                counter: value for counter, value in self._pending.items() if value
+            }
+            self._pending = {counter: 0 for counter in COUNTERS}
+            timings = {name: round(value, 3) for name, value in self._timings.items()}
+            self._last_write = time.monotonic()
+        try:
+            update_task_run(
+                task_run_id=self._task_run_id,
+                counters=counters,
+                timings=timings,
+                **kwargs,
+            )
+        except:
+            _LOG.warning(
+                f"Error saving progress of task run {self._task_run_id}", exc_info=True
+            )
+            # Keep the counters for the next write
+            with self._lock:
+                for counter, value in counters.items():
+                    self._pending[counter] += value
@@ -2,16 +2,21 @@ import abc
 import datetime
 import json
 import logging
-from typing import Dict, Any, Union
+from typing import Dict, Any, Iterator, Union
 
 import nesis.api.core.util.http as http
-from nesis.api.core.document_loaders.stores import SqlDocumentStore
+from nesis.api.core.document_loaders.stores import (
+    SqlDocumentStore,
+    ParquetDocumentStore,
+)
 from nesis.api.core.models.entities import Document, Datasource
 from nesis.api.core.services.util import (
     save_document,
     get_document,
     delete_document,
     get_documents,
+    touch_document,
+    ConflictException,
 )
 from nesis.api.core.util.dateutil import strptime
 
@@ -43,6 +48,18 @@ class RagRunner(abc.ABC):
     def get(self, **kwargs) -> list:
         pass
 
+    def discard(self, rag_metadata: Dict[str, Any]) -> None:
+        """
+        Drop the output of a run that is not saved, for example because the file was taken over by another worker.
+        """
+        pass
+
+    def flush(self) -> None:
+        """
+        Write out anything the runner buffered.
+        """
+        pass
+
 
 class ExtractRunner(RagRunner):
 
@@ -58,9 +75,12 @@ class ExtractRunner(RagRunner):
 
         if destination is None:
             raise ValueError("Destination for the extraction is missing")
-        _sql_extraction_store = destination["sql"]
+        if destination.get("parquet") is not None:
+            self._extraction_store = ParquetDocumentStore(**destination["parquet"])
+        else:
+            _sql_extraction_store = destination["sql"]
 
-        self._extraction_store = SqlDocumentStore(**_sql_extraction_store)
+            self._extraction_store = SqlDocumentStore(**_sql_extraction_store)
         self._rag_endpoint = (self._config.get("rag") or {}).get("endpoint")
 
     def run(
@@ -76,7 +96,9 @@ class ExtractRunner(RagRunner):
         if document_id is not None:
             _LOG.debug(f"Checking if document {document_id} is modified")
             _is_modified = self._is_modified(
-                document_id=document_id, last_modified=last_modified
+                document_id=document_id,
+                last_modified=last_modified,
+                document=kwargs.get("document"),
             )
             if _is_modified is None or not _is_modified:
                 _LOG.debug(f"Document {document_id} is not modified")
@@ -89,32 +111,41 @@ class ExtractRunner(RagRunner):
             filepath=file_path,
             field="file",
             metadata=metadata,
+            stream=kwargs.get("file_stream"),
         )
         return json.loads(response)
 
     def get(self, **kwargs) -> list:
-        return self._extraction_store.get(base_uri=kwargs.get("base_uri"))
+        return self._extraction_store.get(
+            base_uri=kwargs.get("base_uri"), document_id=kwargs.get("document_id")
+        )
+
+    def stream(self, datasource: Datasource) -> Iterator:
+        """
+        Stream the extracted records of a datasource in one query, see SqlDocumentStore.stream
+        """
+        return self._extraction_store.stream(
+            datasource_id=datasource.uuid,
+            base_uri=datasource.connection.get("endpoint"),
+        )
 
     def _is_modified(
-        self, document_id, last_modified: datetime.datetime
+        self, document_id, last_modified: datetime.datetime, document=None
     ) -> Union[bool, None]:
         """
         Here we check if this file has been updated.
-        If the file has been updated, we delete it from the vector store and re-ingest the new updated file
+        If the file has been updated, we extract it again and its record is replaced when the new one is saved.
+        The document may be supplied from a prefetched DocumentIndex to avoid a lookup per file.
         """
-        documents = self._extraction_store.get(document_id=document_id)
+        documents = (
+            self._extraction_store.get(document_id=document_id)
+            if document is None
+            else [document]
+        )
         for document in documents:
-            if document is not None and last_modified.replace(
+            return last_modified.replace(
                 microsecond=0
-            ) > document.last_modified.replace(microsecond=0):
-                try:
-                    self.delete(document=document)
-                except:
-                    _LOG.warning(
-                        f"Failed to delete document {document_id}'s record. Continuing anyway..."
-                    )
-                return True
-            return False
+            ) > document.last_modified.replace(microsecond=0)
 
     def save(self, **kwargs):
         return self._extraction_store.save(
@@ -129,12 +160,20 @@ class ExtractRunner(RagRunner):
         )
 
     def delete(self, document, **kwargs) -> None:
-        self._extraction_store.delete(document_id=document.uuid)
+        # The record is at hand, so a parquet store appends the tombstone without reading the dataset
+        self._extraction_store.delete(document_id=document.uuid, record=document)
+
+    def flush(self) -> None:
+        self._extraction_store.flush()
 
 
 class IngestRunner(RagRunner):
 
     def get(self, **kwargs) -> list:
+        document_id = kwargs.get("document_id")
+        if document_id is not None:
+            document = get_document(document_id=document_id)
+            return [] if document is None else [document]
         base_uri = kwargs.get("base_uri")
         return get_documents(base_uri=base_uri)
 
@@ -144,6 +183,15 @@ class IngestRunner(RagRunner):
         self._endpoint = self._config
 
         self._rag_endpoint = (self._config.get("rag") or {}).get("endpoint")
+        self._batch = (self._config.get("rag") or {}).get("batch") or {}
+
+    def _batches(self, size) -> bool:
+        """
+        Whether a file of this size is uploaded as part of a batch to the bulk ingest endpoint
+        """
+        max_files = int(self._batch.get("max_files") or 0)
+        max_file_size = int(self._batch.get("max_file_size") or 0)
+        return max_files > 1 and size is not None and int(size) <= max_file_size
 
     def run(
         self,
@@ -160,10 +208,28 @@ class IngestRunner(RagRunner):
                 document_id=document_id,
                 datasource=datasource,
                 last_modified=last_modified,
+                document=kwargs.get("document"),
+                store_metadata=kwargs.get("store_metadata"),
+                documents=kwargs.get("documents"),
             )
             if _is_modified is None or not _is_modified:
                 return
 
+        size = kwargs.get("size")
+        if self._batches(size):
+            response = self._http_client.upload_batched(
+                url=f"{self._rag_endpoint}/v1/ingest/files/bulk",
+                filepath=file_path,
+                field="files",
+                metadata=metadata,
+                size=int(size),
+                max_files=int(self._batch["max_files"]),
+                max_bytes=int(self._batch.get("max_bytes") or 0),
+                linger=float(self._batch.get("linger") or 0),
+                stream=kwargs.get("file_stream"),
+            )
+            return json.loads(response)
+
         url = f"{self._rag_endpoint}/v1/ingest/files"
 
         response = self._http_client.upload(
@@ -171,33 +237,69 @@ class IngestRunner(RagRunner):
             filepath=file_path,
             field="file",
             metadata=metadata,
+            stream=kwargs.get("file_stream"),
         )
         return json.loads(response)
 
     def _is_modified(
-        self, document_id, datasource: Datasource, last_modified: datetime.datetime
+        self,
+        document_id,
+        datasource: Datasource,
+        last_modified: datetime.datetime,
+        document=None,
+        store_metadata: Dict[str, Any] = None,
+        documents=None,
     ) -> Union[bool, None]:
         """
         Here we check if this file has been updated.
-        If the file has been updated, we delete it from the vector store and re-ingest the new updated file
+        If the file has been updated, we delete it from the vector store and re-ingest the new updated file.
+        The document may be supplied from a prefetched DocumentIndex, documents, to avoid a lookup per file.
+        If only the timestamp changed, that is, the new store_metadata carries the content_hash we stored, the
+        record and its entry in documents are brought up to date and the ingested documents are kept.
         """
         endpoint = datasource.connection["endpoint"]
-        document: Document = get_document(document_id=document_id)
+        if document is None:
+            document = get_document(document_id=document_id)
         if document is None or document.base_uri != endpoint:
             return False
-        store_metadata = document.store_metadata
+        stored_metadata = document.store_metadata
         document_last_modified = document.last_modified
         if (
             document_last_modified is None
-            and store_metadata is not None
-            and store_metadata.get("last_modified")
+            and stored_metadata is not None
+            and stored_metadata.get("last_modified")
         ):
             document_last_modified = strptime(
-                date_string=store_metadata["last_modified"]
+                date_string=stored_metadata["last_modified"]
             ).replace(tzinfo=None)
         if document_last_modified is not None and last_modified.replace(
             microsecond=0
         ) > document_last_modified.replace(microsecond=0):
+            content_hash = (store_metadata or {}).get("content_hash")
+            if content_hash is not None and content_hash == (stored_metadata or {}).get(
+                "content_hash"
+            ):
+                _LOG.info(
+                    f"Document {document_id} content is unchanged, keeping its ingested documents"
+                )
+                touched = touch_document(
+                    document_id=document.uuid,
+                    store_metadata=store_metadata,
+                    last_modified=last_modified,
+                )
+                if touched is not None and documents is not None:
+                    documents.put(touched)
+                return False
+            lock_token = (store_metadata or {}).get("lock_token")
+            if lock_token is not None:
+                # The document may have been taken over, and re-ingested, since it was indexed
+                current = get_document(document_id=document_id)
+                if current is not None and lock_token < (
+                    (current.store_metadata or {}).get("lock_token") or 0
+                ):
+                    raise ConflictException(
+                        f"Document {document_id} was saved under a newer lock"
+                    )
             try:
                 self.delete(document=document, rag_metadata=document.rag_metadata)
             except:
@@ -220,16 +322,8 @@ class IngestRunner(RagRunner):
         )
 
     def delete(self, document: Document, **kwargs) -> None:
-        endpoint = (self._config.get("rag") or {}).get("endpoint")
-        rag_metadata = kwargs["rag_metadata"]
-
         try:
-            self._http_client.deletes(
-                urls=[
-                    f"{endpoint}/v1/ingest/documents/{document_data['doc_id']}"
-                    for document_data in rag_metadata.get("data") or []
-                ]
-            )
+            self._delete_ingested(kwargs["rag_metadata"])
         except:
             _LOG.warning(
                 f"Failed to delete document {document.filename}",
@@ -238,3 +332,20 @@ class IngestRunner(RagRunner):
 
         _LOG.info(f"Deleting document {document.filename}")
         delete_document(document_id=document.id)
+
+    def discard(self, rag_metadata: Dict[str, Any]) -> None:
+        self._delete_ingested(rag_metadata)
+
+    def _delete_ingested(self, rag_metadata: Dict[str, Any]) -> None:
+        endpoint = (self._config.get("rag") or {}).get("endpoint")
+        doc_ids = [
+            document_data["doc_id"]
+            for document_data in (rag_metadata or {}).get("data") or []
+        ]
+        # A single file can produce many rag documents so they are deleted in one request
+        if len(doc_ids) > 0:
+            self._http_client.post(
+                url=f"{endpoint}/v1/ingest/documents/delete",
+                payload=json.dumps({"doc_ids": doc_ids}),
+                headers={"Content-Type": "application/json"},
+            )
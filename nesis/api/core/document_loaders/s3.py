@@ -1,15 +1,20 @@
+import collections
+import concurrent.futures
 import json
 import logging
-import pathlib
-import tempfile
-from concurrent.futures import as_completed
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 import boto3
 import memcache
 
 import nesis.api.core.util.http as http
+from nesis.api.core.document_loaders.cancellation import (
+    TaskCancellation,
+    TaskCancelled,
+)
+from nesis.api.core.document_loaders.checkpoint import TaskCheckpoint
 from nesis.api.core.document_loaders.loader_helper import DocumentProcessor
+from nesis.api.core.document_loaders.progress import TaskProgress
 from nesis.api.core.models.entities import Document, Datasource
 from nesis.api.core.services import util
 from nesis.api.core.services.util import (
@@ -19,7 +24,7 @@ from nesis.api.core.services.util import (
     get_documents,
     ingest_file,
 )
-from nesis.api.core.util import clean_control, isblank
+from nesis.api.core.util import isblank
 from nesis.api.core.util.concurrency import IOBoundPool
 from nesis.api.core.util.constants import DEFAULT_DATETIME_FORMAT
 from nesis.api.core.util.dateutil import strptime
@@ -34,12 +39,25 @@ class Processor(DocumentProcessor):
         http_client: http.HttpClient,
         cache_client: memcache.Client,
         datasource: Datasource,
+        checkpoint: TaskCheckpoint = None,
+        progress: TaskProgress = None,
+        priority: int = 0,
+        cancellation: TaskCancellation = None,
     ):
-        super().__init__(config, http_client, datasource)
+        super().__init__(
+            config,
+            http_client,
+            datasource,
+            cache_client=cache_client,
+            progress=progress,
+            priority=priority,
+            cancellation=cancellation,
+        )
         self._config = config
         self._http_client = http_client
         self._cache_client = cache_client
         self._datasource = datasource
+        self._checkpoint = checkpoint or TaskCheckpoint()
 
     def run(self, metadata: Dict[str, Any]):
         connection: Dict[str, str] = self._datasource.connection
@@ -82,6 +100,8 @@ class Processor(DocumentProcessor):
             )
         except:
             _LOG.exception("Error fetching sharepoint documents")
+        finally:
+            self.flush()
 
     def _sync_documents(
         self,
@@ -99,49 +119,149 @@ class Processor(DocumentProcessor):
                 _LOG.warning("No bucket names supplied, so I can't do much")
 
             bucket_paths_parts = bucket_paths.split(",")
-            futures = []
-            for bucket_path in bucket_paths_parts:
+            split_prefixes = str(connection.get("split_prefixes")).lower() == "true"
+            work_queue = self._work_queue()
+            self._begin_listing()
 
-                # a/b/c/// should only give [a,b,c]
-                bucket_path_parts = [
-                    part for part in bucket_path.split("/") if len(part) != 0
-                ]
+            try:
+                for bucket_path in bucket_paths_parts:
+                    if self._cancelled():
+                        break
 
-                path = "/".join(bucket_path_parts[1:])
-                bucket_name = bucket_path_parts[0]
+                    # a/b/c/// should only give [a,b,c]
+                    bucket_path_parts = [
+                        part for part in bucket_path.split("/") if len(part) != 0
+                    ]
 
-                paginator = client.get_paginator("list_objects_v2")
-                page_iterator = paginator.paginate(
-                    Bucket=bucket_name,
-                    Prefix="" if path == "" else f"{path}/",
-                )
-                for result in page_iterator:
-                    if result["KeyCount"] == 0:
+                    path = "/".join(bucket_path_parts[1:])
+                    bucket_name = bucket_path_parts[0]
+                    prefix = "" if path == "" else f"{path}/"
+
+                    if not split_prefixes:
+                        self._list_objects(
+                            client,
+                            datasource,
+                            metadata,
+                            work_queue,
+                            bucket_name,
+                            prefix,
+                        )
                         continue
-                    # iterate through files
-                    for item in result["Contents"]:
-                        # Paths ending in / are folders so we skip them
-                        if item["Key"].endswith("/"):
-                            continue
-                        futures.append(
-                            IOBoundPool.submit(
-                                self._process_object,
-                                bucket_name,
-                                client,
-                                datasource,
-                                item,
-                                metadata,
-                            )
+
+                    # List each sub prefix in parallel, objects directly under the prefix are listed here
+                    sub_prefixes = self._list_objects(
+                        client,
+                        datasource,
+                        metadata,
+                        work_queue,
+                        bucket_name,
+                        prefix,
+                        delimiter="/",
+                    )
+                    futures = [
+                        IOBoundPool.submit(
+                            self._list_objects,
+                            client,
+                            datasource,
+                            metadata,
+                            work_queue,
+                            bucket_name,
+                            sub_prefix,
                         )
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except:
-                    _LOG.warning(future.exception())
+                        for sub_prefix in sub_prefixes
+                    ]
+                    for future in futures:
+                        future.result()
+            finally:
+                work_queue.shutdown(wait=True)
 
         except:
+            self._partial_listing()
             _LOG.warning("Error fetching and updating documents", exc_info=True)
 
+    def _list_objects(
+        self,
+        client,
+        datasource: Datasource,
+        metadata: dict,
+        work_queue,
+        bucket_name: str,
+        prefix: str,
+        delimiter: str = None,
+    ) -> List[str]:
+        """
+        List the objects under a prefix and queue them for processing. Undelimited listings are checkpointed with the
+        last key of the latest page whose objects have all been processed, so an interrupted run resumes after it.
+        Returns the common prefixes found when listing with a delimiter. If the run is told to stop, the listing
+        stops and the checkpoint is left for the next run to resume from.
+        """
+        checkpoint_key = f"{bucket_name}/{prefix}"
+        paginate_kwargs = {"Bucket": bucket_name, "Prefix": prefix}
+        if delimiter is not None:
+            paginate_kwargs["Delimiter"] = delimiter
+        else:
+            start_after = (self._checkpoint.get(checkpoint_key) or {}).get(
+                "start_after"
+            )
+            if start_after is not None:
+                _LOG.info(f"Resuming listing of {checkpoint_key} after {start_after}")
+                paginate_kwargs["StartAfter"] = start_after
+                # Objects before the checkpoint are not listed in this run
+                self._partial_listing()
+
+        paginator = client.get_paginator("list_objects_v2")
+        page_iterator = paginator.paginate(**paginate_kwargs)
+
+        common_prefixes = []
+        pending_pages = collections.deque()
+        for result in page_iterator:
+            if self._cancelled():
+                break
+            common_prefixes.extend(
+                common_prefix["Prefix"]
+                for common_prefix in result.get("CommonPrefixes") or []
+            )
+            contents = result.get("Contents") or []
+            # iterate through files
+            futures = [
+                self._submit(
+                    work_queue,
+                    self._process_object,
+                    bucket_name,
+                    client,
+                    datasource,
+                    item,
+                    metadata,
+                )
+                for item in contents
+                # Paths ending in / are folders so we skip them
+                if not item["Key"].endswith("/")
+            ]
+            if delimiter is None and len(contents) != 0:
+                pending_pages.append((futures, contents[-1]["Key"]))
+                self._advance_checkpoint(checkpoint_key, pending_pages)
+
+        if delimiter is None:
+            for futures, _ in pending_pages:
+                concurrent.futures.wait(futures)
+            if self._cancelled():
+                self._advance_checkpoint(checkpoint_key, pending_pages)
+            else:
+                self._checkpoint.remove(checkpoint_key)
+
+        return common_prefixes
+
+    def _advance_checkpoint(self, checkpoint_key: str, pending_pages) -> None:
+        start_after = None
+        # Objects that were not processed because the run stopped hold the checkpoint back
+        while pending_pages and all(
+            future.done() and not isinstance(future.exception(), TaskCancelled)
+            for future in pending_pages[0][0]
+        ):
+            _, start_after = pending_pages.popleft()
+        if start_after is not None:
+            self._checkpoint.put(checkpoint_key, {"start_after": start_after})
+
     def _process_object(self, bucket_name, client, datasource, item, metadata):
         connection = datasource.connection
         endpoint = connection["endpoint"]
@@ -151,24 +271,36 @@ class Processor(DocumentProcessor):
             "file_name": f"{bucket_name}/{item['Key']}",
             "self_link": self_link,
         }
+        if not self._listed(self_link):
+            # The object belongs to another replica's shard
+            return
+
+        if self.is_unchanged(
+            self_link=self_link,
+            last_modified=item["LastModified"],
+            store_metadata={"size": item["Size"], "etag": item.get("ETag")},
+        ):
+            _LOG.debug(
+                f"Skipping unchanged object {item['Key']} in bucket {bucket_name}"
+            )
+            return
+
         """
                             We use memcache's add functionality to implement a shared lock to allow for multiple instances
                             operating 
                             """
-        _lock_key = clean_control(f"{__name__}/locks/{self_link}")
-        if self._cache_client.add(key=_lock_key, val=_lock_key, time=30 * 60):
-            try:
-                self._sync_document(
-                    client=client,
-                    datasource=datasource,
-                    metadata=_metadata,
-                    bucket_name=bucket_name,
-                    item=item,
-                )
-            finally:
-                self._cache_client.delete(_lock_key)
-        else:
-            _LOG.info(f"Document {self_link} is already processing")
+        with self._lock(self_link) as lease:
+            if lease is None:
+                _LOG.info(f"Document {self_link} is already processing")
+                return
+            self._sync_document(
+                client=client,
+                datasource=datasource,
+                metadata=_metadata,
+                bucket_name=bucket_name,
+                item=item,
+                lease=lease,
+            )
 
     def _sync_document(
         self,
@@ -177,45 +309,43 @@ class Processor(DocumentProcessor):
         metadata: dict,
         bucket_name: str,
         item,
+        lease=None,
     ):
         endpoint = datasource.connection["endpoint"]
         _metadata = metadata
 
-        with tempfile.NamedTemporaryFile(
-            dir=tempfile.gettempdir(),
-        ) as tmp:
-            key_parts = item["Key"].split("/")
+        try:
+            _LOG.info(f"Starting syncing object {item['Key']} in bucket {bucket_name}")
 
-            path_to_tmp = f"{str(pathlib.Path(tmp.name).absolute())}-{key_parts[-1]}"
+            def file_stream():
+                # The object body is piped straight into the upload so no temporary file is written
+                return client.get_object(Bucket=bucket_name, Key=item["Key"])["Body"]
 
-            try:
-                _LOG.info(
-                    f"Starting syncing object {item['Key']} in bucket {bucket_name}"
-                )
-                # Write item to file
-                client.download_file(bucket_name, item["Key"], path_to_tmp)
-                self.sync(
-                    endpoint,
-                    path_to_tmp,
-                    last_modified=item["LastModified"],
-                    metadata=metadata,
-                    store_metadata={
-                        "bucket_name": bucket_name,
-                        "object_name": item["Key"],
-                        "filename": item["Key"],
-                        "size": item["Size"],
-                        "last_modified": item["LastModified"].strftime(
-                            DEFAULT_DATETIME_FORMAT
-                        ),
-                    },
-                )
+            self.sync(
+                endpoint,
+                item["Key"],
+                last_modified=item["LastModified"],
+                metadata=metadata,
+                store_metadata={
+                    "bucket_name": bucket_name,
+                    "object_name": item["Key"],
+                    "filename": item["Key"],
+                    "size": item["Size"],
+                    "etag": item.get("ETag"),
+                    "last_modified": item["LastModified"].strftime(
+                        DEFAULT_DATETIME_FORMAT
+                    ),
+                },
+                file_stream=file_stream,
+                lease=lease,
+            )
 
-                _LOG.info(f"Done syncing object {item['Key']} in bucket {bucket_name}")
-            except:
-                _LOG.warning(
-                    f"Error when getting and ingesting document {item['Key']}",
-                    exc_info=True,
-                )
+            _LOG.info(f"Done syncing object {item['Key']} in bucket {bucket_name}")
+        except:
+            _LOG.warning(
+                f"Error when getting and ingesting document {item['Key']}",
+                exc_info=True,
+            )
 
     def _unsync_documents(self, client) -> None:
         def clean(**kwargs):
@@ -240,7 +370,15 @@ class Processor(DocumentProcessor):
 
 
 def validate_connection_info(connection: Dict[str, Any]) -> Dict[str, Any]:
-    _valid_keys = ["endpoint", "user", "password", "region", "dataobjects"]
+    _valid_keys = [
+        "endpoint",
+        "user",
+        "password",
+        "region",
+        "dataobjects",
+        "max_in_flight",
+        "split_prefixes",
+    ]
     assert not isblank(connection.get("region")), "A valid region must be supplied"
     assert not isblank(
         connection.get("dataobjects")
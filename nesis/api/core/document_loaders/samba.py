@@ -1,7 +1,8 @@
 import logging
 import pathlib
+import shutil as local_shutil
+import threading
 import uuid
-from concurrent.futures import as_completed
 from datetime import datetime
 from typing import Dict, Any
 
@@ -9,11 +10,17 @@ import memcache
 import smbprotocol
 from smbclient import scandir, stat, shutil
 
+from nesis.api.core.document_loaders.cancellation import TaskCancellation
 from nesis.api.core.document_loaders.loader_helper import DocumentProcessor
+from nesis.api.core.document_loaders.progress import TaskProgress
 from nesis.api.core.models.entities import Datasource
-from nesis.api.core.util import http, clean_control, isblank
+from nesis.api.core.util import http, isblank
 from nesis.api.core.util.concurrency import IOBoundPool
-from nesis.api.core.util.constants import DEFAULT_DATETIME_FORMAT, DEFAULT_SAMBA_PORT
+from nesis.api.core.util.constants import (
+    DEFAULT_DATETIME_FORMAT,
+    DEFAULT_SAMBA_PORT,
+    DEFAULT_SAMBA_MAX_TRANSFERS,
+)
 
 _LOG = logging.getLogger(__name__)
 
@@ -25,8 +32,19 @@ class Processor(DocumentProcessor):
         http_client: http.HttpClient,
         cache_client: memcache.Client,
         datasource: Datasource,
+        progress: TaskProgress = None,
+        priority: int = 0,
+        cancellation: TaskCancellation = None,
     ):
-        super().__init__(config, http_client, datasource)
+        super().__init__(
+            config,
+            http_client,
+            datasource,
+            cache_client=cache_client,
+            progress=progress,
+            priority=priority,
+            cancellation=cancellation,
+        )
         self._config = config
         self._http_client = http_client
         self._cache_client = cache_client
@@ -40,6 +58,7 @@ class Processor(DocumentProcessor):
                 metadata=metadata,
             )
         except:
+            self._partial_listing()
             _LOG.exception(f"Error syncing documents")
 
         try:
@@ -48,12 +67,8 @@ class Processor(DocumentProcessor):
             )
         except:
             _LOG.exception(f"Error unsyncing documents")
-
-        for future in as_completed(self._futures):
-            try:
-                future.result()
-            except:
-                _LOG.warning(future.exception())
+        finally:
+            self.flush()
 
     def _sync_samba_documents(self, metadata):
 
@@ -81,122 +96,192 @@ class Processor(DocumentProcessor):
         work_dir = f"/tmp/{uuid.uuid4()}"
         pathlib.Path(work_dir).mkdir(parents=True)
 
-        for file_share in file_shares:
-            if (
-                len(dataobjects_parts) > 0
-                and file_share.is_dir()
-                and file_share.name not in dataobjects_parts
-            ):
-                continue
-            try:
+        work_queue = self._work_queue()
+        # Bounds the number of concurrent copies over the connection to the samba server
+        transfers = threading.BoundedSemaphore(
+            int(connection.get("max_transfers") or DEFAULT_SAMBA_MAX_TRANSFERS)
+        )
+        self._begin_listing()
+
+        try:
+            for file_share in file_shares:
+                if self._cancelled():
+                    break
+                if (
+                    len(dataobjects_parts) > 0
+                    and file_share.is_dir()
+                    and file_share.name not in dataobjects_parts
+                ):
+                    continue
 
                 _metadata = {
                     **(metadata or {}),
                     "file_name": file_share.path,
                 }
+                self._walk(
+                    connection=connection,
+                    file_share=file_share,
+                    work_dir=work_dir,
+                    work_queue=work_queue,
+                    transfers=transfers,
+                    metadata=_metadata,
+                )
 
+            # Directory scans add the scans of their subdirectories before they complete so once the list is
+            # drained, the whole tree has been walked
+            while self._futures:
+                future = self._futures.pop()
+                try:
+                    future.result()
+                except:
+                    self._partial_listing()
+                    _LOG.warning(
+                        "Error walking shared directory",
+                        exc_info=True,
+                    )
+        finally:
+            work_queue.shutdown(wait=True)
+            local_shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _walk(
+        self, connection, file_share, work_dir, work_queue, transfers, metadata
+    ) -> None:
+        """
+        Directories are scanned as separate tasks on the IOBoundPool so a deep folder does not hold up the rest of
+        the share. Files are queued on the work queue.
+        """
+        if file_share.is_dir():
+            if not file_share.name.startswith("."):
                 self._futures.append(
                     IOBoundPool.submit(
-                        self._process_file,
+                        self._walk_directory,
                         connection=connection,
-                        file_share=file_share,
+                        directory=file_share,
                         work_dir=work_dir,
-                        metadata=_metadata,
+                        work_queue=work_queue,
+                        transfers=transfers,
+                        metadata=metadata,
                     )
                 )
+            return
 
-            except:
-                _LOG.warning(
-                    f"Error fetching and updating documents from shared_file share {file_share.path} - ",
-                    exc_info=True,
-                )
+        self._submit(
+            work_queue,
+            self._process_file,
+            connection=connection,
+            file_share=file_share,
+            work_dir=work_dir,
+            transfers=transfers,
+            metadata=metadata,
+        )
 
-    def _process_file(self, connection, file_share, work_dir, metadata):
+    def _walk_directory(
+        self, connection, directory, work_dir, work_queue, transfers, metadata
+    ) -> None:
+        dir_files = scandir(
+            directory.path,
+            username=connection["user"],
+            password=connection["password"],
+            port=connection["port"],
+        )
+        for dir_file in dir_files:
+            if self._cancelled():
+                break
+            self._walk(
+                connection=connection,
+                file_share=dir_file,
+                work_dir=work_dir,
+                work_queue=work_queue,
+                transfers=transfers,
+                metadata=metadata,
+            )
+
+    def _process_file(self, connection, file_share, work_dir, transfers, metadata):
         username = connection["user"]
         password = connection["password"]
         endpoint = connection["endpoint"]
         port = connection["port"]
 
-        if file_share.is_dir():
-            if not file_share.name.startswith("."):
-                dir_files = scandir(
-                    file_share.path, username=username, password=password, port=port
-                )
-                for dir_file in dir_files:
-                    self._process_file(
-                        connection=connection,
-                        file_share=dir_file,
-                        work_dir=work_dir,
-                        metadata=metadata,
-                    )
+        file_name = file_share.name
+        self_link = file_share.path
+        if not self._listed(self_link):
+            # The object belongs to another replica's shard
             return
 
-        file_name = file_share.name
-        file_stats = stat(
-            file_share.path, username=username, password=password, port=port
-        )
+        # The directory listing already carries the file attributes, so this does not go back to the server
+        file_stats = file_share.stat()
         last_change_datetime = datetime.fromtimestamp(file_stats.st_chgtime)
 
-        try:
-            file_path = f"{work_dir}/{file_share.name}"
-            file_unique_id = f"{uuid.uuid5(uuid.NAMESPACE_DNS, file_share.path)}"
+        if self.is_unchanged(
+            self_link=self_link,
+            last_modified=last_change_datetime,
+            store_metadata={"size": file_stats.st_size},
+        ):
+            _LOG.debug(f"Skipping unchanged shared_file {file_share.path}")
+            return
 
-            _LOG.info(
-                f"Starting syncing shared_file {file_name} in shared directory share {file_share.path}"
-            )
+        with self._lock(self_link) as lease:
+            if lease is None:
+                _LOG.info(f"Document {self_link} is already processing")
+                return
 
+            file_unique_id = f"{uuid.uuid5(uuid.NAMESPACE_DNS, file_share.path)}"
+            # Files of the same name in different folders are copied concurrently so each gets its own folder
+            file_dir = pathlib.Path(f"{work_dir}/{file_unique_id}")
             try:
-                shutil.copyfile(
-                    file_share.path,
-                    file_path,
-                    username=username,
-                    password=password,
-                    port=port,
-                )
-                self_link = file_share.path
-                _lock_key = clean_control(f"{__name__}/locks/{self_link}")
+                file_dir.mkdir(parents=True, exist_ok=True)
+                file_path = f"{file_dir}/{file_share.name}"
 
-                metadata["self_link"] = self_link
+                _LOG.info(
+                    f"Starting syncing shared_file {file_name} in shared directory share {file_share.path}"
+                )
 
-                if self._cache_client.add(key=_lock_key, val=_lock_key, time=30 * 60):
-                    try:
-                        self.sync(
-                            endpoint,
+                try:
+                    with transfers, self._progress.stage("download"):
+                        shutil.copyfile(
+                            file_share.path,
                             file_path,
-                            last_modified=last_change_datetime,
-                            metadata=metadata,
-                            store_metadata={
-                                "shared_folder": file_share.name,
-                                "file_path": file_share.path,
-                                "filename": file_share.path,
-                                "file_id": file_unique_id,
-                                "size": file_stats.st_size,
-                                "name": file_name,
-                                "last_modified": last_change_datetime.strftime(
-                                    DEFAULT_DATETIME_FORMAT
-                                ),
-                            },
+                            username=username,
+                            password=password,
+                            port=port,
                         )
-                    finally:
-                        self._cache_client.delete(_lock_key)
-                else:
-                    _LOG.info(f"Document {self_link} is already processing")
+                except:
+                    _LOG.warning(
+                        f"Failed to copy contents of shared_file {file_name} from shared location {file_share.path}",
+                        exc_info=True,
+                    )
+                    self._progress.add("failed")
+                    return
+
+                self.sync(
+                    endpoint,
+                    file_path,
+                    last_modified=last_change_datetime,
+                    metadata={**metadata, "self_link": self_link},
+                    store_metadata={
+                        "shared_folder": file_share.name,
+                        "file_path": file_share.path,
+                        "filename": file_share.path,
+                        "file_id": file_unique_id,
+                        "size": file_stats.st_size,
+                        "name": file_name,
+                        "last_modified": last_change_datetime.strftime(
+                            DEFAULT_DATETIME_FORMAT
+                        ),
+                    },
+                    lease=lease,
+                )
 
-            except:
+                _LOG.info(
+                    f"Done syncing shared_file {file_name} in location {file_share.path}"
+                )
+            except Exception as ex:
                 _LOG.warning(
-                    f"Failed to copy contents of shared_file {file_name} from shared location {file_share.path}",
+                    f"Error when getting and ingesting shared_file {file_name} - {ex}",
                     exc_info=True,
                 )
-                return
-
-            _LOG.info(
-                f"Done syncing shared_file {file_name} in location {file_share.path}"
-            )
-        except Exception as ex:
-            _LOG.warn(
-                f"Error when getting and ingesting shared_file {file_name} - {ex}",
-                exc_info=True,
-            )
+            finally:
+                local_shutil.rmtree(file_dir, ignore_errors=True)
 
     def _unsync_samba_documents(self, connection):
         username = connection["user"]
@@ -231,7 +316,15 @@ def _connect_samba_server(connection):
 
 def validate_connection_info(connection: Dict[str, Any]) -> Dict[str, Any]:
     port = connection.get("port") or DEFAULT_SAMBA_PORT
-    _valid_keys = ["port", "endpoint", "user", "password", "dataobjects"]
+    _valid_keys = [
+        "port",
+        "endpoint",
+        "user",
+        "password",
+        "dataobjects",
+        "max_in_flight",
+        "max_transfers",
+    ]
     if not str(port).isnumeric():
         raise ValueError("Port value cannot be non numeric")
 
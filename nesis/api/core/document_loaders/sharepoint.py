@@ -1,5 +1,9 @@
+import collections
+import concurrent.futures
 import json
 import pathlib
+import threading
+import time
 import uuid
 import tempfile
 from typing import Dict, Any
@@ -9,9 +13,15 @@ import memcache
 
 from office365.sharepoint.client_context import ClientContext
 from office365.runtime.client_request_exception import ClientRequestException
+from office365.sharepoint.changes.query import ChangeQuery
+from office365.sharepoint.changes.token import ChangeToken
+from office365.sharepoint.changes.type import ChangeType
 
+from nesis.api.core.document_loaders.cancellation import TaskCancellation
+from nesis.api.core.document_loaders.checkpoint import TaskCheckpoint
 from nesis.api.core.document_loaders.loader_helper import DocumentProcessor
-from nesis.api.core.util import http, clean_control, isblank
+from nesis.api.core.document_loaders.progress import TaskProgress
+from nesis.api.core.util import http, isblank
 import logging
 from nesis.api.core.models.entities import Document, Datasource
 from nesis.api.core.services.util import (
@@ -28,6 +38,10 @@ from nesis.api.core.util.dateutil import strptime
 
 _LOG = logging.getLogger(__name__)
 
+_CHANGE_TOKEN_KEY = "change_token"
+# Incremental syncs fall back to a full listing at least this often, in seconds, to reconcile missed changes
+_RECONCILIATION_INTERVAL = 24 * 60 * 60
+
 
 class Processor(DocumentProcessor):
     def __init__(
@@ -36,37 +50,78 @@ class Processor(DocumentProcessor):
         http_client: http.HttpClient,
         cache_client: memcache.Client,
         datasource: Datasource,
+        checkpoint: TaskCheckpoint = None,
+        progress: TaskProgress = None,
+        priority: int = 0,
+        cancellation: TaskCancellation = None,
     ):
-        super().__init__(config, http_client, datasource)
+        super().__init__(
+            config,
+            http_client,
+            datasource,
+            cache_client=cache_client,
+            progress=progress,
+            priority=priority,
+            cancellation=cancellation,
+        )
         self._config = config
         self._http_client = http_client
         self._cache_client = cache_client
         self._datasource = datasource
+        self._checkpoint = checkpoint or TaskCheckpoint()
         self._futures = []
+        self._cert_path = None
+        self._thread_context = threading.local()
+        self._reconciliation_interval = float(
+            ((config.get("tasks") or {}).get("reconciliation") or {}).get("interval")
+            or _RECONCILIATION_INTERVAL
+        )
 
     def run(self, metadata: Dict[str, Any]):
 
         try:
 
             connection = self._datasource.connection
-            site_url = connection.get("endpoint")
-            client_id = connection.get("client_id")
-            tenant = connection.get("tenant_id")
-            thumbprint = connection.get("thumbprint")
 
             with tempfile.NamedTemporaryFile(dir=tempfile.gettempdir()) as tmp:
                 cert_path = (
                     f"{str(pathlib.Path(tmp.name).absolute())}-{uuid.uuid4()}.key"
                 )
                 pathlib.Path(cert_path).write_text(connection["certificate"])
-
-                _sharepoint_context = ClientContext(site_url).with_client_certificate(
-                    tenant=tenant,
-                    client_id=client_id,
-                    thumbprint=thumbprint,
-                    cert_path=cert_path,
-                )
-
+                self._cert_path = cert_path
+
+                _sharepoint_context = self._create_context()
+                library = _sharepoint_context.web.default_document_library()
+
+                change_checkpoint = self._checkpoint.get(_CHANGE_TOKEN_KEY) or {}
+                change_token = change_checkpoint.get("token")
+                if change_token is not None and not self._reconciliation_due(
+                    change_checkpoint
+                ):
+                    try:
+                        # The token only advances past the changes that were processed, so a stopped run or a
+                        # failed change is replayed by the next run
+                        change_token = self._sync_sharepoint_changes(
+                            library=library,
+                            change_token=change_token,
+                            metadata=metadata,
+                        )
+                        self._checkpoint.put(
+                            _CHANGE_TOKEN_KEY,
+                            {**change_checkpoint, "token": change_token},
+                        )
+                        return
+                    except:
+                        _LOG.warning(
+                            "Error fetching sharepoint changes, falling back to a full sync",
+                            exc_info=True,
+                        )
+
+                # Changes made while we list the library are picked up by the next incremental sync
+                library.get().select(["CurrentChangeToken"]).execute_query()
+                change_token = library.current_change_token.StringValue
+
+                self._begin_listing()
                 self._sync_sharepoint_documents(
                     sp_context=_sharepoint_context,
                     metadata=metadata,
@@ -74,8 +129,161 @@ class Processor(DocumentProcessor):
                 self._unsync_sharepoint_documents(
                     sp_context=_sharepoint_context,
                 )
+                if self._listing_complete and change_token is not None:
+                    self._checkpoint.put(
+                        _CHANGE_TOKEN_KEY,
+                        {"token": change_token, "listed_at": time.time()},
+                    )
         except Exception as ex:
             _LOG.exception(f"Error fetching sharepoint documents - {ex}")
+        finally:
+            self.flush()
+
+    def _reconciliation_due(self, change_checkpoint: Dict[str, Any]) -> bool:
+        """
+        Whether the library is due a full listing. Change logs can miss changes, for example when they are
+        trimmed before we read them, so incremental syncs are reconciled with a full listing every interval.
+        """
+        listed_at = change_checkpoint.get("listed_at")
+        return (
+            listed_at is None
+            or time.time() - listed_at >= self._reconciliation_interval
+        )
+
+    def _create_context(self) -> ClientContext:
+        connection = self._datasource.connection
+        return ClientContext(connection.get("endpoint")).with_client_certificate(
+            tenant=connection.get("tenant_id"),
+            client_id=connection.get("client_id"),
+            thumbprint=connection.get("thumbprint"),
+            cert_path=self._cert_path,
+        )
+
+    def _context(self) -> ClientContext:
+        """
+        The client context queues up requests, so it is not safe to share between threads. Each download worker
+        gets its own.
+        """
+        sp_context = getattr(self._thread_context, "sp_context", None)
+        if sp_context is None:
+            sp_context = self._create_context()
+            self._thread_context.sp_context = sp_context
+        return sp_context
+
+    def _sync_sharepoint_changes(self, library, change_token: str, metadata) -> str:
+        """
+        Sync only the items that changed in the document library since the change token. Returns the token of the
+        last change seen.
+        """
+        connection = self._datasource.connection
+        sharepoint_folders = connection.get("dataobjects") or ""
+
+        root_folder = library.root_folder.get().execute_query()
+        folder_urls = [
+            f"{root_folder.serverRelativeUrl.rstrip('/')}/{folder_name.strip().strip('/')}/"
+            for folder_name in sharepoint_folders.split(",")
+        ]
+
+        # The changes seen, in order, with the future of their work
+        pending = collections.deque()
+        processed_token = change_token
+        work_queue = self._work_queue()
+        try:
+            while not self._cancelled():
+                changes = library.get_changes(
+                    ChangeQuery(
+                        item=True,
+                        change_token_start=ChangeToken(change_token),
+                    )
+                ).execute_query()
+                if len(changes) == 0:
+                    break
+
+                for change in changes:
+                    if self._cancelled():
+                        break
+                    future = self._sync_sharepoint_change(
+                        library=library,
+                        change=change,
+                        folder_urls=folder_urls,
+                        work_queue=work_queue,
+                        metadata=metadata,
+                    )
+                    change_token = change.change_token.StringValue
+                    pending.append((future, change_token))
+                    processed_token = self._processed_until(pending, processed_token)
+        finally:
+            work_queue.shutdown(wait=True)
+
+        return self._processed_until(pending, processed_token)
+
+    @staticmethod
+    def _processed_until(pending, change_token):
+        """
+        Drop the changes at the head of pending whose work completed, returning the token of the last one. A change
+        that failed, or was not processed because the run stopped, holds the head back.
+        """
+        while pending and pending[0][0].done():
+            future, token = pending[0]
+            if future.exception() is not None or future.result() is False:
+                break
+            pending.popleft()
+            change_token = token
+        return change_token
+
+    def _sync_sharepoint_change(
+        self, library, change, folder_urls, work_queue, metadata
+    ) -> concurrent.futures.Future:
+        """
+        Sync the item of a change. Returns the future of the work, which fails, or results in False, if the change
+        was not processed.
+        """
+        unique_id = change.properties.get("UniqueId")
+        future = concurrent.futures.Future()
+        try:
+            match change.change_type:
+                case ChangeType.DeleteObject | ChangeType.MoveAway:
+                    self._remove_sharepoint_item(unique_id=unique_id)
+                case (
+                    ChangeType.Add
+                    | ChangeType.Update
+                    | ChangeType.SystemUpdate
+                    | ChangeType.Rename
+                    | ChangeType.MoveInto
+                    | ChangeType.Restore
+                ):
+                    file = (
+                        library.get_item_by_id(change.properties["ItemId"])
+                        .file.get()
+                        .execute_query()
+                    )
+                    # A renamed or moved file gets a new self link so the document under the old one goes
+                    self._remove_sharepoint_item(
+                        unique_id=unique_id, file_url=file.serverRelativeUrl
+                    )
+                    if any(
+                        file.serverRelativeUrl.startswith(folder_url)
+                        for folder_url in folder_urls
+                    ):
+                        return self._submit(
+                            work_queue,
+                            self._process_file,
+                            file=file,
+                            metadata=metadata,
+                        )
+            future.set_result(None)
+        except Exception as ex:
+            _LOG.warning(
+                f"Error processing change to sharepoint item {unique_id}",
+                exc_info=True,
+            )
+            future.set_exception(ex)
+        return future
+
+    def _remove_sharepoint_item(self, unique_id: str, file_url: str = None) -> None:
+        for document in self._documents.lookup("etag", unique_id):
+            if (document.store_metadata or {}).get("file_url") != file_url:
+                self.remove_document(document_id=document.uuid)
 
     def _sync_sharepoint_documents(self, sp_context, metadata):
         try:
@@ -94,32 +302,44 @@ class Processor(DocumentProcessor):
             sp_folders = sharepoint_folders.split(",")
 
             root_folder = sp_context.web.default_document_library().root_folder
+            work_queue = self._work_queue()
 
-            for folder_name in sp_folders:
-                sharepoint_folder = root_folder.folders.get_by_path(folder_name)
-
-                if sharepoint_folder is None:
-                    _LOG.warning(
-                        f"Cannot retrieve Sharepoint folder {sharepoint_folder} proceeding to process other folders"
-                    )
-                    continue
-
-                self._process_folder_files(
-                    sharepoint_folder,
-                    metadata=metadata,
-                )
+            try:
+                for folder_name in sp_folders:
+                    if self._cancelled():
+                        break
+                    sharepoint_folder = root_folder.folders.get_by_path(folder_name)
+
+                    if sharepoint_folder is None:
+                        _LOG.warning(
+                            f"Cannot retrieve Sharepoint folder {sharepoint_folder} proceeding to process other folders"
+                        )
+                        self._partial_listing()
+                        continue
 
-                # Recursively get all the child folders
-                _child_folders_recursive = sharepoint_folder.get_folders(
-                    True
-                ).execute_query()
-                for _child_folder in _child_folders_recursive:
                     self._process_folder_files(
-                        _child_folder,
+                        sharepoint_folder,
+                        work_queue=work_queue,
                         metadata=metadata,
                     )
 
+                    # Recursively get all the child folders
+                    _child_folders_recursive = sharepoint_folder.get_folders(
+                        True
+                    ).execute_query()
+                    for _child_folder in _child_folders_recursive:
+                        if self._cancelled():
+                            break
+                        self._process_folder_files(
+                            _child_folder,
+                            work_queue=work_queue,
+                            metadata=metadata,
+                        )
+            finally:
+                work_queue.shutdown(wait=True)
+
         except Exception as file_ex:
+            self._partial_listing()
             _LOG.exception(
                 f"Error fetching and updating documents - Error: {file_ex}",
                 exc_info=True,
@@ -140,28 +360,25 @@ class Processor(DocumentProcessor):
             "file_name": file.name,
             "self_link": self_link,
         }
+        if not self._listed(self_link):
+            # The object belongs to another replica's shard
+            return
 
-        """
-        We use memcache's add functionality to implement a shared lock to allow for multiple instances
-        operating 
-        """
-        _lock_key = clean_control(f"{__name__}/locks/{self_link}")
-        if self._cache_client.add(key=_lock_key, val=_lock_key, time=30 * 60):
-            try:
-                self._sync_document(
-                    metadata=_metadata,
-                    file=file,
-                )
-            finally:
-                self._cache_client.delete(_lock_key)
-        else:
-            _LOG.info(f"Document {self_link} is already processing")
+        with self._lock(self_link) as lease:
+            if lease is None:
+                _LOG.info(f"Document {self_link} is already processing")
+                return
+            return self._sync_document(metadata=_metadata, file=file, lease=lease)
 
-    def _process_folder_files(self, folder, metadata):
+    def _process_folder_files(self, folder, work_queue, metadata):
         # process files in folder
         _files = folder.get_files(False).execute_query()
         for file in _files:
-            self._process_file(
+            if self._cancelled():
+                break
+            self._submit(
+                work_queue,
+                self._process_file,
                 file=file,
                 metadata=metadata,
             )
@@ -170,7 +387,11 @@ class Processor(DocumentProcessor):
         self,
         metadata: dict,
         file,
-    ):
+        lease=None,
+    ) -> bool:
+        """
+        Download and sync a file. Returns False if that failed, the failure being logged and counted.
+        """
         connection = self._datasource.connection
         site_url = connection["endpoint"]
         _metadata = metadata
@@ -189,8 +410,13 @@ class Processor(DocumentProcessor):
                 # Write item to file
 
                 # How can we refine this for efficiency
-                with open(path_to_tmp, "wb") as local_file:
-                    file.download(local_file).execute_query()
+                with (
+                    open(path_to_tmp, "wb") as local_file,
+                    self._progress.stage("download"),
+                ):
+                    self._context().web.get_file_by_server_relative_url(
+                        file.serverRelativeUrl
+                    ).download(local_file).execute_query()
 
                 self.sync(
                     site_url,
@@ -207,11 +433,14 @@ class Processor(DocumentProcessor):
                             DEFAULT_DATETIME_FORMAT
                         ),
                     },
+                    lease=lease,
                 )
+                return True
             except:
                 _LOG.warning(
                     f"Error when getting and ingesting file {file.name}", exc_info=True
                 )
+                return False
 
     def _unsync_sharepoint_documents(self, sp_context):
 
@@ -244,6 +473,7 @@ def validate_connection_info(connection: Dict[str, Any]) -> Dict[str, Any]:
         "thumbprint",
         "certificate",
         "dataobjects",
+        "max_in_flight",
     ]
     assert not isblank(connection.get("endpoint")), "A site url must be supplied"
     assert not isblank(connection.get("client_id")), "A client_id must be supplied"
@@ -2,7 +2,10 @@ import json
 import logging
 import datetime as dt
 import os
+import threading
 import uuid
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
 
 import sqlalchemy as sa
 from sqlalchemy import (
@@ -16,6 +19,7 @@ from sqlalchemy import (
     Text,
     Enum,
 )
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session, declarative_base
 
@@ -23,6 +27,37 @@ from nesis.api.core.models import objects
 
 _LOG = logging.getLogger(__name__)
 
+_DEFAULT_BATCH_SIZE = 100
+_DEFAULT_LINGER = 1.0
+# The columns an upsert overwrites on an existing record, the others keep their values
+_UPSERT_COLUMNS = [
+    "base_uri",
+    "filename",
+    "extract_metadata",
+    "store_metadata",
+    "last_modified",
+    "last_processed",
+]
+
+
+class _StreamedRow(NamedTuple):
+    """
+    A buffered record in the row shape SqlDocumentStore.stream yields. It has no id until it is written.
+    """
+
+    id: Optional[int]
+    uuid: str
+    base_uri: str
+    filename: str
+    last_modified: dt.datetime
+    store_metadata: Optional[Dict[str, Any]]
+    extract_metadata: Optional[Dict[str, Any]]
+
+
+# SQL Server takes at most 2100 parameters per statement
+_MSSQL_MAX_PARAMETERS = 2000
+_DEFAULT_ROW_GROUP_SIZE = 10000
+
 
 class RagDocumentStore(object):
     def __init__(self, config, http_client):
@@ -51,8 +86,31 @@ class RagDocumentStore(object):
 
 class SqlDocumentStore(object):
 
-    def __init__(self, url, echo=False, pool_size=10):
+    def __init__(
+        self,
+        url,
+        echo=False,
+        pool_size=10,
+        batch_size=_DEFAULT_BATCH_SIZE,
+        linger=_DEFAULT_LINGER,
+    ):
+        """
+        Saved records are buffered and written in batches of up to batch_size records, one multi-row upsert per
+        batch, or linger seconds after the first record of a batch was saved. flush writes the buffered records
+        out. A batch_size of 1 writes every record as it is saved. The records of a batch that fails to write are
+        buffered again, unless saved again since, and retried with the next batch. Reads see the buffered records
+        over the written ones without flushing them.
+        """
         self._url = url
+        self._batch_size = max(int(batch_size or 1), 1)
+        self._linger = float(linger or 0)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # Keyed by (uuid, datasource_id), a file saved twice before a flush is only written once
+        self._pending: Dict[Tuple[str, str], dict] = {}
+        # Taken from _pending and being written, reads still see them until the write commits
+        self._writing: Dict[Tuple[str, str], dict] = {}
+        self._timer: Optional[threading.Timer] = None
         self._engine = sa.create_engine(
             self._url,
             echo=echo,
@@ -119,6 +177,10 @@ class SqlDocumentStore(object):
     def get(self, **kwargs):
         document_id = kwargs.get("document_id")
         base_uri = kwargs.get("base_uri")
+        buffered = self._buffered(
+            lambda record: (document_id is None or record["uuid"] == document_id)
+            and (base_uri is None or record["base_uri"] == base_uri)
+        )
         with Session(self._engine) as session:
             query = session.query(self.Store)
             if document_id is not None:
@@ -126,31 +188,555 @@ class SqlDocumentStore(object):
             if base_uri is not None:
                 query = query.filter(self.Store.base_uri == base_uri)
 
-            return query.all()
+            records = [
+                record
+                for record in query.all()
+                if (record.uuid, record.datasource_id) not in buffered
+            ]
+        return records + [self.Store(**record) for record in buffered.values()]
 
-    def save(self, **kwargs):
+    def stream(self, **kwargs) -> Iterator:
+        """
+        Stream the records of a datasource in a single query, as rows of id, uuid, base_uri, filename,
+        last_modified, store_metadata and extract_metadata. Records without a datasource_id are matched on their
+        base_uri. Buffered records are yielded after the written ones, with an id of None.
+        """
+        buffered = self._buffered(
+            lambda record: record["datasource_id"] == kwargs["datasource_id"]
+            or (
+                record["datasource_id"] is None
+                and record["base_uri"] == kwargs["base_uri"]
+            )
+        )
+        buffered_uuids = {record["uuid"] for record in buffered.values()}
         with Session(self._engine) as session:
-            session.expire_on_commit = False
-            store_record = self.Store()
+            query = (
+                session.query(
+                    self.Store.id,
+                    self.Store.uuid,
+                    self.Store.base_uri,
+                    self.Store.filename,
+                    self.Store.last_modified,
+                    self.Store.store_metadata,
+                    self.Store.extract_metadata,
+                )
+                .filter(
+                    sa.or_(
+                        self.Store.datasource_id == kwargs["datasource_id"],
+                        sa.and_(
+                            self.Store.datasource_id.is_(None),
+                            self.Store.base_uri == kwargs["base_uri"],
+                        ),
+                    )
+                )
+                .execution_options(yield_per=kwargs.get("yield_per") or 1000)
+            )
+            for row in query:
+                if row.uuid not in buffered_uuids:
+                    yield row
+        for record in buffered.values():
+            yield _StreamedRow(
+                id=None,
+                **{
+                    field: record[field]
+                    for field in _StreamedRow._fields
+                    if field != "id"
+                },
+            )
+
+    def _buffered(self, matches) -> Dict[Tuple[str, str], dict]:
+        """
+        The buffered records, pending or being written, that matches accepts, keyed by (uuid, datasource_id).
+        """
+        with self._lock:
+            return {
+                key: record
+                for key, record in {**self._writing, **self._pending}.items()
+                if matches(record)
+            }
+
+    def save(self, **kwargs):
+        record = {
+            "uuid": kwargs["document_id"],
+            "datasource_id": kwargs["datasource_id"],
+            "base_uri": kwargs["base_uri"],
+            "filename": kwargs["filename"],
+            "extract_metadata": kwargs["extract_metadata"],
+            "store_metadata": kwargs["store_metadata"],
+            "status": objects.DocumentStatus.PROCESSING,
+            "last_modified": kwargs["last_modified"],
+            "last_processed": dt.datetime.utcnow(),
+        }
+        with self._lock:
+            self._pending[(record["uuid"], record["datasource_id"])] = record
+            if len(self._pending) >= self._batch_size:
+                records = self._take()
+            else:
+                records = None
+                self._linger_later()
+        if records:
+            self._write(records)
+
+        return self.Store(**record)
+
+    def flush(self) -> None:
+        """
+        Write out the buffered records.
+        """
+        with self._lock:
+            records = self._take()
+        if records:
+            self._write(records)
 
-            store_record.uuid = kwargs["document_id"]
-            store_record.datasource_id = kwargs["datasource_id"]
-            store_record.extract_metadata = kwargs["extract_metadata"]
-            store_record.store_metadata = kwargs["store_metadata"]
-            store_record.last_modified = kwargs["last_modified"]
-            store_record.base_uri = kwargs["base_uri"]
-            store_record.rag_metadata = kwargs["rag_metadata"]
-            store_record.filename = kwargs["filename"]
+    def _flush_later(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            _LOG.warning("Failed to write extracted documents", exc_info=True)
 
-            session.add(store_record)
-            session.commit()
+    def _linger_later(self) -> None:
+        if self._timer is None and self._linger > 0 and self._pending:
+            self._timer = threading.Timer(self._linger, self._flush_later)
+            self._timer.daemon = True
+            self._timer.start()
 
-            return store_record
+    def _take(self) -> List[dict]:
+        records = list(self._pending.values())
+        self._writing.update(self._pending)
+        self._pending = {}
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return records
 
-    def delete(self, document_id):
+    def _write(self, records: List[dict]) -> None:
+        """
+        Upsert records, buffering them again when the write fails so that they are not lost with the batch.
+        """
+        try:
+            self._upsert(records)
+        except:
+            with self._lock:
+                for record in records:
+                    key = (record["uuid"], record["datasource_id"])
+                    if self._writing.get(key) is record:
+                        self._pending.setdefault(key, record)
+                self._linger_later()
+            raise
+        finally:
+            with self._lock:
+                for record in records:
+                    key = (record["uuid"], record["datasource_id"])
+                    if self._writing.get(key) is record:
+                        self._writing.pop(key)
+
+    def _upsert(self, records: List[dict]) -> None:
+        """
+        Upsert records on (uuid, datasource_id) in a single transaction, with the dialect's multi-row upsert.
+        Dialects without one get a delete of the existing records followed by a multi-row insert.
+        """
+        table = self.Store.__table__
+        with self._write_lock, self._engine.begin() as connection:
+            match self._engine.dialect.name:
+                case "postgresql" | "sqlite":
+                    insert = (
+                        postgresql.insert
+                        if self._engine.dialect.name == "postgresql"
+                        else sqlite.insert
+                    )
+                    statement = insert(table).values(records)
+                    connection.execute(
+                        statement.on_conflict_do_update(
+                            index_elements=[table.c.uuid, table.c.datasource_id],
+                            set_={
+                                column: statement.excluded[column]
+                                for column in _UPSERT_COLUMNS
+                            },
+                        )
+                    )
+                case "mysql" | "mariadb":
+                    statement = mysql.insert(table).values(records)
+                    connection.execute(
+                        statement.on_duplicate_key_update(
+                            {
+                                column: statement.inserted[column]
+                                for column in _UPSERT_COLUMNS
+                            }
+                        )
+                    )
+                case "mssql":
+                    max_records = _MSSQL_MAX_PARAMETERS // len(records[0])
+                    for idx in range(0, len(records), max_records):
+                        connection.execute(
+                            self._merge(records[idx : idx + max_records])
+                        )
+                case _:
+                    connection.execute(
+                        table.delete().where(
+                            sa.tuple_(table.c.uuid, table.c.datasource_id).in_(
+                                [
+                                    (record["uuid"], record["datasource_id"])
+                                    for record in records
+                                ]
+                            )
+                        )
+                    )
+                    connection.execute(table.insert(), records)
+        _LOG.debug(f"Wrote {len(records)} extracted documents")
+
+    def _merge(self, records: List[dict]) -> sa.TextClause:
+        """
+        A MERGE of records for SQL Server, which has no upsert construct in SQLAlchemy.
+        """
+        table = self.Store.__table__
+        columns = list(records[0].keys())
+        values = ", ".join(
+            f"({', '.join(f':{column}_{idx}' for column in columns)})"
+            for idx in range(len(records))
+        )
+        statement = (
+            f"MERGE INTO {table.name} WITH (HOLDLOCK) AS target "
+            f"USING (VALUES {values}) AS source ({', '.join(columns)}) "
+            "ON target.uuid = source.uuid AND target.datasource_id = source.datasource_id "
+            f"WHEN MATCHED THEN UPDATE SET {', '.join(f'{column} = source.{column}' for column in _UPSERT_COLUMNS)} "
+            f"WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) "
+            f"VALUES ({', '.join(f'source.{column}' for column in columns)});"
+        )
+        return sa.text(statement).bindparams(
+            *[
+                sa.bindparam(
+                    f"{column}_{idx}", value=record[column], type_=table.c[column].type
+                )
+                for idx, record in enumerate(records)
+                for column in columns
+            ]
+        )
+
+    def delete(self, document_id, **kwargs):
+        with self._lock:
+            for key in [key for key in self._pending if key[0] == document_id]:
+                self._pending.pop(key)
+            for key in [key for key in self._writing if key[0] == document_id]:
+                self._writing.pop(key)
         with Session(self._engine) as session:
             store_record = (
                 session.query(self.Store).filter(self.Store.uuid == document_id).first()
             )
-            session.delete(store_record)
-            session.commit()
+            if store_record is not None:
+                session.delete(store_record)
+                session.commit()
+
+
+class ExtractedRecord(NamedTuple):
+    """
+    The latest extraction of a file in a ParquetDocumentStore.
+    """
+
+    uuid: str
+    datasource_id: str
+    base_uri: str
+    filename: str
+    last_modified: dt.datetime
+    store_metadata: Optional[Dict[str, Any]]
+    extract_metadata: Optional[Dict[str, Any]]
+
+
+class ParquetDocumentStore(object):
+    """
+    Writes the elements extracted from each file as rows of Parquet files, on local disk or in an object store
+    (s3://, gs://, ...). The files are partitioned by datasource_id and extract_date, hive style, and each run
+    writes one part file per partition. Rows are buffered per partition and appended as a row group every
+    row_group_size rows; flush writes the remaining rows and closes the files.
+
+    The files are append only. Re-extracting a file appends its new elements and removing it appends a tombstone
+    row with deleted set, so the current elements of a file are the rows of its latest extracted_at, unless deleted.
+    Every extraction writes a first row, with element_index 0 or, for a file without elements or a tombstone, null,
+    which is what this store reads to track the files. Reads skip the part files this run still has open and see
+    the files it wrote since through the records it keeps in memory, so reading does not close the part files.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        row_group_size: int = _DEFAULT_ROW_GROUP_SIZE,
+        options: Optional[Dict[str, Any]] = None,
+    ):
+        try:
+            import pyarrow as pa
+            import pyarrow.dataset as ds
+            import pyarrow.fs as fs
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError(
+                "'pyarrow' is not installed. It is required for the parquet extraction destination."
+            ) from e
+        self._pa = pa
+        self._ds = ds
+        self._fs = fs
+        self._pq = pq
+
+        if urlparse(path).scheme == "s3" and options:
+            # Credentials, region and endpoint_override for S3 compatible stores
+            self._filesystem = fs.S3FileSystem(**options)
+            self._path = path[len("s3://") :].rstrip("/")
+        elif urlparse(path).scheme:
+            self._filesystem, self._path = fs.FileSystem.from_uri(path)
+        else:
+            self._filesystem = fs.LocalFileSystem()
+            self._path = os.path.abspath(path)
+        self._row_group_size = max(int(row_group_size or 1), 1)
+
+        self._schema = pa.schema(
+            [
+                ("document_id", pa.string()),
+                ("base_uri", pa.string()),
+                ("filename", pa.string()),
+                ("last_modified", pa.timestamp("us")),
+                ("extracted_at", pa.timestamp("us")),
+                ("store_metadata", pa.string()),
+                ("deleted", pa.bool_()),
+                ("element_index", pa.int32()),
+                ("element_id", pa.string()),
+                ("text", pa.string()),
+                ("metadata", pa.string()),
+            ]
+        )
+        self._partitioning = ds.partitioning(
+            pa.schema([("datasource_id", pa.string()), ("extract_date", pa.string())]),
+            flavor="hive",
+        )
+        self._lock = threading.Lock()
+        # Partition directory -> buffered rows, and the part file each partition is written to in this run
+        self._pending: Dict[str, List[dict]] = {}
+        self._writers: Dict[str, Any] = {}
+        self._open_files: set = set()
+        # The records written by this store since the last flush, and whether they were deleted, so they are seen
+        # before the files are closed
+        self._written: Dict[str, tuple] = {}
+        self._extracted_at = dt.datetime.min
+
+    def stream(self, **kwargs) -> Iterator:
+        """
+        The files of a datasource as rows of id, uuid, base_uri, filename, last_modified, store_metadata and
+        extract_metadata.
+        """
+        for record in self._records(datasource_id=kwargs["datasource_id"]):
+            yield (
+                None,
+                record.uuid,
+                record.base_uri,
+                record.filename,
+                record.last_modified,
+                record.store_metadata,
+                record.extract_metadata,
+            )
+
+    def get(self, **kwargs) -> List[ExtractedRecord]:
+        return list(
+            self._records(
+                document_id=kwargs.get("document_id"),
+                base_uri=kwargs.get("base_uri"),
+            )
+        )
+
+    def _records(
+        self,
+        document_id: Optional[str] = None,
+        base_uri: Optional[str] = None,
+        datasource_id: Optional[str] = None,
+    ) -> Iterator[ExtractedRecord]:
+        filters = {
+            "document_id": document_id,
+            "base_uri": base_uri,
+            "datasource_id": datasource_id,
+        }
+        expression = self._ds.field("element_index").is_null() | (
+            self._ds.field("element_index") == 0
+        )
+        for field, value in filters.items():
+            if value is not None:
+                expression = expression & (self._ds.field(field) == value)
+
+        with self._lock:
+            open_files = set(self._open_files)
+            written = dict(self._written)
+        files = [
+            info.path
+            for info in self._filesystem.get_file_info(
+                self._fs.FileSelector(self._path, recursive=True, allow_not_found=True)
+            )
+            if info.type == self._fs.FileType.File
+            and info.path.endswith(".parquet")
+            and info.path not in open_files
+        ]
+        rows = []
+        if files:
+            dataset = self._ds.dataset(
+                files,
+                schema=self._schema.append(
+                    self._pa.field("datasource_id", self._pa.string())
+                ).append(self._pa.field("extract_date", self._pa.string())),
+                format="parquet",
+                filesystem=self._filesystem,
+                partitioning=self._partitioning,
+                partition_base_dir=self._path,
+            )
+            rows = dataset.to_table(
+                columns=[
+                    "document_id",
+                    "datasource_id",
+                    "base_uri",
+                    "filename",
+                    "last_modified",
+                    "extracted_at",
+                    "store_metadata",
+                    "deleted",
+                ],
+                filter=expression,
+            ).to_pylist()
+
+        latest: Dict[str, dict] = {}
+        for row in rows:
+            current = latest.get(row["document_id"])
+            if current is None or row["extracted_at"] > current["extracted_at"]:
+                latest[row["document_id"]] = row
+        records: Dict[str, Optional[ExtractedRecord]] = {
+            row["document_id"]: (
+                None
+                if row["deleted"]
+                else ExtractedRecord(
+                    uuid=row["document_id"],
+                    datasource_id=row["datasource_id"],
+                    base_uri=row["base_uri"],
+                    filename=row["filename"],
+                    last_modified=row["last_modified"],
+                    store_metadata=json.loads(row["store_metadata"] or "null"),
+                    extract_metadata=None,
+                )
+            )
+            for row in latest.values()
+        }
+        # What this run wrote since the files were last closed is newer than anything read from them
+        for record, deleted in written.values():
+            if all(
+                value is None or getattr(record, field) == value
+                for field, value in (
+                    ("uuid", document_id),
+                    ("base_uri", base_uri),
+                    ("datasource_id", datasource_id),
+                )
+            ):
+                records[record.uuid] = None if deleted else record
+        for record in records.values():
+            if record is not None:
+                yield record
+
+    def save(self, **kwargs) -> ExtractedRecord:
+        record = ExtractedRecord(
+            uuid=kwargs["document_id"],
+            datasource_id=kwargs["datasource_id"],
+            base_uri=kwargs["base_uri"],
+            filename=kwargs["filename"],
+            last_modified=kwargs["last_modified"],
+            store_metadata=kwargs["store_metadata"],
+            extract_metadata=kwargs["extract_metadata"],
+        )
+        elements = (record.extract_metadata or {}).get("data")
+        if not isinstance(elements, list):
+            elements = []
+        rows = [
+            {
+                "element_index": idx,
+                "element_id": element.get("id_"),
+                "text": element.get("text"),
+                "metadata": json.dumps(element.get("metadata")),
+            }
+            for idx, element in enumerate(elements)
+        ] or [{}]
+        self._append(record, rows, deleted=False)
+        return record
+
+    def delete(self, document_id=None, record: ExtractedRecord = None) -> None:
+        """
+        Append a tombstone for a file. Callers holding the file's record pass it in to save looking it up.
+        """
+        if record is None:
+            record = next(iter(self.get(document_id=document_id)), None)
+        if record is None:
+            return
+        self._append(record, [{}], deleted=True)
+
+    def _append(self, record: ExtractedRecord, rows: List[dict], deleted: bool) -> None:
+        with self._lock:
+            # The latest extraction of a file wins so extracted_at must increase, even within a clock tick
+            extracted_at = max(
+                dt.datetime.utcnow(),
+                self._extracted_at + dt.timedelta(microseconds=1),
+            )
+            self._extracted_at = extracted_at
+        partition = "/".join(
+            [
+                self._path,
+                f"datasource_id={record.datasource_id}",
+                f"extract_date={extracted_at.strftime('%Y-%m-%d')}",
+            ]
+        )
+        rows = [
+            {
+                "document_id": record.uuid,
+                "base_uri": record.base_uri,
+                "filename": record.filename,
+                "last_modified": record.last_modified,
+                "extracted_at": extracted_at,
+                "store_metadata": json.dumps(record.store_metadata),
+                "deleted": deleted,
+                "element_index": None,
+                "element_id": None,
+                "text": None,
+                "metadata": None,
+                **row,
+            }
+            for row in rows
+        ]
+        with self._lock:
+            pending = self._pending.setdefault(partition, [])
+            pending.extend(rows)
+            # The elements are in the rows, reads of a record return no extract_metadata whether it was flushed or not
+            self._written[record.uuid] = (
+                record._replace(extract_metadata=None),
+                deleted,
+            )
+            if len(pending) >= self._row_group_size:
+                self._write(partition)
+
+    def flush(self) -> None:
+        """
+        Write out the buffered rows and close the part files so that they can be read.
+        """
+        with self._lock:
+            for partition in list(self._pending.keys()):
+                self._write(partition)
+            for writer in self._writers.values():
+                writer.close()
+            self._writers = {}
+            self._open_files = set()
+            self._written = {}
+
+    def _write(self, partition: str) -> None:
+        rows = self._pending.pop(partition, [])
+        if not rows:
+            return
+        writer = self._writers.get(partition)
+        if writer is None:
+            self._filesystem.create_dir(partition, recursive=True)
+            file_path = f"{partition}/part-{uuid.uuid4()}.parquet"
+            writer = self._pq.ParquetWriter(
+                file_path, self._schema, filesystem=self._filesystem
+            )
+            self._writers[partition] = writer
+            self._open_files.add(file_path)
+        writer.write_table(
+            self._pa.Table.from_pylist(rows, schema=self._schema),
+            row_group_size=len(rows),
+        )
+        _LOG.debug(f"Wrote {len(rows)} extracted elements to {partition}")
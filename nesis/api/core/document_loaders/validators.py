@@ -4,6 +4,7 @@ from nesis.api.core.document_loaders import samba
 from nesis.api.core.document_loaders import s3
 from nesis.api.core.document_loaders import minio
 from nesis.api.core.document_loaders import sharepoint
+from nesis.api.core.document_loaders.stores import ParquetDocumentStore
 from nesis.api.core.models.objects import DatasourceType
 
 
@@ -28,11 +29,16 @@ def validate_datasource_connection(datasource) -> dict:
     if connection is None:
         raise ValueError("Missing connection")
 
-    destination_url = ((connection.get("destination") or {}).get("sql") or {}).get(
-        "url"
-    )
+    destination = connection.get("destination") or {}
+    destination_url = (destination.get("sql") or {}).get("url")
+    destination_path = (destination.get("parquet") or {}).get("path")
     if mode == "extract":
-        if destination_url is None:
+        if destination_path is not None:
+            try:
+                ParquetDocumentStore(**destination["parquet"])
+            except Exception as ex:
+                raise ValueError(f"Invalid parquet destination - {ex}")
+        elif destination_url is None:
             raise ValueError("Missing url for destination target")
         else:
             try:
@@ -1,11 +1,9 @@
 #!/usr/bin/env python
 
 import argparse
-import json
 import os
 import sys
 
-import yaml
 from gevent.pywsgi import WSGIServer
 
 working_dir = os.path.dirname(os.path.dirname(__file__))
@@ -16,7 +14,6 @@ from nesis.api.core.models import initialize_engine
 from nesis.api.core.services import init_services as cloud_services
 from nesis.api.core.util.http import HttpClient
 import logging
-import nesis.api.core.util as util
 
 import nesis.api.core.config as settings
 
@@ -24,19 +21,7 @@ _LOG = logging.getLogger(__name__)
 
 
 def run_cloud(app, args, services):
-    config_file = args.config
-    # secrets_file = args.secrets
-    #
-    if config_file:
-        with open(config_file) as fh:
-            if config_file.endswith(".json"):
-                config = json.load(fh)
-            else:
-                config = yaml.load(fh, yaml.Loader)
-    else:
-        config = {}
-
-    config = util.merge(config, settings.default)
+    config = settings.load_config(args.config)
     service_config = config.get("server") or {}
 
     # Initialize database
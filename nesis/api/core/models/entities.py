@@ -12,6 +12,7 @@ from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy import (
     Column,
     BigInteger,
+    Integer,
     ForeignKey,
     Index,
     Boolean,
@@ -23,6 +24,7 @@ from sqlalchemy import (
     ForeignKeyConstraint,
     Text,
     JSON,
+    Sequence,
 )
 
 DEFAULT_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -405,6 +407,20 @@ class Task(Base):
     definition = Column(JSONB, nullable=False)
     enabled = Column(Boolean, default=True, nullable=False)
     status = Column(Enum(objects.TaskStatus, name="task_status"), nullable=False)
+    """
+    From 0 to 10. Queued runs of higher priority tasks are taken first and their files get a larger share of the
+    ingestion workers, see FairShareExecutor
+    """
+    priority = Column(Integer, default=0, nullable=False)
+    """
+    The most seconds a run may take. A run out of time stops between files and resumes from its checkpoint on the
+    next run, see TaskCancellation. Without one, the tasks.cancellation.time_budget setting applies.
+    """
+    time_budget = Column(Integer)
+    """
+    Progress saved by a running task so that an interrupted run resumes where it stopped
+    """
+    checkpoint = Column(JSONB)
     create_date = Column(DateTime, default=dt.datetime.utcnow, nullable=False)
     update_date = Column(DateTime, default=dt.datetime.utcnow, nullable=False)
 
@@ -424,6 +440,8 @@ class Task(Base):
         status: objects.TaskStatus = objects.TaskStatus.CREATED,
         create_date: dt.datetime = dt.datetime.utcnow(),
         parent_id: Optional[str] = None,
+        priority: int = 0,
+        time_budget: Optional[int] = None,
     ):
         self.uuid = str(uuid.uuid4())
         self.type = task_type
@@ -432,6 +450,8 @@ class Task(Base):
         self.definition = definition
         self.create_date = create_date
         self.parent_id = parent_id
+        self.priority = priority
+        self.time_budget = time_budget
 
     def to_dict(self, **kwargs):
         return {
@@ -440,6 +460,8 @@ class Task(Base):
             "schedule": self.schedule,
             "enabled": self.enabled,
             "status": self.status.name,
+            "priority": self.priority,
+            "time_budget": self.time_budget,
             "parent_id": self.parent_id,
             "definition": self.definition,
             "create_date": self.create_date.strftime(DEFAULT_DATETIME_FORMAT),
@@ -447,6 +469,132 @@ class Task(Base):
         }
 
 
+class TaskRun(Base):
+    """
+    A single run of a task with its progress. The counters and the time spent in each stage are updated as the
+    run goes, see TaskProgress.
+    """
+
+    __tablename__ = "task_run"
+    id = Column(BigInteger, primary_key=True, nullable=False)
+    uuid = Column(Unicode(255), unique=True, nullable=False)
+    task_id = Column(Unicode(255), nullable=False)
+    status = Column(Enum(objects.TaskStatus, name="task_status"), nullable=False)
+    listed = Column(BigInteger, default=0, nullable=False)
+    skipped = Column(BigInteger, default=0, nullable=False)
+    downloaded_bytes = Column(BigInteger, default=0, nullable=False)
+    uploaded = Column(BigInteger, default=0, nullable=False)
+    failed = Column(BigInteger, default=0, nullable=False)
+    deleted = Column(BigInteger, default=0, nullable=False)
+    """
+    Seconds spent in each stage of the run, summed over the workers
+    """
+    timings = Column(JSONB)
+    start_date = Column(DateTime, default=dt.datetime.utcnow, nullable=False)
+    end_date = Column(DateTime)
+    update_date = Column(DateTime, default=dt.datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ("task_id",), [Task.uuid], name="fk_task_run_task", ondelete="CASCADE"
+        ),
+        Index("idx_task_run_task_start", "task_id", "start_date"),
+    )
+
+    def __init__(
+        self,
+        task_id: str,
+        status: objects.TaskStatus = objects.TaskStatus.RUNNING,
+    ):
+        self.uuid = str(uuid.uuid4())
+        self.task_id = task_id
+        self.status = status
+        self.listed = 0
+        self.skipped = 0
+        self.downloaded_bytes = 0
+        self.uploaded = 0
+        self.failed = 0
+        self.deleted = 0
+        self.timings = {}
+
+    def docs_per_second(self) -> float:
+        """
+        The files processed, whether uploaded, skipped or failed, per second of the run so far
+        """
+        end_date = self.end_date or dt.datetime.utcnow()
+        elapsed = (end_date - self.start_date).total_seconds()
+        processed = self.uploaded + self.skipped + self.failed
+        return processed / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self, **kwargs):
+        return {
+            "id": self.uuid,
+            "task_id": self.task_id,
+            "status": self.status.name,
+            "listed": self.listed,
+            "skipped": self.skipped,
+            "downloaded_bytes": self.downloaded_bytes,
+            "uploaded": self.uploaded,
+            "failed": self.failed,
+            "deleted": self.deleted,
+            "timings": self.timings or {},
+            "docs_per_second": round(self.docs_per_second(), 3),
+            "start_date": self.start_date.strftime(DEFAULT_DATETIME_FORMAT),
+            "end_date": (
+                None
+                if self.end_date is None
+                else self.end_date.strftime(DEFAULT_DATETIME_FORMAT)
+            ),
+            "update_date": self.update_date.strftime(DEFAULT_DATETIME_FORMAT),
+        }
+
+
+class QueuedTask(Base):
+    """
+    A run of a task waiting for, or claimed by, an ingestion worker. A worker holds its claim on the run for as
+    long as it renews the lease, a run whose lease expired is claimed again. The record goes once the run finishes.
+    """
+
+    __tablename__ = "task_queue"
+    id = Column(BigInteger, primary_key=True, nullable=False)
+    uuid = Column(Unicode(255), unique=True, nullable=False)
+    task_id = Column(Unicode(255), nullable=False)
+    params = Column(JSONB, nullable=False)
+    status = Column(Enum(objects.TaskStatus, name="task_status"), nullable=False)
+    priority = Column(Integer, default=0, nullable=False)
+    worker_id = Column(Unicode(255))
+    lease_expiry = Column(DateTime)
+    attempts = Column(BigInteger, default=0, nullable=False)
+    enqueue_date = Column(DateTime, default=dt.datetime.utcnow, nullable=False)
+    start_date = Column(DateTime)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ("task_id",), [Task.uuid], name="fk_task_queue_task", ondelete="CASCADE"
+        ),
+        Index(
+            "idx_task_queue_status_priority_enqueue",
+            "status",
+            "priority",
+            "enqueue_date",
+        ),
+        Index("idx_task_queue_task", "task_id"),
+    )
+
+    def __init__(self, task_id: str, params: Dict[str, Any], priority: int = 0):
+        self.uuid = str(uuid.uuid4())
+        self.task_id = task_id
+        self.params = params
+        self.priority = priority
+        self.status = objects.TaskStatus.CREATED
+        self.attempts = 0
+        self.enqueue_date = dt.datetime.utcnow()
+
+
+# The fencing tokens of the postgres locks backend, see nesis.api.core.util.locks.PostgresLockBackend
+lock_fence_seq = Sequence("lock_fence_seq", metadata=Base.metadata)
+
+
 class App(Base):
     """
     An app integration
@@ -1,4 +1,6 @@
 import os
+from typing import Optional
+
 from nesis.api.core.models.entities import (
     Action,
     UserRole,
@@ -25,6 +27,7 @@ from nesis.api.core.services.management import (
 from nesis.api.core.services.task_service import TaskService
 from nesis.api.core.services.util import PermissionException, UnauthorizedAccess
 from nesis.api.core.services.app_service import AppService
+from nesis.api.core.services.authorization import AuthorizationCache
 
 
 qanda_prediction_service: QandaPredictionService
@@ -35,10 +38,16 @@ user_session_service: UserSessionService
 role_service: RoleService
 task_service: TaskService
 app_service: AppService
+# Caches the decisions of authorized, see AuthorizationCache. None when disabled.
+authorization_cache: AuthorizationCache = None
 
 
 def init_services(config, http_client=None):
-    global datasource_service, qanda_prediction_service, settings_service, user_service, user_session_service, role_service, task_service, app_service
+    global datasource_service, qanda_prediction_service, settings_service, user_service, user_session_service, role_service, task_service, app_service, authorization_cache
+
+    authorization_cache = None
+    if ((config.get("authorization") or {}).get("cache") or {}).get("enabled"):
+        authorization_cache = AuthorizationCache(config=config)
 
     user_session_service = UserSessionService(config=config)
 
@@ -84,7 +93,8 @@ def authorized(
 ) -> dict:
     """
     This function checks if a given session token (app or user) is allowed to perform a given action on the resource (if supplied).
-    If no resource is supplied, then the check is performed on all resources
+    If no resource is supplied, then the check is performed on all resources. Decisions are cached when
+    authorization.cache is enabled, see AuthorizationCache.
     :param session_service: The session service
     :param session: The DBSession
     :param token: The token
@@ -106,15 +116,26 @@ def authorized(
     if session_user is not None and session_user.get("root", False):
         return session_user
 
-    query = _get_action_query(
-        action, resource, resource_type, session, session_app, session_user, user_id
-    )
-
-    if query is None:
+    principal = _get_principal(session_app, session_user, user_id)
+    if principal is None:
         raise UnauthorizedAccess()
 
-    role_actions = query.all()
-    if len(role_actions) == 0:
+    allowed = None
+    cache_key = None
+    if authorization_cache is not None:
+        # Read before the query, so that a decision racing an invalidation is stored under the stale version
+        cache_key = authorization_cache.key(principal, action, resource_type, resource)
+        allowed = authorization_cache.get(cache_key)
+
+    if allowed is None:
+        query = _get_action_query(
+            action, resource, resource_type, session, session_app, session_user, user_id
+        )
+        allowed = query.first() is not None
+        if cache_key is not None:
+            authorization_cache.put(cache_key, allowed)
+
+    if not allowed:
         message = (
             f"Not authorized to perform {action.name} on {resource}"
             if resource
@@ -125,6 +146,28 @@ def authorized(
     return session_user or session_app
 
 
+def invalidate_authorizations() -> None:
+    """
+    Discard the cached authorization decisions. Call this once a role, a user's roles or an app's roles change.
+    """
+    if authorization_cache is not None:
+        authorization_cache.invalidate()
+
+
+def _get_principal(session_app, session_user, user_id) -> Optional[str]:
+    """
+    Whose permissions apply, matching _get_action_query. An app acting as a user has the user's permissions.
+    """
+    if all([user_id, session_app]) or session_user is not None:
+        _user_id = user_id
+        if session_user is not None:
+            _user_id = session_user["id"]
+        return f"users/{_user_id}"
+    elif session_app is not None:
+        return f"apps/{session_app['id']}"
+    return None
+
+
 def _get_action_query(
     action, resource, resource_type, session, session_app, session_user, user_id
 ):
@@ -62,6 +62,7 @@ class AppRoleService(ServiceOperation):
             session.add(app_role)
             session.commit()
             session.refresh(app_role)
+            services.invalidate_authorizations()
 
             return app_role
         except Exception as e:
@@ -120,6 +121,7 @@ class AppRoleService(ServiceOperation):
 
             query.delete()
             session.commit()
+            services.invalidate_authorizations()
         except Exception as e:
             self.__LOG.exception("Error when deleting app")
             raise
@@ -300,6 +302,7 @@ class AppService(ServiceOperation):
 
                 session.delete(app)
                 session.commit()
+                services.invalidate_authorizations()
 
         except Exception:
             session.rollback()
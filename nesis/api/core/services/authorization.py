@@ -0,0 +1,144 @@
+import collections
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional
+
+import memcache
+
+_LOG = logging.getLogger(__name__)
+
+_VERSION_KEY = "authorization/version"
+
+
+class AuthorizationCache(object):
+    """
+    Caches authorization decisions keyed by principal, action, resource type and resource. Decisions are kept in an
+    in-process LRU of up to size entries in front of memcache, where they expire after expiry seconds.
+    Every key carries the version of the roles, a counter in memcache that invalidate bumps whenever a role, a user's
+    roles or an app's roles change, so that all the decisions made before the change go stale at once. Each process
+    re-reads the version at most every version_interval seconds, which bounds how long another replica keeps using
+    stale decisions.
+    """
+
+    def __init__(self, config: dict, cache_client: memcache.Client = None):
+        cache_config = (config.get("authorization") or {}).get("cache") or {}
+        self._size = int(cache_config.get("size") or 10000)
+        self._expiry = int(cache_config.get("expiry") or 300)
+        self._version_interval = float(cache_config.get("version_interval") or 1)
+        self._cache = cache_client or memcache.Client(
+            config["memcache"]["hosts"], debug=1
+        )
+        self._lock = threading.Lock()
+        self._decisions: collections.OrderedDict = collections.OrderedDict()
+        self._version: Optional[int] = None
+        self._version_read = 0.0
+
+    def key(
+        self, principal: str, action, resource_type, resource: Optional[str]
+    ) -> tuple:
+        """
+        The key of a decision under the current version. A caller computes it once, before making the decision, and
+        looks the decision up and stores it under that same key. A decision made while the version is bumped is then
+        stored under the version it was made under, which is no longer read.
+        """
+        return (
+            self._current_version(),
+            principal,
+            action.name,
+            resource_type.name,
+            resource,
+        )
+
+    def get(self, key: tuple) -> Optional[bool]:
+        """
+        The cached decision, True if allowed and False if denied, or None if the decision is not cached
+        """
+        with self._lock:
+            allowed = self._decisions.get(key)
+            if allowed is not None:
+                self._decisions.move_to_end(key)
+                return allowed
+
+        try:
+            allowed = self._cache.get(self._cache_key(key))
+        except:
+            _LOG.warning("Error reading authorization decision", exc_info=True)
+            return None
+        if allowed is not None:
+            self._remember(key, bool(allowed))
+            return bool(allowed)
+        return None
+
+    def put(self, key: tuple, allowed: bool) -> None:
+        self._remember(key, allowed)
+        try:
+            self._cache.set(self._cache_key(key), int(allowed), time=self._expiry)
+        except:
+            _LOG.warning("Error saving authorization decision", exc_info=True)
+
+    def invalidate(self) -> None:
+        """
+        Make every cached decision stale, in this process right away and in the others within version_interval
+        seconds.
+        """
+        try:
+            version = self._cache.incr(_VERSION_KEY)
+            if version is None:
+                version = self._new_version()
+        except:
+            _LOG.warning("Error invalidating authorization decisions", exc_info=True)
+            version = None
+        with self._lock:
+            self._decisions.clear()
+            # Without memcache, the version is only bumped in this process
+            self._version = version if version is not None else (self._version or 0) + 1
+            self._version_read = time.monotonic()
+
+    def _remember(self, key: tuple, allowed: bool) -> None:
+        with self._lock:
+            if key[0] != self._version:
+                # Made under a version invalidated since, it would never be read
+                return
+            self._decisions[key] = allowed
+            self._decisions.move_to_end(key)
+            while len(self._decisions) > self._size:
+                self._decisions.popitem(last=False)
+
+    @staticmethod
+    def _cache_key(key: tuple) -> str:
+        # Resources are free text, so they are hashed into a valid memcache key
+        digest = hashlib.sha256(repr(key[1:]).encode("utf-8")).hexdigest()
+        return f"authorization/{key[0]}/{digest}"
+
+    def _current_version(self) -> int:
+        with self._lock:
+            if (
+                self._version is not None
+                and time.monotonic() - self._version_read < self._version_interval
+            ):
+                return self._version
+
+        try:
+            version = self._cache.get(_VERSION_KEY)
+            if version is None:
+                version = self._new_version()
+        except:
+            _LOG.warning("Error reading authorization version", exc_info=True)
+            version = None
+
+        with self._lock:
+            if version is not None and version != self._version:
+                # Decisions made under another version can no longer be used
+                self._decisions.clear()
+                self._version = int(version)
+            elif self._version is None:
+                self._version = 0
+            self._version_read = time.monotonic()
+            return self._version
+
+    def _new_version(self) -> Optional[int]:
+        # A version evicted from memcache starts again from the clock so that it does not repeat an older one
+        self._cache.add(_VERSION_KEY, int(time.time() * 1000))
+        return self._cache.get(_VERSION_KEY)
@@ -291,6 +291,7 @@ class UserService(ServiceOperation):
                 raise ServiceException("Cannot delete Administrator")
             session.delete(user)
             session.commit()
+            services.invalidate_authorizations()
         except Exception as e:
             self._LOG.exception("Error when fetching users")
             raise
@@ -481,6 +482,7 @@ class RoleService(ServiceOperation):
                 role_action.role = role_record.id
                 session.add(role_action)
             session.commit()
+            services.invalidate_authorizations()
 
             role_record.policy_items = role_action_list
 
@@ -555,6 +557,7 @@ class RoleService(ServiceOperation):
             query = session.query(Role).filter(Role.uuid == uuid)
             query.delete()
             session.commit()
+            services.invalidate_authorizations()
         except Exception as e:
             self.__LOG.exception("Error when fetching users")
             raise
@@ -635,6 +638,7 @@ class RoleService(ServiceOperation):
             for role_action in role_action_items:
                 session.add(role_action)
             session.commit()
+            services.invalidate_authorizations()
 
             return role_record
 
@@ -688,6 +692,7 @@ class UserRoleService(ServiceOperation):
             session.add(user_role)
             session.commit()
             session.refresh(user_role)
+            services.invalidate_authorizations()
 
             return user_role
         except Exception as e:
@@ -751,6 +756,7 @@ class UserRoleService(ServiceOperation):
                 )
             query.delete()
             session.commit()
+            services.invalidate_authorizations()
         except Exception as e:
             self.__LOG.exception("Error when fetching users")
             raise
@@ -1,4 +1,6 @@
 import logging
+import queue
+import threading
 from typing import Dict, Any, List, Optional
 
 import apscheduler
@@ -8,7 +10,6 @@ from apscheduler.events import (
     EVENT_JOB_EXECUTED,
     JobEvent,
     EVENT_JOB_SUBMITTED,
-    EVENT_JOB_ADDED,
 )
 from apscheduler.executors.pool import ThreadPoolExecutor, ProcessPoolExecutor
 from apscheduler.jobstores.base import JobLookupError
@@ -24,9 +25,11 @@ from nesis.api.core.models.entities import (
     Action,
     Datasource,
     Task,
+    TaskRun,
 )
 from nesis.api.core.models.objects import (
     DatasourceStatus,
+    DatasourceType,
 )
 from nesis.api.core.models.objects import TaskType, TaskStatus
 from nesis.api.core.services.util import (
@@ -35,8 +38,18 @@ from nesis.api.core.services.util import (
     ConflictException,
     PermissionException,
 )
-from nesis.api.core.services.util import validate_schedule
-from nesis.api.core.tasks.document_management import ingest_datasource
+from nesis.api.core.services.util import (
+    validate_schedule,
+    validate_priority,
+    validate_time_budget,
+    save_task_statuses,
+)
+from nesis.api.core.tasks.document_management import (
+    ingest_datasource,
+    ingest_datasource_events,
+)
+from nesis.api.core.tasks.queue import enqueue_task
+from nesis.api.core.util.concurrency import IOBoundPool
 from nesis.api.core.util.http import HttpClient
 
 _LOG = logging.getLogger(__name__)
@@ -64,6 +77,26 @@ class TaskService(ServiceOperation):
 
         self._LOG.info("Initializing service...")
 
+        status_config = self._config["tasks"].get("status") or {}
+        self._status_batch_size = int(status_config.get("batch_size") or 100)
+        self._status_linger = float(status_config.get("linger") or 0.5)
+        self._status_queue: queue.Queue = queue.Queue()
+        self._status_writer = threading.Thread(
+            target=self._write_statuses, name="task-status-writer", daemon=True
+        )
+        self._status_writer.start()
+
+        # Notifications are ingested by at most one pool worker per datasource, see _drain_events
+        events_config = self._config["tasks"].get("events") or {}
+        self._max_pending_events = int(events_config.get("max_pending") or 10000)
+        self._events_lock = threading.Lock()
+        self._pending_events: Dict[str, list] = {}
+        self._events_futures: Dict[str, Any] = {}
+
+        # With workers, the scheduler's jobs only queue the runs, see nesis.api.core.worker
+        self._workers = bool((self._config["tasks"].get("worker") or {}).get("enabled"))
+        self._job_func = enqueue_task if self._workers else ingest_datasource
+
         self._setup_scheduler()
 
     def _setup_scheduler(self):
@@ -86,11 +119,33 @@ class TaskService(ServiceOperation):
             job_defaults=self._config["tasks"]["job"]["defaults"],
             timezone=pytz.timezone(self._config["tasks"]["timezone"]),
         )
+        # One listener for all the jobs. It only queues the status transitions, see _write_statuses.
+        # Workers record the status of the runs they take, so only a failure to queue one is of interest here.
+        self._scheduler.add_listener(
+            self._scheduler_listener,
+            (
+                EVENT_JOB_ERROR
+                if self._workers
+                else EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_SUBMITTED
+            ),
+        )
         try:
             self._scheduler.start()
         except (KeyboardInterrupt, SystemExit):
             self._scheduler.shutdown(wait=False)
             _LOG.info(f"Terminating scheduler process")
+            return
+
+        # Jobs scheduled before workers were turned on or off still point at the other function, and jobs of earlier
+        # releases carry no task id, without which their runs are not checkpointed, tracked or queued. The task id
+        # is the job id.
+        for job in self._scheduler.get_jobs():
+            if job.func is not self._job_func or "task_id" not in job.kwargs:
+                self._scheduler.modify_job(
+                    job.id,
+                    func=self._job_func,
+                    kwargs={**job.kwargs, "task_id": job.id},
+                )
 
     def _authorized(self, session, token, action):
         """
@@ -177,11 +232,19 @@ class TaskService(ServiceOperation):
             except ValueError as e:
                 raise ServiceException(e)
 
+            try:
+                priority = validate_priority(task.get("priority"))
+                time_budget = validate_time_budget(task.get("time_budget"))
+            except ValueError as e:
+                raise ServiceException(e)
+
             entity = Task(
                 schedule=schedule,
                 task_type=task_type,
                 definition=task_definition,
                 parent_id=parent_id,
+                priority=priority,
+                time_budget=time_budget,
             )
 
             session.add(entity)
@@ -189,19 +252,15 @@ class TaskService(ServiceOperation):
             session.refresh(entity)
 
             self._scheduler.add_job(
-                func=ingest_datasource,
+                func=self._job_func,
                 trigger=trigger,
                 id=entity.uuid,
-                kwargs={"params": task_definition, "config": self._config},
-            )
-            self._scheduler.add_listener(
-                self._scheduler_listener,
-                EVENT_JOB_EXECUTED
-                | EVENT_JOB_ERROR
-                | EVENT_JOB_SUBMITTED
-                | EVENT_JOB_ADDED,
+                kwargs={
+                    "params": task_definition,
+                    "config": self._config,
+                    "task_id": entity.uuid,
+                },
             )
-
             return entity
         except Exception as exc:
             session.rollback()
@@ -218,48 +277,124 @@ class TaskService(ServiceOperation):
             if session:
                 session.close()
 
-    @staticmethod
-    def _scheduler_listener(event: JobEvent) -> None:
-        job_id = event.job_id
+    def ingest_events(self, **kwargs):
+        """
+        Ingest a batch of datasource notifications in the background. Must have Task.CREATE permissions and access
+        to the datasource. Batches arriving while the datasource's notifications are being ingested are coalesced,
+        up to the tasks events max_pending records.
+        :param kwargs:
+        :return: the future of the ingestion
+        """
+        token = kwargs.get("token")
+        datasource_id = kwargs["datasource_id"]
+        events = kwargs.get("events") or {}
 
         session = DBSession()
-        task: Task = session.query(Task).filter(Task.uuid == job_id).first()
-        if task is None:
-            raise ValueError(f"Task {job_id} not found. May have been deleted")
-        datasource: Optional[Datasource] = None
-        if task.type == TaskType.INGEST_DATASOURCE:
-            datasource: Datasource = (
-                session.query(Datasource)
-                .filter(Datasource.uuid == task.parent_id)
-                .first()
-            )
+        try:
+            self._authorized(session=session, token=token, action=Action.CREATE)
+        finally:
+            session.close()
+
+        records = events.get("Records") if isinstance(events, dict) else None
+        if not isinstance(records, list):
+            raise ServiceException("Invalid events supplied")
+
+        datasource_records: List[Datasource] = self._datasource_service.get(
+            token=token, datasource_id=datasource_id
+        )
+        if len(datasource_records) == 0:
+            raise ServiceException("Invalid datasource supplied")
+        if datasource_records[0].type != DatasourceType.MINIO:
+            raise ServiceException("Datasource does not support events")
+
+        with self._events_lock:
+            pending = self._pending_events.setdefault(datasource_id, [])
+            if len(pending) + len(records) > self._max_pending_events:
+                raise ServiceException("Too many pending events for this datasource")
+            pending.extend(records)
+            future = self._events_futures.get(datasource_id)
+            if future is None:
+                future = IOBoundPool.submit(
+                    self._drain_events, datasource_id=datasource_id
+                )
+                self._events_futures[datasource_id] = future
+            return future
+
+    def _drain_events(self, datasource_id: str) -> None:
+        """
+        Ingest the pending notifications of a datasource until none are left. A single drain runs per datasource
+        so a burst of notifications holds one pool worker and is ingested in as few runs as it arrives in.
+        """
+        while True:
+            with self._events_lock:
+                records = self._pending_events.pop(datasource_id, None)
+                if not records:
+                    self._events_futures.pop(datasource_id, None)
+                    return
+            try:
+                ingest_datasource_events(
+                    config=self._config,
+                    params={"datasource": {"id": datasource_id}, "records": records},
+                )
+            except:
+                self._LOG.warning(
+                    f"Error ingesting the events of datasource {datasource_id}",
+                    exc_info=True,
+                )
 
-        match event.code:
-            case apscheduler.events.EVENT_JOB_ERROR:
-                if hasattr(event, "exception"):
-                    if event.exception is not None:
-                        _LOG.warning(
-                            f"Task {job_id} failed with error {event.exception}"
+    def _scheduler_listener(self, event: JobEvent) -> None:
+        """
+        Runs on the scheduler's thread, so it only queues the status transition for the status writer.
+        """
+        if event.code == EVENT_JOB_ERROR and getattr(event, "exception", None):
+            _LOG.warning(f"Task {event.job_id} failed with error {event.exception}")
+        self._status_queue.put((event.job_id, event.code))
+
+    def flush(self) -> None:
+        """
+        Block until all the queued status transitions are written.
+        """
+        self._status_queue.join()
+
+    def _write_statuses(self) -> None:
+        """
+        Drain the status queue, writing the transitions in batches of up to status batch_size, each in one
+        transaction. A batch waits at most status linger seconds for more transitions to arrive.
+        """
+        while True:
+            events = [self._status_queue.get()]
+            try:
+                while len(events) < self._status_batch_size:
+                    try:
+                        events.append(
+                            self._status_queue.get(timeout=self._status_linger)
                         )
-                task.status = TaskStatus.ERROR
-                if datasource is not None:
-                    datasource.status = DatasourceStatus.ONLINE
-            case apscheduler.events.EVENT_JOB_SUBMITTED:
-                task.status = TaskStatus.RUNNING
-                if datasource is not None:
-                    datasource.status = DatasourceStatus.INGESTING
-            case apscheduler.events.EVENT_JOB_EXECUTED:
-                task.status = TaskStatus.COMPLETED
-                if datasource is not None:
-                    datasource.status = DatasourceStatus.ONLINE
-
-        session.merge(task)
-        if datasource is not None:
-            session.merge(datasource)
-        try:
-            session.commit()
-        except:
-            _LOG.warning(f"Error when saving task {job_id} status", exc_info=True)
+                    except queue.Empty:
+                        break
+                self._save_statuses(events)
+            except:
+                _LOG.warning(
+                    f"Error when saving the status of {len(events)} tasks",
+                    exc_info=True,
+                )
+            finally:
+                for _ in events:
+                    self._status_queue.task_done()
+
+    @staticmethod
+    def _save_statuses(events: List[tuple[str, int]]) -> None:
+        # Only the latest transition of each task matters
+        statuses: Dict[str, TaskStatus] = {}
+        for job_id, code in events:
+            statuses.pop(job_id, None)
+            match code:
+                case apscheduler.events.EVENT_JOB_ERROR:
+                    statuses[job_id] = TaskStatus.ERROR
+                case apscheduler.events.EVENT_JOB_SUBMITTED:
+                    statuses[job_id] = TaskStatus.RUNNING
+                case apscheduler.events.EVENT_JOB_EXECUTED:
+                    statuses[job_id] = TaskStatus.COMPLETED
+        save_task_statuses(statuses=statuses)
 
     def get(self, **kwargs):
         task_id = kwargs.get("task_id")
@@ -293,6 +428,37 @@ class TaskService(ServiceOperation):
             if session:
                 session.close()
 
+    def get_runs(self, **kwargs) -> List[TaskRun]:
+        """
+        Get the runs of a task, latest first, with their progress. Must have Task.READ permissions on the task.
+        """
+        task_id = kwargs["task_id"]
+        limit = kwargs.get("limit") or 20
+
+        session = DBSession()
+        try:
+            self._authorized_resources(
+                session=session,
+                action=Action.READ,
+                token=kwargs.get("token"),
+                resource=task_id,
+            )
+
+            session.expire_on_commit = False
+            return (
+                session.query(TaskRun)
+                .filter(TaskRun.task_id == task_id)
+                .order_by(TaskRun.start_date.desc(), TaskRun.id.desc())
+                .limit(limit)
+                .all()
+            )
+        except Exception:
+            self._LOG.exception(f"Error when fetching task runs")
+            raise
+        finally:
+            if session:
+                session.close()
+
     def _authorized_resources(self, token, session, action, resource=None):
         authorized_tasks: list[RoleAction] = services.authorized_resources(
             self._session_service,
@@ -365,6 +531,18 @@ class TaskService(ServiceOperation):
             if enabled is not None and isinstance(enabled, bool):
                 task_record.enabled = enabled
 
+            if task.get("priority") is not None:
+                try:
+                    task_record.priority = validate_priority(task["priority"])
+                except ValueError as ve:
+                    raise ServiceException(ve)
+
+            if "time_budget" in task:
+                try:
+                    task_record.time_budget = validate_time_budget(task["time_budget"])
+                except ValueError as ve:
+                    raise ServiceException(ve)
+
             schedule = task.get("schedule")
             cron_job = None
             if schedule is not None:
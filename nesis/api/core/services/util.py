@@ -1,9 +1,13 @@
 import re
 import abc
-from typing import List, Union, Optional
+import logging
+from typing import List, Union, Optional, Iterator, Dict
+
+from sqlalchemy import or_, and_
 
 from nesis.api.core.models import DBSession
-from nesis.api.core.models.entities import Document
+from nesis.api.core.models.entities import Document, Task, TaskRun, Datasource
+from nesis.api.core.models.objects import TaskStatus, TaskType, DatasourceStatus
 from nesis.api.core.util import isblank
 from nesis.api.core.util.http import HttpClient
 
@@ -12,6 +16,11 @@ from apscheduler.triggers.date import DateTrigger
 
 import nesis.api.core.util.dateutil as du
 
+_LOG = logging.getLogger(__name__)
+
+MIN_TASK_PRIORITY = 0
+MAX_TASK_PRIORITY = 10
+
 
 class ServiceOperation(abc.ABC):
     @abc.abstractmethod
@@ -63,7 +72,24 @@ class ObjectNotFound(ServiceException):
     pass
 
 
+def _check_lock_token(current: Optional[Document], store_metadata) -> None:
+    """
+    Refuse to save store_metadata over the current record of a document when that record was saved under a
+    higher lock_token.
+    """
+    lock_token = (store_metadata or {}).get("lock_token")
+    if current is None or lock_token is None:
+        return
+    if lock_token < ((current.store_metadata or {}).get("lock_token") or 0):
+        raise ConflictException(f"Document {current.uuid} was saved under a newer lock")
+
+
 def save_document(**kwargs) -> Document:
+    """
+    Save a document. When its store_metadata carries the lock_token of the lease it was processed under, the save
+    is refused with a ConflictException if the current record of the document was saved under a higher token, that
+    is, by a worker that took the lock over from this one.
+    """
     document = kwargs.get("document")
     if document is None:
         document = Document(
@@ -81,6 +107,17 @@ def save_document(**kwargs) -> Document:
         session = DBSession()
     try:
         session.expire_on_commit = False
+        if (document.store_metadata or {}).get("lock_token") is not None:
+            current = (
+                session.query(Document)
+                .filter(
+                    Document.uuid == document.uuid,
+                    Document.datasource_id == document.datasource_id,
+                )
+                .with_for_update()
+                .first()
+            )
+            _check_lock_token(current, document.store_metadata)
         session.add(document)
         session.commit()
         session.refresh(document)
@@ -93,6 +130,36 @@ def save_document(**kwargs) -> Document:
             session.close()
 
 
+def touch_document(**kwargs) -> Optional[Document]:
+    """
+    Bring a document's store_metadata and last_modified up to date, leaving its ingested documents alone. As with
+    save_document, the update is refused with a ConflictException if the record was saved under a higher
+    lock_token. Returns the updated document, or None if it no longer exists.
+    """
+    session = DBSession()
+    try:
+        session.expire_on_commit = False
+        document = (
+            session.query(Document)
+            .filter(Document.uuid == kwargs["document_id"])
+            .with_for_update()
+            .first()
+        )
+        if document is None:
+            return None
+        _check_lock_token(document, kwargs["store_metadata"])
+        document.store_metadata = kwargs["store_metadata"]
+        document.last_modified = kwargs["last_modified"]
+        session.commit()
+        return document
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
 def delete_document(**kwargs):
     session = DBSession()
     try:
@@ -129,6 +196,150 @@ def get_document(**kwargs) -> Document:
             session.close()
 
 
+def get_task(**kwargs) -> Optional[Task]:
+    session = DBSession()
+    try:
+        session.expire_on_commit = False
+        return session.query(Task).filter(Task.uuid == kwargs["task_id"]).first()
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def get_task_checkpoint(**kwargs) -> Optional[dict]:
+    session = DBSession()
+    try:
+        task = session.query(Task).filter(Task.uuid == kwargs["task_id"]).first()
+        return None if task is None else task.checkpoint
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def save_task_checkpoint(**kwargs) -> None:
+    session = DBSession()
+    try:
+        session.query(Task).filter(Task.uuid == kwargs["task_id"]).update(
+            {Task.checkpoint: kwargs["checkpoint"]}
+        )
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def save_task_statuses(**kwargs) -> None:
+    """
+    Set the status of many tasks in one transaction. An ingestion task's datasource is INGESTING while the task
+    runs and ONLINE otherwise. Unknown tasks, for example deleted ones, are skipped.
+    """
+    statuses: Dict[str, TaskStatus] = kwargs["statuses"]
+
+    session = DBSession()
+    try:
+        tasks: Dict[str, Task] = {
+            task.uuid: task
+            for task in session.query(Task).filter(Task.uuid.in_(list(statuses)))
+        }
+        datasource_ids = {
+            task.parent_id
+            for task in tasks.values()
+            if task.type == TaskType.INGEST_DATASOURCE
+        }
+        datasources: Dict[str, Datasource] = (
+            {
+                datasource.uuid: datasource
+                for datasource in session.query(Datasource).filter(
+                    Datasource.uuid.in_(list(datasource_ids))
+                )
+            }
+            if datasource_ids
+            else {}
+        )
+
+        for task_id, status in statuses.items():
+            task = tasks.get(task_id)
+            if task is None:
+                _LOG.warning(f"Task {task_id} not found. May have been deleted")
+                continue
+            task.status = status
+            datasource = (
+                datasources.get(task.parent_id)
+                if task.type == TaskType.INGEST_DATASOURCE
+                else None
+            )
+            if datasource is not None:
+                datasource.status = (
+                    DatasourceStatus.INGESTING
+                    if status == TaskStatus.RUNNING
+                    else DatasourceStatus.ONLINE
+                )
+
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def create_task_run(**kwargs) -> TaskRun:
+    session = DBSession()
+    try:
+        session.expire_on_commit = False
+        task_run = TaskRun(task_id=kwargs["task_id"])
+        session.add(task_run)
+        session.commit()
+        session.refresh(task_run)
+        return task_run
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def update_task_run(**kwargs) -> None:
+    """
+    Add counters to a task run's counters and replace its timings. The status and end_date are set if supplied.
+    """
+    values = {
+        getattr(TaskRun, counter): getattr(TaskRun, counter) + value
+        for counter, value in (kwargs.get("counters") or {}).items()
+    }
+    values[TaskRun.update_date] = du.dt.datetime.utcnow()
+    if kwargs.get("timings") is not None:
+        values[TaskRun.timings] = kwargs["timings"]
+    if kwargs.get("status") is not None:
+        values[TaskRun.status] = kwargs["status"]
+    if kwargs.get("end_date") is not None:
+        values[TaskRun.end_date] = kwargs["end_date"]
+
+    session = DBSession()
+    try:
+        session.query(TaskRun).filter(TaskRun.uuid == kwargs["task_run_id"]).update(
+            values
+        )
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
 def get_documents(**kwargs) -> List[Document]:
     session = DBSession()
     try:
@@ -147,6 +358,45 @@ def get_documents(**kwargs) -> List[Document]:
             session.close()
 
 
+def stream_documents(**kwargs) -> Iterator:
+    """
+    Stream the documents of a datasource using a single query. Records are fetched in batches of yield_per rows
+    so that very large datasources do not have to be held in memory by the database driver.
+    Documents created before the datasource_id column was populated are matched on their base_uri.
+    """
+    session = DBSession()
+    try:
+        query = (
+            session.query(
+                Document.id,
+                Document.uuid,
+                Document.base_uri,
+                Document.filename,
+                Document.last_modified,
+                Document.store_metadata,
+                Document.rag_metadata,
+            )
+            .filter(
+                or_(
+                    Document.datasource_id == kwargs["datasource_id"],
+                    and_(
+                        Document.datasource_id.is_(None),
+                        Document.base_uri == kwargs["base_uri"],
+                    ),
+                )
+            )
+            .execution_options(yield_per=kwargs.get("yield_per") or 1000)
+        )
+        for row in query:
+            yield row
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
 _name_regex = re.compile(r"^[a-z0-9_-]{5,}$")
 
 
@@ -186,6 +436,28 @@ def un_ingest_file(http_client: HttpClient, endpoint: str, doc_id: str) -> None:
     http_client.delete(url=f"{endpoint}/v1/ingest/documents/{doc_id}")
 
 
+def validate_priority(priority) -> int:
+    if priority is None:
+        return 0
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        raise ValueError("Task priority must be a number")
+    if not MIN_TASK_PRIORITY <= priority <= MAX_TASK_PRIORITY:
+        raise ValueError(
+            f"Task priority must be between {MIN_TASK_PRIORITY} and {MAX_TASK_PRIORITY}"
+        )
+    return priority
+
+
+def validate_time_budget(time_budget) -> Optional[int]:
+    if time_budget is None:
+        return None
+    if isinstance(time_budget, bool) or not isinstance(time_budget, int):
+        raise ValueError("Task time budget must be a number of seconds")
+    if time_budget <= 0:
+        raise ValueError("Task time budget must be greater than 0")
+    return time_budget
+
+
 def validate_schedule(schedule) -> BaseTrigger:
     try:
         # While apscheduler can make the conversion, we do it here to have full control of error behaviour
@@ -1,4 +1,5 @@
 import logging
+from typing import Optional
 
 import memcache
 
@@ -7,14 +8,65 @@ import nesis.api.core.document_loaders.minio as minio
 import nesis.api.core.document_loaders.s3 as s3
 import nesis.api.core.document_loaders.samba as samba
 import nesis.api.core.document_loaders.sharepoint as sharepoint
-from nesis.api.core.models.entities import Datasource
-from nesis.api.core.models.objects import DatasourceType
+from nesis.api.core.document_loaders.cancellation import TaskCancellation
+from nesis.api.core.document_loaders.checkpoint import TaskCheckpoint
+from nesis.api.core.document_loaders.progress import TaskProgress
+from nesis.api.core.models.entities import Datasource, Task
+from nesis.api.core.models.objects import DatasourceType, TaskStatus
 from nesis.api.core.services.datasources import DatasourceService
-from nesis.api.core.util import http
+from nesis.api.core.services.util import create_task_run, get_task
+from nesis.api.core.util import http, sharding
 
 _LOG = logging.getLogger(__name__)
 
 
+def _task_progress(config, task_id) -> TaskProgress:
+    """
+    Start a run of the task, recording its progress. Failing to record progress does not fail the run.
+    """
+    interval = float(
+        ((config.get("tasks") or {}).get("progress") or {}).get("interval") or 5
+    )
+    task_run_id = None
+    if task_id is not None:
+        try:
+            task_run_id = create_task_run(task_id=task_id).uuid
+        except:
+            _LOG.warning(f"Error creating a run of task {task_id}", exc_info=True)
+    return TaskProgress(task_run_id=task_run_id, interval=interval)
+
+
+def _get_task(task_id) -> Optional[Task]:
+    if task_id is None:
+        return None
+    try:
+        return get_task(task_id=task_id)
+    except:
+        _LOG.warning(f"Error getting task {task_id}", exc_info=True)
+        return None
+
+
+def _task_cancellation(
+    config, task_id, task: Optional[Task], queued_task_id=None, worker_id=None
+) -> TaskCancellation:
+    """
+    Stop the run once the task is deleted or disabled, the run has used up the task's time budget, falling back
+    to the tasks.cancellation.time_budget setting, or the worker running it has lost its lease.
+    """
+    cancellation_config = (config.get("tasks") or {}).get("cancellation") or {}
+    time_budget = None if task is None else task.time_budget
+    if time_budget is None and cancellation_config.get("time_budget"):
+        time_budget = float(cancellation_config["time_budget"])
+    interval = cancellation_config.get("interval")
+    return TaskCancellation(
+        task_id=task_id,
+        time_budget=time_budget,
+        interval=5.0 if interval is None else float(interval),
+        queued_task_id=queued_task_id,
+        worker_id=worker_id,
+    )
+
+
 def ingest_datasource(**kwargs) -> None:
     config = kwargs["config"] or {}
     http_client = kwargs.get("http_client")
@@ -38,6 +90,61 @@ def ingest_datasource(**kwargs) -> None:
 
     metadata = {"datasource": datasource.name}
 
+    # A checkpoint records one replica's progress through the datasource. With sharding, replicas would
+    # resume from each other's progress, so checkpoints are kept in memory for the run instead.
+    task_id = None if sharding.membership(config) is not None else kwargs.get("task_id")
+    progress = _task_progress(config=config, task_id=kwargs.get("task_id"))
+    task = _get_task(kwargs.get("task_id"))
+    cancellation = _task_cancellation(
+        config=config,
+        task_id=kwargs.get("task_id"),
+        task=task,
+        queued_task_id=kwargs.get("queued_task_id"),
+        worker_id=kwargs.get("worker_id"),
+    )
+
+    try:
+        _ingest_datasource(
+            config=config,
+            http_client=http_client,
+            cache_client=cache_client,
+            datasource=datasource,
+            metadata=metadata,
+            task_id=task_id,
+            progress=progress,
+            priority=0 if task is None else task.priority,
+            cancellation=cancellation,
+        )
+    except:
+        progress.finish(status=TaskStatus.ERROR)
+        raise
+
+    if cancellation.stopped:
+        # The run stopped early and the next one resumes from its checkpoint
+        progress.finish(status=TaskStatus.PAUSED)
+        _LOG.info(
+            f"Stopped ingesting datasource {datasource.name} - {cancellation.reason} - {progress.snapshot()}"
+        )
+        return
+    progress.finish(status=TaskStatus.COMPLETED)
+
+    _LOG.info(
+        f"Ingested datasource {datasource.name} - {progress.snapshot()}. Upload concurrency: "
+        f"{http_client.limiter_metrics()}"
+    )
+
+
+def _ingest_datasource(
+    config,
+    http_client,
+    cache_client,
+    datasource,
+    metadata,
+    task_id,
+    progress,
+    priority,
+    cancellation,
+) -> None:
     match datasource.type:
         case DatasourceType.MINIO:
 
@@ -46,6 +153,10 @@ def ingest_datasource(**kwargs) -> None:
                 http_client=http_client,
                 cache_client=cache_client,
                 datasource=datasource,
+                checkpoint=TaskCheckpoint(task_id=task_id),
+                progress=progress,
+                priority=priority,
+                cancellation=cancellation,
             )
 
             minio_ingestor.run(metadata=metadata)
@@ -57,6 +168,10 @@ def ingest_datasource(**kwargs) -> None:
                 http_client=http_client,
                 cache_client=cache_client,
                 datasource=datasource,
+                checkpoint=TaskCheckpoint(task_id=task_id),
+                progress=progress,
+                priority=priority,
+                cancellation=cancellation,
             )
 
             ingestor.run(metadata=metadata)
@@ -67,6 +182,9 @@ def ingest_datasource(**kwargs) -> None:
                 http_client=http_client,
                 cache_client=cache_client,
                 datasource=datasource,
+                progress=progress,
+                priority=priority,
+                cancellation=cancellation,
             )
 
             ingestor.run(metadata=metadata)
@@ -77,9 +195,54 @@ def ingest_datasource(**kwargs) -> None:
                 http_client=http_client,
                 cache_client=cache_client,
                 datasource=datasource,
+                checkpoint=TaskCheckpoint(task_id=task_id),
+                progress=progress,
+                priority=priority,
+                cancellation=cancellation,
             )
 
             minio_ingestor.run(metadata=metadata)
 
         case _:
             raise ValueError("Invalid datasource type")
+
+
+def ingest_datasource_events(**kwargs) -> None:
+    """
+    Ingest only the objects referenced by a batch of datasource notifications. Only MinIO bucket notifications are
+    supported for now.
+    """
+    config = kwargs["config"] or {}
+    http_client = kwargs.get("http_client")
+    if http_client is None:
+        http_client = http.HttpClient(config=config)
+    cache_client = kwargs.get("cache_client")
+    if cache_client is None:
+        cache_client = memcache.Client(config["memcache"]["hosts"], debug=1)
+    params = kwargs["params"]
+
+    datasource_param = params["datasource"]
+    records = params.get("records") or []
+
+    datasource: Datasource = DatasourceService.get_datasource(
+        datasource_id=datasource_param["id"]
+    )
+
+    if datasource is None:
+        _LOG.warning(f"Datasource {datasource_param['id']} not found")
+        raise ValueError(f'Invalid datasource {datasource_param["id"]}')
+
+    metadata = {"datasource": datasource.name}
+
+    match datasource.type:
+        case DatasourceType.MINIO:
+            minio_ingestor = minio.MinioProcessor(
+                config=config,
+                http_client=http_client,
+                cache_client=cache_client,
+                datasource=datasource,
+            )
+
+            minio_ingestor.process_events(records=records, metadata=metadata)
+        case _:
+            raise ValueError("Datasource type does not support event ingestion")
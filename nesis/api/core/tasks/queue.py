@@ -0,0 +1,165 @@
+import datetime
+import logging
+from typing import List, Set
+
+from sqlalchemy import or_, and_
+
+from nesis.api.core.models import DBSession
+from nesis.api.core.models.entities import QueuedTask, Task
+from nesis.api.core.models.objects import TaskStatus
+
+_LOG = logging.getLogger(__name__)
+
+
+def enqueue_task(**kwargs) -> None:
+    """
+    The scheduler's job when ingestion runs on workers. It queues a run of the task for a worker to claim,
+    unless a run of the task is already queued or running.
+    """
+    task_id = kwargs["task_id"]
+
+    session = DBSession()
+    try:
+        queued = (
+            session.query(QueuedTask.id).filter(QueuedTask.task_id == task_id).first()
+        )
+        if queued is not None:
+            _LOG.info(f"Task {task_id} is already queued")
+            return
+        task = session.query(Task.priority).filter(Task.uuid == task_id).first()
+        session.add(
+            QueuedTask(
+                task_id=task_id,
+                params=kwargs["params"],
+                priority=0 if task is None else task.priority,
+            )
+        )
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def claim_tasks(**kwargs) -> List[QueuedTask]:
+    """
+    Claim up to count queued runs, highest priority then oldest first, for worker_id for lease seconds. Runs whose lease expired are
+    claimed again. Rows locked by another worker's claim are skipped so workers do not wait on each other.
+    """
+    worker_id = kwargs["worker_id"]
+    now = datetime.datetime.utcnow()
+
+    session = DBSession()
+    try:
+        session.expire_on_commit = False
+        queued_tasks: List[QueuedTask] = (
+            session.query(QueuedTask)
+            .filter(
+                or_(
+                    QueuedTask.status == TaskStatus.CREATED,
+                    and_(
+                        QueuedTask.status == TaskStatus.RUNNING,
+                        QueuedTask.lease_expiry < now,
+                    ),
+                )
+            )
+            .order_by(
+                QueuedTask.priority.desc(), QueuedTask.enqueue_date, QueuedTask.id
+            )
+            .limit(kwargs["count"])
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for queued_task in queued_tasks:
+            if queued_task.status == TaskStatus.RUNNING:
+                _LOG.warning(
+                    f"Reclaiming task {queued_task.task_id} from worker {queued_task.worker_id}"
+                )
+            queued_task.status = TaskStatus.RUNNING
+            queued_task.worker_id = worker_id
+            queued_task.lease_expiry = now + datetime.timedelta(seconds=kwargs["lease"])
+            queued_task.attempts += 1
+            queued_task.start_date = now
+        session.commit()
+        return queued_tasks
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def renew_tasks(**kwargs) -> Set[str]:
+    """
+    Extend worker_id's lease on the queued runs. Returns the runs worker_id still holds.
+    """
+    worker_id = kwargs["worker_id"]
+    queued_task_ids = kwargs["queued_task_ids"]
+    if not queued_task_ids:
+        return set()
+
+    session = DBSession()
+    try:
+        queued_tasks = (
+            session.query(QueuedTask)
+            .filter(
+                QueuedTask.uuid.in_(queued_task_ids),
+                QueuedTask.worker_id == worker_id,
+            )
+            .all()
+        )
+        lease_expiry = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=kwargs["lease"]
+        )
+        for queued_task in queued_tasks:
+            queued_task.lease_expiry = lease_expiry
+        session.commit()
+        return {queued_task.uuid for queued_task in queued_tasks}
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def finish_task(**kwargs) -> None:
+    """
+    Remove a finished run from the queue, unless another worker reclaimed it in the meantime.
+    """
+    session = DBSession()
+    try:
+        session.query(QueuedTask).filter(
+            QueuedTask.uuid == kwargs["queued_task_id"],
+            QueuedTask.worker_id == kwargs["worker_id"],
+        ).delete()
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        if session:
+            session.close()
+
+
+def holds_task(**kwargs) -> bool:
+    """
+    Whether worker_id still holds the queued run, that is another worker has not reclaimed it after its lease expired
+    """
+    session = DBSession()
+    try:
+        queued_task = (
+            session.query(QueuedTask.id)
+            .filter(
+                QueuedTask.uuid == kwargs["queued_task_id"],
+                QueuedTask.worker_id == kwargs["worker_id"],
+            )
+            .first()
+        )
+        return queued_task is not None
+    finally:
+        if session:
+            session.close()
@@ -1,6 +1,10 @@
+import collections
+import concurrent.futures
 import multiprocessing as mp
 import os
 import queue
+import threading
+import time
 from concurrent.futures import (
     ProcessPoolExecutor,
     ThreadPoolExecutor,
@@ -8,7 +12,9 @@ from concurrent.futures import (
     as_completed,
     wait,
     ALL_COMPLETED,
+    Future,
 )
+from typing import Optional
 
 # A CPU bound thread pool
 CPUBoundPool = ProcessPoolExecutor(mp.cpu_count() + 2)
@@ -20,6 +26,302 @@ IOBoundPool = ThreadPoolExecutor(
 
 
 class BlockingThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    A thread pool whose work queue is bounded. Once queue_size items are waiting, submit blocks until a worker
+    frees up, applying backpressure to the producer.
+    """
+
     def __init__(self, *, queue_size=0, **kwargs):
         super().__init__(**kwargs)
         self._work_queue = queue.Queue(maxsize=queue_size)
+
+
+class AdaptiveLimiter(object):
+    """
+    Bounds the number of concurrent calls to a downstream service and adapts that bound to the service's capacity
+    with additive increase, multiplicative decrease (AIMD). Each successful call raises the limit by 1/limit, about one
+    per limit's worth of calls. A failed call, or one that takes over latency_tolerance times the running average
+    latency, cuts the limit by decrease_factor. Cuts are at most one per average latency so that a burst of failures
+    from one overload shrinks the limit once. The latency of a call that sent a body of more than size_unit bytes is
+    taken per size_unit bytes, so that a large upload is not mistaken for a slow service.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 10,
+        min_limit: int = 1,
+        max_limit: int = 100,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+        smoothing: float = 0.1,
+        size_unit: int = 1024 * 1024,
+    ):
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._decrease_factor = decrease_factor
+        self._latency_tolerance = latency_tolerance
+        self._smoothing = smoothing
+        self._size_unit = size_unit
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._latency: float = 0.0
+        self._last_decrease = 0.0
+        self._wait_time = 0.0
+        self._acquired = 0
+        self._successes = 0
+        self._failures = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self) -> float:
+        """
+        Block until a call may proceed. Returns the time the call started, to be passed to release.
+        """
+        queued = time.monotonic()
+        with self._condition:
+            self._waiting += 1
+            try:
+                while self._in_flight >= int(self._limit):
+                    self._condition.wait()
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+            self._acquired += 1
+            started = time.monotonic()
+            self._wait_time += started - queued
+        return started
+
+    def release(self, started: float, ok: bool, size: int = 0) -> None:
+        """
+        Record the outcome of a call started at started, which sent size bytes, and adjust the limit.
+        """
+        now = time.monotonic()
+        latency = (now - started) / max(size / self._size_unit, 1)
+        with self._condition:
+            self._in_flight -= 1
+            slow = (
+                self._latency > 0 and latency > self._latency * self._latency_tolerance
+            )
+            if ok:
+                self._successes += 1
+            else:
+                self._failures += 1
+
+            if not ok or slow:
+                if now - self._last_decrease >= self._latency:
+                    self._limit = max(
+                        float(self._min_limit), self._limit * self._decrease_factor
+                    )
+                    self._last_decrease = now
+            else:
+                self._limit = min(float(self._max_limit), self._limit + 1 / self._limit)
+
+            if ok:
+                self._latency = (
+                    latency
+                    if self._latency == 0
+                    else self._latency + self._smoothing * (latency - self._latency)
+                )
+            self._condition.notify_all()
+
+    def metrics(self) -> dict:
+        with self._condition:
+            return {
+                "limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "latency": self._latency,
+                "average_wait": (
+                    self._wait_time / self._acquired if self._acquired else 0.0
+                ),
+                "successes": self._successes,
+                "failures": self._failures,
+            }
+
+
+class _Flow(object):
+    """
+    The queued work items of one datasource in a FairShareExecutor
+    """
+
+    def __init__(self, key: str, weight: float, quota: int, queue_size: int):
+        self.key = key
+        self.weight = weight
+        self.quota = quota
+        self.queue_size = queue_size
+        self.items = collections.deque()
+        self.running = 0
+        self.last_finish = 0.0
+        self.users = 0
+
+
+class FairShareQueue(object):
+    """
+    A datasource's view of a FairShareExecutor, with the submit and shutdown of an executor so that it stands in for
+    the work queue of a run.
+    """
+
+    def __init__(self, executor: "FairShareExecutor", flow: _Flow):
+        self._executor = executor
+        self._flow = flow
+        self._futures: set[Future] = set()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = self._executor._submit(self._flow, fn, *args, **kwargs)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._futures.discard(future)
+
+    def shutdown(self, wait: bool = True) -> None:
+        if wait:
+            with self._lock:
+                futures = list(self._futures)
+            concurrent.futures.wait(futures)
+        self._executor._release(self._flow)
+
+
+class FairShareExecutor(object):
+    """
+    One pool of workers for the file level work of every datasource run in the process, shared out with start-time
+    fair queuing. Each item is tagged, on submission, with the virtual time its datasource's share would start it at,
+    1 / weight after the datasource's previous item, and the workers run the item with the lowest tag. A datasource
+    with a backlog of millions of items so gets its share of the workers rather than all of them, and a datasource
+    that just started is served right away. A datasource also runs at most quota items at once and queues at most
+    queue_size, after which submit blocks until one of its items is taken.
+    """
+
+    def __init__(self, max_workers: int):
+        self._max_workers = max_workers
+        self._condition = threading.Condition()
+        self._flows: dict[str, _Flow] = {}
+        self._virtual_time = 0.0
+        self._threads: list[threading.Thread] = []
+
+    def queue(
+        self, key: str, weight: float = 1.0, quota: int = 0, queue_size: int = 0
+    ) -> FairShareQueue:
+        """
+        The queue of the datasource key. Runs of the same datasource share its queue and its quota, the latest run
+        sets the weight.
+        """
+        with self._condition:
+            flow = self._flows.get(key)
+            if flow is None:
+                flow = _Flow(
+                    key=key,
+                    weight=weight,
+                    quota=quota or self._max_workers,
+                    queue_size=queue_size,
+                )
+                self._flows[key] = flow
+            flow.weight = weight
+            flow.users += 1
+            while len(self._threads) < self._max_workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name=f"FairShare-{len(self._threads)}",
+                    daemon=True,
+                )
+                self._threads.append(thread)
+                thread.start()
+        return FairShareQueue(executor=self, flow=flow)
+
+    def _submit(self, flow: _Flow, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self._condition:
+            while flow.queue_size and len(flow.items) >= flow.queue_size:
+                self._condition.wait()
+            start = max(self._virtual_time, flow.last_finish)
+            flow.last_finish = start + 1.0 / flow.weight
+            flow.items.append((start, future, fn, args, kwargs))
+            self._condition.notify_all()
+        return future
+
+    def _release(self, flow: _Flow) -> None:
+        with self._condition:
+            flow.users -= 1
+            if flow.users <= 0 and not flow.items and not flow.running:
+                self._flows.pop(flow.key, None)
+
+    def _next(self):
+        """
+        The next item to run, the one with the lowest start tag among the datasources under their quota.
+        """
+        flows = [
+            flow
+            for flow in self._flows.values()
+            if flow.items and flow.running < flow.quota
+        ]
+        if not flows:
+            return None, None
+        flow = min(flows, key=lambda f: f.items[0][0])
+        item = flow.items.popleft()
+        self._virtual_time = max(self._virtual_time, item[0])
+        flow.running += 1
+        self._condition.notify_all()
+        return flow, item
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                flow, item = self._next()
+                while item is None:
+                    self._condition.wait()
+                    flow, item = self._next()
+
+            _, future, fn, args, kwargs = item
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as ex:
+                        future.set_exception(ex)
+            finally:
+                with self._condition:
+                    flow.running -= 1
+                    if flow.users <= 0 and not flow.items and not flow.running:
+                        self._flows.pop(flow.key, None)
+                    self._condition.notify_all()
+
+    def metrics(self) -> dict:
+        with self._condition:
+            return {
+                flow.key: {
+                    "queued": len(flow.items),
+                    "running": flow.running,
+                    "weight": flow.weight,
+                    "quota": flow.quota,
+                }
+                for flow in self._flows.values()
+            }
+
+
+_fair_share_executor: Optional[FairShareExecutor] = None
+_fair_share_lock = threading.Lock()
+
+
+def fair_share_executor(config: dict) -> Optional[FairShareExecutor]:
+    """
+    The process wide FairShareExecutor, or None if fair sharing is disabled in config
+    """
+    global _fair_share_executor
+    fair_share_config = (config.get("tasks") or {}).get("fair_share") or {}
+    if not fair_share_config.get("enabled"):
+        return None
+    if _fair_share_executor is None:
+        with _fair_share_lock:
+            if _fair_share_executor is None:
+                _fair_share_executor = FairShareExecutor(
+                    max_workers=int(fair_share_config.get("workers") or 64)
+                )
+    return _fair_share_executor
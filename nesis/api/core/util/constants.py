@@ -27,6 +27,11 @@ BASIC_PREFIX = "Basic"
 UUID_PATTERN = re.compile(r"^[\da-fA-F]{8}-([\da-fA-F]{4}-){3}[\da-fA-F]{12}$")
 
 DEFAULT_SAMBA_PORT = 445
+# The default number of files copied at any one time over a connection to a samba server
+DEFAULT_SAMBA_MAX_TRANSFERS = 4
+
+# The default number of objects a datasource processes, or queues for processing, at any one time
+DEFAULT_MAX_IN_FLIGHT = 50
 
 
 class TOKEN_AUTH:
@@ -1,62 +1,424 @@
 import concurrent
 import concurrent.futures
+import http.cookiejar
 import json
-import multiprocessing
 import os
 import pathlib
-import base64
-from typing import Union
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+from typing import (
+    Any,
+    Union,
+    Callable,
+    BinaryIO,
+    Iterator,
+    Dict,
+    Optional,
+    List,
+    Tuple,
+)
 
-import memcache
 import requests as req
+import urllib3
 import logging
+from requests.adapters import HTTPAdapter
 
-from nesis.api.core.util import clean_control
-from nesis.api.core.util.concurrency import IOBoundPool
+from nesis.api.core.util.concurrency import IOBoundPool, AdaptiveLimiter
+
+
+# The size of the chunks read from a stream when uploading it
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# The number of hosts for which connection pools are kept
+_POOL_CONNECTIONS = 10
+_DEFAULT_CONNECT_TIMEOUT = 10
+_DEFAULT_READ_TIMEOUT = 300
+_DEFAULT_RETRIES = 3
+_DEFAULT_BACKOFF_FACTOR = 0.5
+_RETRY_STATUSES = (429, 502, 503)
+
+_shared_session: Optional[req.Session] = None
+_shared_session_lock = threading.Lock()
+
+# Upload concurrency limiters, one per upload endpoint, shared by every HttpClient in the process
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _multipart_stream(
+    boundary: str, field: str, file_name: str, body: BinaryIO, fields: dict
+) -> Iterator[bytes]:
+    """
+    Generate a multipart/form-data body, reading the file part from body in chunks. Passing this generator to
+    requests results in a chunked transfer so the file is never held in memory or written to disk.
+    """
+    for name, value in fields.items():
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n"
+        ).encode("utf-8")
+    file_name = file_name.replace('"', "%22")
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{file_name}"\r\n\r\n'
+    ).encode("utf-8")
+    while True:
+        chunk = body.read(_STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+
+def _create_session() -> req.Session:
+    session = req.Session()
+    # The session is shared by every caller in the process so it must not carry cookies from one to the next
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    # Size the connection pools so that every IOBoundPool worker can hold a connection to the same host
+    adapter = HTTPAdapter(
+        pool_connections=_POOL_CONNECTIONS, pool_maxsize=IOBoundPool._max_workers
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _session() -> req.Session:
+    """
+    The process wide session. Connections are kept alive and reused across HttpClient instances, threads and
+    greenlets; urllib3's connection pools are thread safe. The session is created lazily, on first use, so that it is
+    created after any monkey patching.
+    """
+    global _shared_session
+    if _shared_session is None:
+        with _shared_session_lock:
+            if _shared_session is None:
+                _shared_session = _create_session()
+    return _shared_session
+
+
+def _not_connected(ex: req.exceptions.ConnectionError) -> bool:
+    """
+    Whether a request failed before a connection to the server was established, so nothing was sent
+    """
+    if isinstance(ex, req.exceptions.ConnectTimeout):
+        return True
+    reason = ex.args[0] if ex.args else None
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _read_upload(filepath, stream: Callable[[], BinaryIO] = None) -> bytes:
+    if stream is None:
+        return pathlib.Path(filepath).read_bytes()
+    body = stream()
+    try:
+        return body.read()
+    finally:
+        body.close()
+        if hasattr(body, "release_conn"):
+            body.release_conn()
+
+
+class _UploadBatcher(object):
+    """
+    Groups small file uploads to one bulk endpoint. A batch is sent when it holds max_files files or max_bytes bytes,
+    or linger seconds after its first file was queued, whichever comes first. The endpoint must answer with one
+    result per file, in order, each holding either the file's data or its error.
+    """
+
+    def __init__(
+        self,
+        client: "HttpClient",
+        url: str,
+        field: str,
+        max_files: int,
+        max_bytes: int,
+        linger: float,
+    ):
+        self._client = client
+        self._url = url
+        self._field = field
+        self._max_files = max_files
+        self._max_bytes = max_bytes
+        self._linger = linger
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[str, dict, Callable, concurrent.futures.Future]] = []
+        self._pending_bytes = 0
+        self._timer: Optional[threading.Timer] = None
+
+    def submit(
+        self, filepath, metadata: dict, size: int, stream: Callable = None
+    ) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._pending.append((filepath, metadata, stream, future))
+            self._pending_bytes += size or 0
+            if (
+                len(self._pending) >= self._max_files
+                or self._pending_bytes >= self._max_bytes
+            ):
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self._linger, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            self._send(batch)
+        return future
+
+    def flush(self) -> None:
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def _take(self) -> list:
+        batch = self._pending
+        self._pending = []
+        self._pending_bytes = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _send(self, batch: list) -> None:
+        client = self._client
+        sent = [0]
+
+        def send() -> req.Response:
+            # Files in a batch are small so each is read whole. They are read again if the request is retried.
+            files = [
+                (
+                    self._field,
+                    (pathlib.Path(filepath).name, _read_upload(filepath, stream)),
+                )
+                for filepath, _, stream, _ in batch
+            ]
+            sent[0] = sum(len(content) for _, (_, content) in files)
+            return client._session.post(
+                url=self._url,
+                files=files,
+                data={"metadata": json.dumps([item[1] for item in batch])},
+                timeout=client._timeout,
+            )
+
+        try:
+            response = client._send(
+                send,
+                limiter=_limiter(self._url, client._limiter_config),
+                sent=lambda: sent[0],
+                idempotent=False,
+            )
+            if response.status_code == 400:
+                raise ValueError(response.text)
+            response.raise_for_status()
+            results = response.json()["data"]
+            for (_, _, _, future), result in zip(batch, results):
+                if result.get("error") is not None:
+                    future.set_exception(ValueError(result["error"]))
+                else:
+                    future.set_result(
+                        json.dumps(
+                            {"object": "list", "model": "rag", "data": result["data"]}
+                        )
+                    )
+        except Exception as ex:
+            client._LOG.warning(
+                f"Failed to upload a batch of {len(batch)} files", exc_info=True
+            )
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+        else:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(
+                        ValueError(f"No result returned by {self._url}")
+                    )
+
+
+def _endpoint(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _limiter(url: str, config: dict) -> AdaptiveLimiter:
+    """
+    The limiter for the endpoint serving url. It is created, from config, the first time the endpoint is used.
+    """
+    endpoint = _endpoint(url)
+    with _limiters_lock:
+        limiter = _limiters.get(endpoint)
+        if limiter is None:
+            limiter = AdaptiveLimiter(
+                initial_limit=int(config.get("initial") or 10),
+                min_limit=int(config.get("min") or 1),
+                max_limit=int(config.get("max") or IOBoundPool._max_workers),
+                decrease_factor=float(config.get("decrease_factor") or 0.5),
+                latency_tolerance=float(config.get("latency_tolerance") or 2.0),
+                size_unit=int(config.get("size_unit") or 1024 * 1024),
+            )
+            _limiters[endpoint] = limiter
+        return limiter
 
 
 class HttpClient(object):
     """
-    A simple http client wrapping the request library
+    A simple http client wrapping the request library. All clients share a pooled, keep-alive transport.
+    Requests that fail to connect or are answered with 429, 502 or 503 are retried with an exponential backoff.
+    Uploads and other POSTs are only retried when they failed to connect or were answered with 429.
+    Uploads are bounded by an adaptive concurrency limit per endpoint, see AdaptiveLimiter.
     """
 
     def __init__(self, config):
         self._config = config
-        self._cache = memcache.Client(config["memcache"]["hosts"], debug=1)
         self._LOG = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+        self._session = _session()
+
+        client_config = (config.get("http") or {}).get("client") or {}
+        self._timeout = (
+            float(client_config.get("connect_timeout") or _DEFAULT_CONNECT_TIMEOUT),
+            float(client_config.get("read_timeout") or _DEFAULT_READ_TIMEOUT),
+        )
+        retries = client_config.get("retries")
+        self._retries = int(_DEFAULT_RETRIES if retries is None else retries)
+        self._backoff_factor = float(
+            client_config.get("backoff_factor") or _DEFAULT_BACKOFF_FACTOR
+        )
+        self._limiter_config = client_config.get("limiter") or {}
+        self._batchers: Dict[str, _UploadBatcher] = {}
+        self._batchers_lock = threading.Lock()
+
+    def _send(
+        self,
+        send: Callable[[], req.Response],
+        limiter: AdaptiveLimiter = None,
+        sent: Callable[[], int] = None,
+        idempotent: bool = True,
+    ) -> req.Response:
+        """
+        Call send, retrying it on connection errors and retryable statuses. send must build the request body afresh
+        on every call. If a limiter is given, each attempt waits for a slot and reports its outcome to the limiter,
+        along with the bytes sent by the attempt as counted by sent; the backoff between attempts does not hold a
+        slot. A request that is not idempotent, such as an upload, may have been acted on by the time it failed, so
+        it is only retried if it never reached the server: when the connection could not be established or it was
+        answered with a 429.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = (
+                    send()
+                    if limiter is None
+                    else self._send_limited(send, limiter, sent)
+                )
+            except req.exceptions.ConnectionError as ex:
+                if attempt >= self._retries or not (idempotent or _not_connected(ex)):
+                    raise
+                delay = self._backoff_factor * (2**attempt)
+            else:
+                if (
+                    response.status_code not in _RETRY_STATUSES
+                    or attempt >= self._retries
+                    or not (idempotent or response.status_code == 429)
+                ):
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                delay = (
+                    float(retry_after)
+                    if retry_after is not None and retry_after.isnumeric()
+                    else self._backoff_factor * (2**attempt)
+                )
+                response.close()
+
+            attempt += 1
+            self._LOG.debug(f"Retrying request, attempt {attempt} in {delay}s")
+            time.sleep(delay)
+
+    @staticmethod
+    def _send_limited(
+        send: Callable[[], req.Response],
+        limiter: AdaptiveLimiter,
+        sent: Callable[[], int] = None,
+    ) -> req.Response:
+        started = limiter.acquire()
+        ok = False
+        try:
+            response = send()
+            ok = (
+                response.status_code not in _RETRY_STATUSES
+                and response.status_code < 500
+            )
+            return response
+        finally:
+            limiter.release(started, ok=ok, size=0 if sent is None else sent())
+
+    def limiter_metrics(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Upload concurrency metrics for every endpoint uploaded to: the current limit, calls in flight and waiting for
+        a slot, the average latency and wait, and the count of successful and failed calls.
+        """
+        with _limiters_lock:
+            limiters = dict(_limiters)
+        return {endpoint: limiter.metrics() for endpoint, limiter in limiters.items()}
+
+    def pool_metrics(self) -> Dict[str, Dict[str, int]]:
+        """
+        Connection pool metrics for every host the transport holds a pool for.
+        """
+        metrics = {}
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                metrics[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                    "connections": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "idle": sum(
+                        1 for conn in list(pool.pool.queue) if conn is not None
+                    ),
+                    "max_size": pool.pool.maxsize,
+                }
+        return metrics
 
     def get(self, url, params=None, headers=None, cookies=None, auth=None) -> str:
-        with req.session() as session:
-            _headers = headers or {}
-            if auth:
-                b64bytes = base64.b64encode(f"{auth[0]}:{auth[0]}".encode("utf-8"))
-                userpass_encoded = "Basic " + str(b64bytes, "utf-8")
-                _headers["Authorization"] = str(userpass_encoded)
-                session.headers = _headers
-
-            response = session.get(
+        response = self._send(
+            lambda: self._session.get(
                 url,
                 params=params,
+                headers=headers,
                 allow_redirects=True,
                 cookies=cookies,
-                auth=(auth[0], auth[1]),
+                auth=(auth[0], auth[1]) if auth else None,
+                timeout=self._timeout,
             )
-            if response.ok:
-                return response.text
-            raise Exception(response.text)
+        )
+        if response.ok:
+            return response.text
+        raise Exception(response.text)
 
     def delete(self, url, params=None, headers=None, cookies=None) -> str:
-        with req.Session() as s:
-            response = s.delete(
+        response = self._send(
+            lambda: self._session.delete(
                 url,
                 params=params,
                 headers=headers,
                 allow_redirects=True,
                 cookies=cookies,
+                timeout=self._timeout,
             )
-            if response.ok:
-                return response.text
-            raise Exception(response.text)
+        )
+        if response.ok:
+            return response.text
+        raise Exception(response.text)
 
     def deletes(self, urls, params=None, headers=None, cookies=None) -> None:
         futures = []
@@ -82,36 +444,38 @@ class HttpClient(object):
             raise exceptions[0]
 
     def post(self, url, payload, headers=None, cookies=None) -> str:
-        with req.Session() as s:
-            response = s.post(
+        response = self._send(
+            lambda: self._session.post(
                 url,
                 headers=headers,
                 allow_redirects=True,
                 data=payload,
                 cookies=cookies,
-            )
-            if response.ok:
-                return response.text
-            raise Exception(response.text)
+                timeout=self._timeout,
+            ),
+            idempotent=False,
+        )
+        if response.ok:
+            return response.text
+        raise Exception(response.text)
 
     def put(self, url, payload, headers=None, cookies=None) -> str:
-        with req.Session() as s:
-            response = s.put(
+        response = self._send(
+            lambda: self._session.put(
                 url,
                 headers=headers,
                 allow_redirects=True,
                 data=payload,
                 cookies=cookies,
+                timeout=self._timeout,
             )
-            if response.ok:
-                return response.text
-            raise Exception(response.text)
-
-    def upload(self, url, filepath, field, metadata: dict) -> Union[None, str]:
-        """
-        Upload a file. We ensure that it is threadsafe by locking on the self_link using Memcached's add method.
-        """
+        )
+        if response.ok:
+            return response.text
+        raise Exception(response.text)
 
+    @staticmethod
+    def _validate_upload(metadata: dict) -> None:
         self_link = metadata.get("self_link")
         if self_link is None:
             raise ValueError("Invalid metadata. Must have a self_link link")
@@ -119,31 +483,118 @@ class HttpClient(object):
         if datasource is None:
             raise ValueError("Invalid metadata. Must have a datasource")
 
+    def upload_batched(
+        self,
+        url,
+        filepath,
+        field,
+        metadata: dict,
+        size: int,
+        max_files: int,
+        max_bytes: int,
+        linger: float,
+        stream: Callable[[], BinaryIO] = None,
+    ) -> str:
         """
-        Here we use memcached add function to simulate locking. This ensure that if multiple instances of this application
-        are running, there will not be a conflict on which instance processed the file
+        Upload a small file as part of a batch sent to the bulk endpoint url. The call blocks until the batch has been
+        sent and returns this file's result in the same shape as upload. The batching parameters take effect the
+        first time url is used.
         """
-        _lock_key = clean_control(f"{__name__}/locks/{self_link}")
-        if self._cache.add(key=_lock_key, val=_lock_key, time=30 * 60):
-            try:
-                with open(filepath, "rb") as file_handle:
-                    file_name = pathlib.Path(filepath).name
-                    _metadata = json.dumps(metadata)
-                    multipart_form_data = {field: (file_name, file_handle)}
+        self._validate_upload(metadata)
+        with self._batchers_lock:
+            batcher = self._batchers.get(url)
+            if batcher is None:
+                batcher = _UploadBatcher(
+                    client=self,
+                    url=url,
+                    field=field,
+                    max_files=max_files,
+                    max_bytes=max_bytes,
+                    linger=linger,
+                )
+                self._batchers[url] = batcher
+        future = batcher.submit(
+            filepath=filepath, metadata=metadata, size=size, stream=stream
+        )
+        return future.result()
 
-                    data = {"metadata": _metadata}
+    def upload(
+        self,
+        url,
+        filepath,
+        field,
+        metadata: dict,
+        stream: Callable[[], BinaryIO] = None,
+    ) -> Union[None, str]:
+        """
+        Upload a file. Callers lock the file, see nesis.api.core.util.locks, so that it is not uploaded by two
+        workers at once. If stream is supplied, it is called to open the file contents which are then piped, in
+        chunks, into the request. In this case, filepath only supplies the file name. The stream is opened again if
+        the upload is retried, which only happens if it did not reach the server, see _send.
+        """
 
-                    response = req.post(
-                        url=url, files=multipart_form_data, params=data, data=data
-                    )
-                    match response.status_code:
-                        case 400:
-                            # ValueError is fitting since 400 means the data we sent is invalid
-                            raise ValueError(response.text)
-                        case 500 | 501 | 503:
-                            response.raise_for_status()
-                    return response.text
+        self._validate_upload(metadata)
+        file_name = pathlib.Path(filepath).name
+        _metadata = json.dumps(metadata)
+        data = {"metadata": _metadata}
+        # The bytes sent by the last attempt, which the concurrency limit takes the latency per, see AdaptiveLimiter
+        sent = [0]
+
+        def send_file() -> req.Response:
+            sent[0] = os.path.getsize(filepath)
+            with open(filepath, "rb") as file_handle:
+                multipart_form_data = {field: (file_name, file_handle)}
+
+                return self._session.post(
+                    url=url,
+                    files=multipart_form_data,
+                    params=data,
+                    data=data,
+                    timeout=self._timeout,
+                )
+
+        def send_stream() -> req.Response:
+            sent[0] = 0
+            body = stream()
+            boundary = uuid.uuid4().hex
+
+            def chunks() -> Iterator[bytes]:
+                for chunk in _multipart_stream(
+                    boundary=boundary,
+                    field=field,
+                    file_name=file_name,
+                    body=body,
+                    fields=data,
+                ):
+                    sent[0] += len(chunk)
+                    yield chunk
+
+            try:
+                return self._session.post(
+                    url=url,
+                    params=data,
+                    data=chunks(),
+                    headers={
+                        "Content-Type": f"multipart/form-data; boundary={boundary}"
+                    },
+                    timeout=self._timeout,
+                )
             finally:
-                self._cache.delete(_lock_key)
-        else:
-            raise UserWarning(f"File {filepath} is already processing")
+                body.close()
+                if hasattr(body, "release_conn"):
+                    body.release_conn()
+
+        response = self._send(
+            send_file if stream is None else send_stream,
+            limiter=_limiter(url, self._limiter_config),
+            sent=lambda: sent[0],
+            idempotent=False,
+        )
+
+        match response.status_code:
+            case 400:
+                # ValueError is fitting since 400 means the data we sent is invalid
+                raise ValueError(response.text)
+            case 500 | 501 | 503:
+                response.raise_for_status()
+        return response.text
@@ -0,0 +1,386 @@
+import abc
+import contextlib
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from typing import Dict, Iterator, List, Optional, Set
+
+import memcache
+import sqlalchemy as sa
+from sqlalchemy.pool import NullPool
+
+from nesis.api.core.util import clean_control
+
+_LOG = logging.getLogger(__name__)
+
+_DEFAULT_TTL = 60
+_DEFAULT_FENCE_BLOCK = 100
+# A reserved block of fencing tokens is only drawn from for this many seconds, see MemcacheLockBackend
+_FENCE_BLOCK_TTL = 1.0
+# Memcached rejects keys longer than 250 characters so longer keys are hashed
+_MAX_KEY_LENGTH = 200
+_FENCE_SEQUENCE = "lock_fence_seq"
+
+_postgres_manager: Optional["LockManager"] = None
+_postgres_manager_lock = threading.Lock()
+
+
+def _clock_token() -> int:
+    # Milliseconds since the epoch, a token start above any handed out by a counter started earlier
+    return int(time.time() * 1000)
+
+
+class Lease(object):
+    """
+    A lock held on key until it is released or lost. The fencing token increases with every lease granted by the
+    backend, so a stale holder can be told apart from the current one: a file's record keeps the token of the lease
+    it was saved under, as lock_token in its store_metadata, and saving it under a lower token is refused. held is
+    this process's view: it turns False once the lease has gone unrenewed for its ttl or a renewal found it taken.
+    """
+
+    def __init__(self, key: str, token: int, owner: str, ttl: float):
+        self.key = key
+        self.token = token
+        self.owner = owner
+        self._ttl = ttl
+        self._expires = time.monotonic() + ttl
+        self._lost = False
+
+    @property
+    def held(self) -> bool:
+        return not self._lost and time.monotonic() < self._expires
+
+    def _remaining(self) -> float:
+        """
+        The seconds left before the lease runs out, or 0 if it is no longer held
+        """
+        return max(self._expires - time.monotonic(), 0) if self.held else 0
+
+    def _renewed(self) -> None:
+        self._expires = time.monotonic() + self._ttl
+
+    def _lose(self) -> None:
+        self._lost = True
+
+
+class LockBackend(abc.ABC):
+    @abc.abstractmethod
+    def acquire(self, keys: List[str], owner: str, ttl: int) -> Dict[str, int]:
+        """
+        Try to lock each of keys. Returns the fencing token of each key that was locked.
+        """
+        pass
+
+    @abc.abstractmethod
+    def renew(self, leases: List[Lease], ttl: int) -> Set[str]:
+        """
+        Extend the leases. Returns the keys that are still held.
+        """
+        pass
+
+    @abc.abstractmethod
+    def release(self, leases: List[Lease]) -> None:
+        pass
+
+
+class MemcacheLockBackend(LockBackend):
+    """
+    Locks are memcache entries created with add and expiring with the lease. The fencing tokens come from a
+    counter, incremented by fence_block at a time so that most acquires draw their token from the block reserved
+    by this process rather than from memcache. A block is only drawn from for a second, as a token from a block
+    reserved before another process's could otherwise come after it. A lease released while comfortably within its
+    ttl is still the memcache entry's holder, so it is deleted without reading the entry back. Locking a file then
+    costs an add and a delete.
+    """
+
+    def __init__(
+        self, cache_client: memcache.Client, fence_block: int = _DEFAULT_FENCE_BLOCK
+    ):
+        self._cache = cache_client
+        self._fence_key = clean_control(f"{__name__}/fence")
+        self._fence_block = max(int(fence_block or 1), 1)
+        self._block_lock = threading.Lock()
+        # The next token of the reserved block, its last token and when the block stops being drawn from
+        self._next_token = 0
+        self._last_token = -1
+        self._block_expiry = 0.0
+
+    @staticmethod
+    def _key(key: str) -> str:
+        _key = clean_control(f"{__name__}/locks/{key}")
+        if len(_key) > _MAX_KEY_LENGTH:
+            _key = clean_control(
+                f"{__name__}/locks/{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+            )
+        return _key
+
+    @staticmethod
+    def _value(owner: str, token: int) -> str:
+        return f"{owner}:{token}"
+
+    def _reserve(self, count: int) -> int:
+        token = self._cache.incr(self._fence_key, delta=count)
+        if token is None:
+            # An evicted counter starts again from the clock, so that it does not hand out tokens lower than those
+            # already saved with the files
+            self._cache.add(self._fence_key, str(_clock_token()))
+            token = self._cache.incr(self._fence_key, delta=count)
+        return int(token or _clock_token())
+
+    def _tokens(self, count: int) -> List[int]:
+        with self._block_lock:
+            if (
+                self._last_token - self._next_token + 1 < count
+                or time.monotonic() >= self._block_expiry
+            ):
+                size = max(count, self._fence_block)
+                self._last_token = self._reserve(size)
+                # Tokens are positive, a record saved without one counting as token 0
+                self._next_token = max(self._last_token - size + 1, 1)
+                self._block_expiry = time.monotonic() + _FENCE_BLOCK_TTL
+            tokens = list(range(self._next_token, self._next_token + count))
+            self._next_token += count
+            return tokens
+
+    def acquire(self, keys: List[str], owner: str, ttl: int) -> Dict[str, int]:
+        tokens = {}
+        for key, token in zip(keys, self._tokens(len(keys))):
+            if self._cache.add(
+                self._key(key), self._value(owner=owner, token=token), time=ttl
+            ):
+                tokens[key] = token
+        return tokens
+
+    def _held(self, leases: List[Lease]) -> List[Lease]:
+        values = self._cache.get_multi([self._key(lease.key) for lease in leases])
+        return [
+            lease
+            for lease in leases
+            if values.get(self._key(lease.key))
+            == self._value(owner=lease.owner, token=lease.token)
+        ]
+
+    def renew(self, leases: List[Lease], ttl: int) -> Set[str]:
+        held = self._held(leases)
+        for lease in held:
+            self._cache.touch(self._key(lease.key), ttl)
+        return {lease.key for lease in held}
+
+    def release(self, leases: List[Lease]) -> None:
+        # The entry of a lease with over a third of its ttl left cannot have expired and been taken by another
+        # holder, so only the other leases are read back
+        held = [lease for lease in leases if lease._remaining() > lease._ttl / 3]
+        unsure = [lease for lease in leases if lease not in held]
+        if unsure:
+            held += self._held(unsure)
+        if held:
+            self._cache.delete_multi([self._key(lease.key) for lease in held])
+
+
+class PostgresLockBackend(LockBackend):
+    """
+    Locks are session level Postgres advisory locks taken over one dedicated connection. They do not expire while
+    the connection lives and are dropped by the server as soon as it dies, so a crashed process never holds a lock.
+    Advisory locks are reentrant within a session, so keys locked by this process are tracked here as well. The
+    fencing tokens come from the lock_fence_seq sequence, created by the migrations, which unlike transaction ids
+    costs nothing to draw from. A locks url must point at a database the migrations ran on.
+    """
+
+    def __init__(self, url: str):
+        self._engine = sa.create_engine(url, poolclass=NullPool)
+        self._connection = None
+        self._lock = threading.Lock()
+        self._held: Set[str] = set()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = self._engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT"
+            )
+            self._held = set()
+        return self._connection
+
+    def _reset(self) -> None:
+        # The server released all our locks with the connection
+        try:
+            if self._connection is not None:
+                self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+        self._held = set()
+
+    def acquire(self, keys: List[str], owner: str, ttl: int) -> Dict[str, int]:
+        with self._lock:
+            keys = [key for key in keys if key not in self._held]
+            if not keys:
+                return {}
+            try:
+                rows = (
+                    self._connect()
+                    .execute(
+                        sa.text(
+                            f"SELECT k, pg_try_advisory_lock(hashtextextended(k, 0)), nextval('{_FENCE_SEQUENCE}') "
+                            "FROM unnest(CAST(:keys AS text[])) AS k"
+                        ),
+                        {"keys": keys},
+                    )
+                    .all()
+                )
+            except Exception:
+                self._reset()
+                raise
+            tokens = {key: int(token) for key, locked, token in rows if locked}
+            self._held.update(tokens.keys())
+            return tokens
+
+    def renew(self, leases: List[Lease], ttl: int) -> Set[str]:
+        with self._lock:
+            try:
+                self._connect().execute(sa.text("SELECT 1"))
+            except Exception:
+                _LOG.warning("Lost the lock connection", exc_info=True)
+                self._reset()
+                return set()
+            return {lease.key for lease in leases if lease.key in self._held}
+
+    def release(self, leases: List[Lease]) -> None:
+        with self._lock:
+            keys = [lease.key for lease in leases if lease.key in self._held]
+            if not keys:
+                return
+            self._held.difference_update(keys)
+            try:
+                self._connect().execute(
+                    sa.text(
+                        "SELECT pg_advisory_unlock(hashtextextended(k, 0)) "
+                        "FROM unnest(CAST(:keys AS text[])) AS k"
+                    ),
+                    {"keys": keys},
+                )
+            except Exception:
+                _LOG.warning("Failed to release locks", exc_info=True)
+                self._reset()
+
+
+class LockManager(object):
+    """
+    Hands out short leases on keys and renews the leases it holds in the background, every third of the ttl, until
+    they are released. A process that dies stops renewing, so its locks are freed within ttl seconds rather than
+    being held for the whole duration of the work.
+    """
+
+    def __init__(self, backend: LockBackend, ttl: int = _DEFAULT_TTL, owner=None):
+        self._backend = backend
+        self._ttl = ttl
+        self.owner = owner or str(uuid.uuid4())
+        self._leases: Dict[str, Lease] = {}
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def acquire(self, keys: List[str]) -> Dict[str, Lease]:
+        """
+        Try to lock all of keys at once. Returns a lease for each key that was locked; the others are held
+        elsewhere.
+        """
+        tokens = self._backend.acquire(keys=keys, owner=self.owner, ttl=self._ttl)
+        leases = {
+            key: Lease(key=key, token=token, owner=self.owner, ttl=self._ttl)
+            for key, token in tokens.items()
+        }
+        if leases:
+            with self._lock:
+                self._leases.update({lease.key: lease for lease in leases.values()})
+                if self._timer is None:
+                    self._schedule()
+        return leases
+
+    def release(self, leases: List[Lease]) -> None:
+        with self._lock:
+            for lease in leases:
+                if self._leases.get(lease.key) is lease:
+                    self._leases.pop(lease.key)
+        try:
+            self._backend.release(leases)
+        except Exception:
+            _LOG.warning("Failed to release locks", exc_info=True)
+
+    @contextlib.contextmanager
+    def lock(self, key: str) -> Iterator[Optional[Lease]]:
+        """
+        Lock key for the duration of the block. The block receives None if key is locked elsewhere.
+        """
+        lease = self.acquire([key]).get(key)
+        try:
+            yield lease
+        finally:
+            if lease is not None:
+                self.release([lease])
+
+    def _schedule(self) -> None:
+        self._timer = threading.Timer(self._ttl / 3, self._renew)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _renew(self) -> None:
+        with self._lock:
+            leases = list(self._leases.values())
+        held = set()
+        try:
+            held = self._backend.renew(leases, ttl=self._ttl)
+        except Exception:
+            _LOG.warning("Failed to renew locks", exc_info=True)
+        for lease in leases:
+            if lease.key in held:
+                lease._renewed()
+            else:
+                _LOG.warning(f"Lost the lock on {lease.key}")
+                lease._lose()
+        with self._lock:
+            for lease in leases:
+                if not lease.held and self._leases.get(lease.key) is lease:
+                    self._leases.pop(lease.key)
+            if self._leases:
+                self._schedule()
+            else:
+                self._timer = None
+
+
+def lock_manager(config: dict, cache_client: memcache.Client = None) -> LockManager:
+    """
+    The lock manager for the locks backend in config. The memcache backend works over cache_client. The postgres
+    backend holds a connection, so a single manager is shared by the process.
+    """
+    global _postgres_manager
+    locks_config = config.get("locks") or {}
+    ttl = int(locks_config.get("ttl") or _DEFAULT_TTL)
+    match locks_config.get("backend") or "memcache":
+        case "memcache":
+            if cache_client is None:
+                cache_client = memcache.Client(config["memcache"]["hosts"], debug=1)
+            return LockManager(
+                backend=MemcacheLockBackend(
+                    cache_client,
+                    fence_block=int(
+                        locks_config.get("fence_block") or _DEFAULT_FENCE_BLOCK
+                    ),
+                ),
+                ttl=ttl,
+            )
+        case "postgres":
+            if _postgres_manager is None:
+                with _postgres_manager_lock:
+                    if _postgres_manager is None:
+                        _postgres_manager = LockManager(
+                            backend=PostgresLockBackend(
+                                url=locks_config.get("url") or config["database"]["url"]
+                            ),
+                            ttl=ttl,
+                        )
+            return _postgres_manager
+        case backend:
+            raise ValueError(
+                f"Invalid locks backend {backend}. Expected 'memcache' or 'postgres'"
+            )
@@ -0,0 +1,175 @@
+import atexit
+import bisect
+import hashlib
+import logging
+import threading
+import uuid
+from typing import Optional, List
+
+import memcache
+
+from nesis.api.core.util import clean_control
+
+_LOG = logging.getLogger(__name__)
+
+_DEFAULT_TTL = 60
+_DEFAULT_HEARTBEAT = 20
+_DEFAULT_MAX_MEMBERS = 64
+_DEFAULT_VNODES = 64
+
+_membership: Optional["ShardMembership"] = None
+_membership_lock = threading.Lock()
+_workers_warned = False
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing(object):
+    """
+    A consistent hash ring. Each member is placed on the ring at vnodes points and a key belongs to the first member
+    clockwise from the key's hash. When a member joins or leaves, only the keys between it and its neighbours move.
+    """
+
+    def __init__(self, members: List[str], vnodes: int = _DEFAULT_VNODES):
+        points = sorted(
+            (_hash(f"{member}:{vnode}"), member)
+            for member in set(members)
+            for vnode in range(vnodes)
+        )
+        self._hashes = [point[0] for point in points]
+        self._members = [point[1] for point in points]
+
+    def __len__(self) -> int:
+        return len(set(self._members))
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._hashes:
+            return None
+        idx = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._members[idx]
+
+
+class ShardMembership(object):
+    """
+    The set of API replicas taking part in sharding. Each replica claims one of max_members slots in memcache
+    with add, so a slot is held by a single replica, and refreshes it every heartbeat seconds. A slot expires ttl
+    seconds after the last refresh, which is how a replica that stopped without leaving drops out of the membership.
+    """
+
+    def __init__(
+        self,
+        cache_client: memcache.Client,
+        ttl: int = _DEFAULT_TTL,
+        heartbeat: float = _DEFAULT_HEARTBEAT,
+        max_members: int = _DEFAULT_MAX_MEMBERS,
+        vnodes: int = _DEFAULT_VNODES,
+        member_id: str = None,
+    ):
+        self._cache = cache_client
+        self._ttl = ttl
+        self._heartbeat = heartbeat
+        self._max_members = max_members
+        self._vnodes = vnodes
+        self.member_id = member_id or str(uuid.uuid4())
+        self._slot: Optional[str] = None
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._slots = [
+            clean_control(f"{__name__}/members/{idx}") for idx in range(max_members)
+        ]
+
+    def join(self) -> None:
+        """
+        Claim a slot and start the heartbeat.
+        """
+        with self._lock:
+            self._claim()
+            if self._timer is None:
+                self._schedule()
+
+    def _claim(self) -> None:
+        if self._slot is not None:
+            if self._cache.get(self._slot) == self.member_id:
+                self._cache.set(self._slot, self.member_id, time=self._ttl)
+                return
+            # Our slot expired and was taken by another replica
+            self._slot = None
+        for slot in self._slots:
+            if self._cache.add(slot, self.member_id, time=self._ttl):
+                self._slot = slot
+                return
+        _LOG.warning(f"No free membership slot for replica {self.member_id}")
+
+    def _schedule(self) -> None:
+        self._timer = threading.Timer(self._heartbeat, self._beat)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _beat(self) -> None:
+        with self._lock:
+            if self._timer is None:
+                return
+            try:
+                self._claim()
+            except Exception:
+                _LOG.warning("Failed to refresh the membership slot", exc_info=True)
+            self._schedule()
+
+    def leave(self) -> None:
+        """
+        Stop the heartbeat and release the slot so that the other replicas take over this replica's shard on their
+        next run.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._slot is not None:
+                if self._cache.get(self._slot) == self.member_id:
+                    self._cache.delete(self._slot)
+                self._slot = None
+
+    def members(self) -> List[str]:
+        return sorted(set(self._cache.get_multi(self._slots).values()))
+
+    def ring(self) -> HashRing:
+        """
+        A snapshot of the ring for the current members. This replica is always on its own ring, even if it has not
+        been able to claim a slot.
+        """
+        return HashRing(members=self.members() + [self.member_id], vnodes=self._vnodes)
+
+
+def membership(config: dict) -> Optional[ShardMembership]:
+    """
+    The membership of this process, or None if sharding is not enabled. It is created and joined on first use and
+    left when the process exits. Sharding is ignored with workers, which take each queued run whole.
+    """
+    global _membership, _workers_warned
+    sharding = (config.get("tasks") or {}).get("sharding") or {}
+    if not sharding.get("enabled"):
+        return None
+    if ((config.get("tasks") or {}).get("worker") or {}).get("enabled"):
+        # A datasource's run is queued once and taken by a single worker, so a worker owning a shard of it would
+        # leave the other shards unsynced
+        if not _workers_warned:
+            _workers_warned = True
+            _LOG.warning("Sharding is ignored when ingestion runs on workers")
+        return None
+    if _membership is None:
+        with _membership_lock:
+            if _membership is None:
+                _membership = ShardMembership(
+                    cache_client=memcache.Client(config["memcache"]["hosts"], debug=1),
+                    ttl=int(sharding.get("ttl") or _DEFAULT_TTL),
+                    heartbeat=float(sharding.get("heartbeat") or _DEFAULT_HEARTBEAT),
+                    max_members=int(
+                        sharding.get("max_members") or _DEFAULT_MAX_MEMBERS
+                    ),
+                    vnodes=int(sharding.get("vnodes") or _DEFAULT_VNODES),
+                )
+                _membership.join()
+                atexit.register(_membership.leave)
+    return _membership
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import argparse
+import concurrent.futures
+import logging
+import multiprocessing as mp
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Set
+
+working_dir = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(working_dir)
+
+import nesis.api.core.config as settings
+from nesis.api.core.models import initialize_engine
+from nesis.api.core.models.entities import QueuedTask
+from nesis.api.core.models.objects import TaskStatus
+from nesis.api.core.services.util import save_task_statuses
+from nesis.api.core.tasks.document_management import ingest_datasource
+from nesis.api.core.tasks.queue import claim_tasks, renew_tasks, finish_task
+
+_LOG = logging.getLogger(__name__)
+
+
+def _initialize(config: dict) -> None:
+    initialize_engine(config)
+
+
+def _run_task(
+    config: dict, task_id: str, params: dict, queued_task_id: str, worker_id: str
+) -> None:
+    ingest_datasource(
+        config=config,
+        params=params,
+        task_id=task_id,
+        queued_task_id=queued_task_id,
+        worker_id=worker_id,
+    )
+
+
+class Worker(object):
+    """
+    Runs queued ingestion runs in its own processes so that heavy syncs do not compete with the API for the GIL.
+    The API's scheduler only queues the runs, see enqueue_task. Any number of workers can share the queue, each
+    claims at most concurrency runs at a time and renews its leases on them every third of the lease. A worker
+    that dies stops renewing, so its runs are claimed by another worker once their lease expires. A run checks that
+    its worker still holds it along with its task, see TaskCancellation, and stops once it was reclaimed.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        worker_id: Optional[str] = None,
+        executor: Optional[concurrent.futures.Executor] = None,
+    ):
+        worker_config = config["tasks"].get("worker") or {}
+        self._config = config
+        self._concurrency = int(worker_config.get("concurrency") or 3)
+        self._lease = int(worker_config.get("lease") or 60)
+        self._poll_interval = float(worker_config.get("poll_interval") or 5)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{uuid.uuid4()}"
+
+        # This is left package public for testing
+        self._executor = executor or concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._concurrency,
+            mp_context=mp.get_context("spawn"),
+            initializer=_initialize,
+            initargs=(config,),
+        )
+        # The queued runs this worker holds, by their queue id
+        self._running: Dict[str, tuple[QueuedTask, concurrent.futures.Future]] = {}
+        # Runs whose lease was lost to another worker. They stop on their next check and are not recorded.
+        self._lost: Set[str] = set()
+        self._last_renewal = time.monotonic()
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+
+    def run(self) -> None:
+        """
+        Take and run queued runs until stopped, then wait for the running ones to finish.
+        """
+        _LOG.info(f"Worker {self.worker_id} started with {self._concurrency} processes")
+        while not self._stopped.is_set() or self._running:
+            try:
+                self.poll()
+            except:
+                _LOG.warning("Error polling the task queue", exc_info=True)
+            self._wake.wait(min(self._poll_interval, self._lease / 3))
+            self._wake.clear()
+        self._executor.shutdown(wait=True)
+        _LOG.info(f"Worker {self.worker_id} stopped")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wake.set()
+
+    def poll(self) -> int:
+        """
+        Record the runs that finished, renew the leases if due and claim queued runs up to concurrency. Returns
+        the number of runs claimed.
+        """
+        self._reap()
+        if time.monotonic() - self._last_renewal >= self._lease / 3:
+            self._renew()
+
+        free = self._concurrency - len(self._running)
+        if self._stopped.is_set() or free <= 0:
+            return 0
+
+        queued_tasks = claim_tasks(
+            worker_id=self.worker_id, count=free, lease=self._lease
+        )
+        if not queued_tasks:
+            return 0
+        save_task_statuses(
+            statuses={
+                queued_task.task_id: TaskStatus.RUNNING for queued_task in queued_tasks
+            }
+        )
+        for queued_task in queued_tasks:
+            _LOG.info(f"Running task {queued_task.task_id}")
+            future = self._executor.submit(
+                _run_task,
+                config=self._config,
+                task_id=queued_task.task_id,
+                params=queued_task.params,
+                queued_task_id=queued_task.uuid,
+                worker_id=self.worker_id,
+            )
+            self._running[queued_task.uuid] = (queued_task, future)
+            future.add_done_callback(lambda _: self._wake.set())
+        return len(queued_tasks)
+
+    def _reap(self) -> None:
+        statuses: Dict[str, TaskStatus] = {}
+        for queued_task_id, (queued_task, future) in list(self._running.items()):
+            if not future.done():
+                continue
+            if queued_task_id in self._lost:
+                self._lost.discard(queued_task_id)
+                self._running.pop(queued_task_id)
+                continue
+
+            # If this fails, the run stays with the worker and is finished on the next poll
+            finish_task(queued_task_id=queued_task_id, worker_id=self.worker_id)
+            self._running.pop(queued_task_id)
+            if future.exception() is not None:
+                _LOG.warning(
+                    f"Task {queued_task.task_id} failed with error {future.exception()}"
+                )
+                statuses[queued_task.task_id] = TaskStatus.ERROR
+            else:
+                statuses[queued_task.task_id] = TaskStatus.COMPLETED
+        if statuses:
+            save_task_statuses(statuses=statuses)
+
+    def _renew(self) -> None:
+        held_ids = [
+            queued_task_id
+            for queued_task_id in self._running
+            if queued_task_id not in self._lost
+        ]
+        held = renew_tasks(
+            worker_id=self.worker_id, queued_task_ids=held_ids, lease=self._lease
+        )
+        for queued_task_id in set(held_ids) - held:
+            _LOG.warning(
+                f"Lost the lease on task {self._running[queued_task_id][0].task_id}"
+            )
+            self._lost.add(queued_task_id)
+        self._last_renewal = time.monotonic()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nesis Ingestion Worker")
+    parser.add_argument("--config", type=str, help="Configuration file", required=False)
+
+    args = parser.parse_args()
+
+    try:
+        config = settings.load_config(args.config)
+        initialize_engine(config)
+        worker = Worker(config=config)
+    except Exception as ex:
+        _LOG.error(f"Error initializing worker - {ex}", exc_info=True)
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    worker.run()
@@ -48,6 +48,8 @@ spec.components.schema("Apps", schema=AppsSchema)
 spec.components.schema("TaskReq", schema=TaskReqSchema)
 spec.components.schema("TaskRes", schema=TaskResSchema)
 spec.components.schema("Tasks", schema=TasksSchema)
+spec.components.schema("TaskRunRes", schema=TaskRunResSchema)
+spec.components.schema("TaskRuns", schema=TaskRunsSchema)
 
 # Roles
 spec.components.schema("RoleReq", schema=RoleReqSchema)
@@ -24,9 +24,14 @@ from nesis.api.core.controllers.management import (
 from nesis.api.core.controllers.datasources import (
     operate_datasources,
     operate_datasource,
+    operate_datasource_events,
 )
 from nesis.api.core.controllers.predictions import operate_module_predictions
-from nesis.api.core.controllers.tasks_controller import operate_tasks, operate_task
+from nesis.api.core.controllers.tasks_controller import (
+    operate_tasks,
+    operate_task,
+    operate_task_runs,
+)
 from nesis.api.spec import spec
 
 with app.test_request_context():
@@ -36,10 +41,12 @@ with app.test_request_context():
     spec.path(view=operate_apps)
     spec.path(view=operate_tasks)
     spec.path(view=operate_task)
+    spec.path(view=operate_task_runs)
     spec.path(view=operate_roles)
     spec.path(view=operate_role)
     spec.path(view=operate_datasources)
     spec.path(view=operate_datasource)
+    spec.path(view=operate_datasource_events)
     spec.path(view=operate_module_predictions)
 
 
@@ -12,6 +12,8 @@ class TaskReqSchema(Schema):
     enabled = fields.Boolean()
     type = fields.Str()
     schedule = fields.Str()
+    priority = fields.Int()
+    time_budget = fields.Int(allow_none=True)
     parent_id = fields.Str()
     definition = fields.Dict()
 
@@ -26,3 +28,24 @@ class TaskResSchema(TaskReqSchema):
 class TasksSchema(Schema):
     items = fields.List(fields.Nested(TaskResSchema))
     count = fields.Int()
+
+
+class TaskRunResSchema(Schema):
+    id = fields.Str()
+    task_id = fields.Str()
+    status = fields.Str()
+    listed = fields.Int()
+    skipped = fields.Int()
+    downloaded_bytes = fields.Int()
+    uploaded = fields.Int()
+    failed = fields.Int()
+    deleted = fields.Int()
+    timings = fields.Dict(keys=fields.Str(), values=fields.Float())
+    docs_per_second = fields.Float()
+    start_date = fields.DateTime(DEFAULT_DATETIME_FORMAT)
+    end_date = fields.DateTime(DEFAULT_DATETIME_FORMAT)
+    update_date = fields.DateTime(DEFAULT_DATETIME_FORMAT)
+
+
+class TaskRunsSchema(Schema):
+    items = fields.List(fields.Nested(TaskRunResSchema))
@@ -80,6 +80,7 @@ config = {
         "executors": {"default_size": 30, "pool_size": 3},
     },
     "apps": {"session": {"expiry": 1800}},
+    "authorization": {"cache": {"enabled": True}},
     "http": {"workers": {"count": 10}},
 }
 
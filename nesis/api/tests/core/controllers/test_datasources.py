@@ -1,4 +1,5 @@
 import json
+import unittest.mock as mock
 
 import yaml
 
@@ -423,3 +424,83 @@ def test_delete_datasource_schedule(client, tc):
     )
     assert 200 == response.status_code, response.json
     assert 0 == len(response.json["items"])
+
+
+@mock.patch("nesis.api.core.services.task_service.IOBoundPool")
+def test_datasource_events(pool: mock.MagicMock, client, tc):
+    payload = {
+        "type": "minio",
+        "name": "finance7",
+        "connection": {
+            "user": "caikuodda",
+            "password": "some.password",
+            "endpoint": "localhost",
+            "dataobjects": "initdb",
+        },
+    }
+
+    admin_session = get_admin_session(client=client)
+
+    response = client.post(
+        f"/v1/datasources",
+        headers=tests.get_header(token=admin_session["token"]),
+        data=json.dumps(payload),
+    )
+    assert 200 == response.status_code, response.json
+    datasource_id = response.json["id"]
+
+    events = {
+        "EventName": "s3:ObjectCreated:Put",
+        "Records": [
+            {
+                "eventName": "s3:ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": "initdb"},
+                    "object": {"key": "file.pdf"},
+                },
+            }
+        ],
+    }
+
+    response = client.post(
+        f"/v1/datasources/{datasource_id}/events",
+        headers=tests.get_header(),
+        data=json.dumps(events),
+    )
+    assert 401 == response.status_code, response.json
+
+    response = client.post(
+        f"/v1/datasources/{datasource_id}/events",
+        headers=tests.get_header(token=admin_session["token"]),
+        data=json.dumps({"Records": "invalid"}),
+    )
+    assert 400 == response.status_code, response.json
+
+    response = client.post(
+        f"/v1/datasources/{datasource_id}/events",
+        headers=tests.get_header(token=admin_session["token"]),
+        data=json.dumps(events),
+    )
+    assert 202 == response.status_code, response.json
+
+    # A batch arriving while the datasource's events are pending is coalesced with them
+    response = client.post(
+        f"/v1/datasources/{datasource_id}/events",
+        headers=tests.get_header(token=admin_session["token"]),
+        data=json.dumps(events),
+    )
+    assert 202 == response.status_code, response.json
+    assert pool.submit.call_count == 1
+    _, submit_kwargs = pool.submit.call_args
+    assert submit_kwargs["datasource_id"] == datasource_id
+
+    with mock.patch(
+        "nesis.api.core.services.task_service.ingest_datasource_events"
+    ) as ingest_datasource_events:
+        services.task_service._drain_events(datasource_id=datasource_id)
+    _, ingest_kwargs = ingest_datasource_events.call_args
+    tc.assertDictEqual(
+        ingest_kwargs["params"],
+        {"datasource": {"id": datasource_id}, "records": events["Records"] * 2},
+    )
+    assert ingest_datasource_events.call_count == 1
@@ -8,6 +8,7 @@ import nesis.api.core.services as services
 import nesis.api.tests as tests
 from nesis.api.core.controllers import app as cloud_app
 from nesis.api.core.models import initialize_engine, DBSession
+from nesis.api.core.services.util import create_task_run, update_task_run
 
 """
 This test runs all tests as administrator. The _permissions.py test module contains all tests with permission
@@ -222,3 +223,51 @@ def test_update_tasks(client, tc):
 
     assert 200 == response.status_code, response.text
     assert "2 4 1 * wed" == response.json["schedule"]
+
+
+def test_task_runs(client, tc):
+
+    admin_session = tests.get_admin_session(app=client)
+
+    datasource = create_datasource(client=client, session=admin_session)
+    response = client.post(
+        f"/v1/tasks",
+        headers=tests.get_header(token=admin_session["token"]),
+        data=json.dumps(
+            {
+                "type": "ingest_datasource",
+                "schedule": "2 4 * * mon,fri",
+                "definition": {"datasource": {"id": datasource["id"]}},
+            }
+        ),
+    )
+    assert 200 == response.status_code, response.text
+    task_id = response.json["id"]
+
+    task_run = create_task_run(task_id=task_id)
+    update_task_run(
+        task_run_id=task_run.uuid,
+        counters={"listed": 10, "uploaded": 4, "skipped": 2},
+        timings={"upload": 1.5},
+    )
+
+    response = client.get(
+        f"/v1/tasks/{task_id}/runs",
+        headers=tests.get_header(token=admin_session["token"]),
+    )
+    assert 200 == response.status_code, response.text
+    items = response.json["items"]
+    assert len(items) == 1
+    assert items[0]["id"] == task_run.uuid
+    assert items[0]["status"] == "RUNNING"
+    assert items[0]["listed"] == 10
+    assert items[0]["uploaded"] == 4
+    assert items[0]["timings"] == {"upload": 1.5}
+    assert items[0]["docs_per_second"] > 0
+
+    # Runs of tasks the user cannot read are denied
+    response = client.get(
+        f"/v1/tasks/{task_id}/runs",
+        headers=tests.get_header(),
+    )
+    assert 401 == response.status_code, response.text
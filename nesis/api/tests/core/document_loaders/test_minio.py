@@ -1,18 +1,29 @@
+import copy
 import datetime
+import io
 import json
 import os
 import unittest as ut
 import unittest.mock as mock
 import uuid
 
+import memcache
 import pytest
 from sqlalchemy.orm.session import Session
 
+import nesis.api.core.config as settings
 import nesis.api.core.document_loaders.minio as minio
 import nesis.api.core.services as services
 from nesis.api import tests
+from nesis.api.core.document_loaders.cancellation import TaskCancellation
+from nesis.api.core.document_loaders.checkpoint import TaskCheckpoint
 from nesis.api.core.document_loaders.stores import SqlDocumentStore
 from nesis.api.core.models import DBSession
+from nesis.api.core.services.util import (
+    save_document,
+    touch_document,
+    ConflictException,
+)
 from nesis.api.core.models import initialize_engine
 from nesis.api.core.models.entities import (
     Datasource,
@@ -22,6 +33,7 @@ from nesis.api.core.models.objects import (
     DatasourceType,
     DatasourceStatus,
 )
+from nesis.api.core.util import sharding
 from nesis.api.core.util.dateutil import strptime
 
 
@@ -49,9 +61,13 @@ def configure() -> None:
     services.init_services(tests.config)
 
 
+@pytest.mark.parametrize("fair_share", [False, True])
 @mock.patch("nesis.api.core.document_loaders.minio.Minio")
 def test_ingest_documents(
-    minio_instance: mock.MagicMock, cache: mock.MagicMock, session: Session
+    minio_instance: mock.MagicMock,
+    cache: mock.MagicMock,
+    session: Session,
+    fair_share: bool,
 ) -> None:
     data = {
         "name": "minio documents",
@@ -89,11 +105,15 @@ def test_ingest_documents(
 
     minio_client.list_objects.return_value = [bucket]
 
+    # The objects are processed either on the run's own work queue or on the workers shared by all datasources
+    config = copy.deepcopy(tests.config)
+    config["tasks"]["fair_share"] = {"enabled": fair_share, "workers": 4}
     minio_ingestor = minio.MinioProcessor(
-        config=tests.config,
+        config=config,
         http_client=http_client,
         cache_client=cache,
         datasource=datasource,
+        priority=2,
     )
 
     # No document records exist
@@ -125,6 +145,79 @@ def test_ingest_documents(
     assert 1 == len(document_records)
 
 
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_ingest_documents_batched(
+    minio_instance: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that with rag.batch enabled, small files are uploaded in batches to the bulk ingest endpoint
+    """
+    # Batching is opt-in, older rag services not serving the bulk endpoint
+    assert int(settings.default["rag"]["batch"]["max_files"]) <= 1
+
+    datasource = Datasource(
+        name="minio documents",
+        connection={
+            "endpoint": "https://s3.endpoint",
+            "access_key": "",
+            "secret_key": "",
+            "dataobjects": "buckets",
+        },
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+    session.add(datasource)
+    session.commit()
+
+    http_client = mock.MagicMock()
+    http_client.upload_batched.return_value = json.dumps({})
+    minio_client = mock.MagicMock()
+    minio_instance.return_value = minio_client
+
+    buckets = []
+    for object_name in ["SomeName", "OtherName"]:
+        bucket = mock.MagicMock()
+        type(bucket).etag = mock.PropertyMock(return_value=str(uuid.uuid4()))
+        type(bucket).bucket_name = mock.PropertyMock(return_value="SomeName")
+        type(bucket).object_name = mock.PropertyMock(return_value=object_name)
+        type(bucket).last_modified = mock.PropertyMock(
+            return_value=datetime.datetime.now()
+        )
+        type(bucket).size = mock.PropertyMock(return_value=1000)
+        type(bucket).version_id = mock.PropertyMock(return_value="2")
+        buckets.append(bucket)
+    minio_client.list_objects.return_value = buckets
+
+    config = copy.deepcopy(tests.config)
+    config["rag"]["batch"] = {
+        "max_files": 4,
+        "max_file_size": 2048,
+        "max_bytes": 8192,
+        "linger": 0.1,
+    }
+    minio_ingestor = minio.MinioProcessor(
+        config=config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+    minio_ingestor.run(metadata={"datasource": "documents"})
+
+    http_client.upload.assert_not_called()
+    assert http_client.upload_batched.call_count == 2
+    file_names = set()
+    for _, upload_kwargs in http_client.upload_batched.call_args_list:
+        assert upload_kwargs["url"] == "http://localhost:8080/v1/ingest/files/bulk"
+        assert upload_kwargs["field"] == "files"
+        assert upload_kwargs["size"] == 1000
+        assert upload_kwargs["max_files"] == 4
+        assert upload_kwargs["max_bytes"] == 8192
+        file_names.add(upload_kwargs["metadata"]["file_name"])
+    assert file_names == {"buckets/SomeName", "buckets/OtherName"}
+
+    assert len(session.query(Document).all()) == 2
+
+
 @mock.patch("nesis.api.core.document_loaders.minio.Minio")
 def test_extract_documents(
     minio_instance: mock.MagicMock, cache: mock.MagicMock, session: Session
@@ -218,6 +311,90 @@ def test_extract_documents(
         assert len(all_documents) == initial_count + 1
 
 
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_extract_documents_parquet(
+    minio_instance: mock.MagicMock, cache: mock.MagicMock, session: Session, tmp_path
+) -> None:
+    """
+    Test extracting documents to a parquet destination, one row per extracted element.
+    """
+    data = {
+        "name": "s3 documents",
+        "engine": "s3",
+        "connection": {
+            "endpoint": "https://s3.endpoint",
+            "dataobjects": "buckets",
+            "mode": "extract",
+            "destination": {
+                "parquet": {"path": str(tmp_path)},
+            },
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    http_client = mock.MagicMock()
+    http_client.upload.return_value = json.dumps(
+        {
+            "data": [
+                {"id_": "e1", "text": "first", "metadata": {}},
+                {"id_": "e2", "text": "second", "metadata": {}},
+            ]
+        }
+    )
+    minio_client = mock.MagicMock()
+    bucket = mock.MagicMock()
+
+    minio_instance.return_value = minio_client
+    type(bucket).etag = mock.PropertyMock(return_value=str(uuid.uuid4()))
+    type(bucket).bucket_name = mock.PropertyMock(return_value="SomeName")
+    type(bucket).object_name = mock.PropertyMock(return_value="SomeName")
+    type(bucket).last_modified = mock.PropertyMock(return_value=datetime.datetime.now())
+    type(bucket).size = mock.PropertyMock(return_value=1000)
+    type(bucket).version_id = mock.PropertyMock(return_value="2")
+
+    minio_client.list_objects.return_value = [bucket]
+
+    minio_ingestor = minio.MinioProcessor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+    minio_ingestor.run(
+        metadata={"datasource": "documents"},
+    )
+
+    extract_store = minio_ingestor._extract_runner._extraction_store
+    records = extract_store.get(base_uri="https://s3.endpoint")
+    assert [record.filename for record in records] == ["SomeName"]
+
+    import pyarrow.dataset as ds
+
+    table = ds.dataset(str(tmp_path), format="parquet", partitioning="hive").to_table()
+    assert sorted(table.column("text").to_pylist()) == ["first", "second"]
+    assert set(table.column("datasource_id").to_pylist()) == {datasource.uuid}
+
+    # The unchanged object is not extracted again on the next run
+    minio.MinioProcessor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    ).run(
+        metadata={"datasource": "documents"},
+    )
+    assert http_client.upload.call_count == 1
+
+
 @mock.patch("nesis.api.core.document_loaders.minio.Minio")
 def test_uningest_documents(
     client: mock.MagicMock, cache: mock.MagicMock, session: Session
@@ -279,13 +456,11 @@ def test_uningest_documents(
         metadata={"datasource": "documents"},
     )
 
-    _, upload_kwargs = http_client.deletes.call_args_list[0]
-    urls = upload_kwargs["urls"]
-
-    assert (
-        urls[0]
-        == f"http://localhost:8080/v1/ingest/documents/{document.rag_metadata['data'][0]['doc_id']}"
-    )
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
+    ]
     documents = session.query(Document).all()
     assert len(documents) == 0
 
@@ -455,13 +630,11 @@ def test_update_ingest_documents(
     )
 
     # The document would be deleted from the rag engine
-    _, deletes_kwargs = http_client.deletes.call_args_list[0]
-    urls = deletes_kwargs["urls"]
-
-    assert (
-        urls[0]
-        == f"http://localhost:8080/v1/ingest/documents/{document.rag_metadata['data'][0]['doc_id']}"
-    )
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
+    ]
     documents = session.query(Document).all()
     assert len(documents) == 1
     assert document.id != documents[0].id
@@ -488,3 +661,817 @@ def test_update_ingest_documents(
     documents = session.query(Document).all()
     assert len(documents) == 1
     assert documents[0].last_modified == last_modified
+
+
+@mock.patch("nesis.api.core.document_loaders.runners.get_document")
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_sync_unchanged_documents(
+    client: mock.MagicMock,
+    get_document: mock.MagicMock,
+    cache: mock.MagicMock,
+    session: Session,
+) -> None:
+    """
+    Test that unchanged documents are resolved from the prefetched document index, without a query per object,
+    and are not downloaded.
+    """
+
+    data = {
+        "name": "s3 documents",
+        "engine": "minio",
+        "connection": {
+            "endpoint": "http://localhost:4566",
+            "region": "us-east-1",
+            "dataobjects": "my-test-bucket",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    self_link = "http://localhost:4566/my-test-bucket/SomeName"
+    last_modified = strptime("2023-07-19 06:40:07")
+
+    document = Document(
+        base_uri="http://localhost:4566",
+        document_id=str(
+            uuid.uuid5(
+                uuid.NAMESPACE_DNS,
+                f"{datasource.uuid}:{self_link}",
+            )
+        ),
+        filename="SomeName",
+        rag_metadata={"data": [{"doc_id": str(uuid.uuid4())}]},
+        store_metadata={
+            "bucket_name": "my-test-bucket",
+            "object_name": "SomeName",
+            "last_modified": "2023-07-19 06:40:07",
+        },
+        last_modified=last_modified,
+        datasource_id=datasource.uuid,
+    )
+
+    session.add(document)
+    session.commit()
+
+    http_client = mock.MagicMock()
+    minio_client = mock.MagicMock()
+    bucket = mock.MagicMock()
+
+    client.return_value = minio_client
+    type(bucket).bucket_name = mock.PropertyMock(return_value="my-test-bucket")
+    type(bucket).object_name = mock.PropertyMock(return_value="SomeName")
+    type(bucket).last_modified = mock.PropertyMock(return_value=last_modified)
+    type(bucket).size = mock.PropertyMock(return_value=1000)
+    type(bucket).version_id = mock.PropertyMock(return_value="2")
+
+    minio_client.list_objects.return_value = [bucket]
+
+    minio_ingestor = minio.MinioProcessor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+
+    minio_ingestor.run(
+        metadata={"datasource": "documents"},
+    )
+
+    get_document.assert_not_called()
+    minio_client.fget_object.assert_not_called()
+    http_client.upload.assert_not_called()
+    http_client.post.assert_not_called()
+
+    documents = session.query(Document).all()
+    assert len(documents) == 1
+    assert documents[0].id == document.id
+
+
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_unsync_documents_from_listing(
+    client: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that, after a complete listing, deleted objects are found without probing the bucket for every document.
+    """
+    data = {
+        "name": "s3 documents",
+        "engine": "minio",
+        "connection": {
+            "endpoint": "http://localhost:4566",
+            "dataobjects": "my-test-bucket",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    documents = []
+    for object_name in ["listed.pdf", "deleted.pdf"]:
+        self_link = f"http://localhost:4566/my-test-bucket/{object_name}"
+        documents.append(
+            Document(
+                base_uri="http://localhost:4566",
+                document_id=str(
+                    uuid.uuid5(uuid.NAMESPACE_DNS, f"{datasource.uuid}:{self_link}")
+                ),
+                filename=object_name,
+                rag_metadata={"data": [{"doc_id": str(uuid.uuid4())}]},
+                store_metadata={
+                    "bucket_name": "my-test-bucket",
+                    "object_name": object_name,
+                    "last_modified": "2023-07-19 06:40:07",
+                },
+                last_modified=strptime("2023-07-19 06:40:07"),
+                datasource_id=datasource.uuid,
+            )
+        )
+    session.add_all(documents)
+    session.commit()
+
+    http_client = mock.MagicMock()
+    minio_client = mock.MagicMock()
+    bucket = mock.MagicMock()
+
+    client.return_value = minio_client
+    type(bucket).bucket_name = mock.PropertyMock(return_value="my-test-bucket")
+    type(bucket).object_name = mock.PropertyMock(return_value="listed.pdf")
+    type(bucket).last_modified = mock.PropertyMock(
+        return_value=strptime("2023-07-19 06:40:07")
+    )
+    type(bucket).size = mock.PropertyMock(return_value=1000)
+    type(bucket).version_id = mock.PropertyMock(return_value=None)
+    type(bucket).etag = mock.PropertyMock(return_value=None)
+    minio_client.list_objects.return_value = [bucket]
+
+    minio_ingestor = minio.MinioProcessor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+
+    minio_ingestor.run(
+        metadata={"datasource": "documents"},
+    )
+
+    minio_client.stat_object.assert_not_called()
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        documents[1].rag_metadata["data"][0]["doc_id"]
+    ]
+    remaining = session.query(Document).all()
+    assert [document.filename for document in remaining] == ["listed.pdf"]
+
+
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_unsync_documents_partial_listing(
+    client: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that we fall back to probing the bucket when the listing did not complete.
+    """
+    data = {
+        "name": "s3 documents",
+        "engine": "minio",
+        "connection": {
+            "endpoint": "http://localhost:4566",
+            "dataobjects": "my-test-bucket",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    self_link = "http://localhost:4566/my-test-bucket/existing.pdf"
+    document = Document(
+        base_uri="http://localhost:4566",
+        document_id=str(
+            uuid.uuid5(uuid.NAMESPACE_DNS, f"{datasource.uuid}:{self_link}")
+        ),
+        filename="existing.pdf",
+        rag_metadata={"data": [{"doc_id": str(uuid.uuid4())}]},
+        store_metadata={
+            "bucket_name": "my-test-bucket",
+            "object_name": "existing.pdf",
+        },
+        last_modified=strptime("2023-07-19 06:40:07"),
+        datasource_id=datasource.uuid,
+    )
+    session.add(document)
+    session.commit()
+
+    http_client = mock.MagicMock()
+    minio_client = mock.MagicMock()
+    client.return_value = minio_client
+    minio_client.list_objects.side_effect = Exception("Access denied")
+
+    minio_ingestor = minio.MinioProcessor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+
+    minio_ingestor.run(
+        metadata={"datasource": "documents"},
+    )
+
+    minio_client.stat_object.assert_called_once_with(
+        bucket_name="my-test-bucket", object_name="existing.pdf"
+    )
+    http_client.post.assert_not_called()
+    assert len(session.query(Document).all()) == 1
+
+
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_ingest_documents_cancelled(
+    client: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that a stopped run processes no more objects, skips the unsync and checkpoints the bucket so that the next
+    run resumes after the last processed object.
+    """
+    datasource = Datasource(
+        name="minio documents",
+        connection={
+            "endpoint": "http://localhost:4566",
+            "dataobjects": "my-test-bucket",
+            "max_in_flight": 1,
+        },
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+    session.add(datasource)
+    session.commit()
+
+    self_link = "http://localhost:4566/my-test-bucket/deleted.pdf"
+    session.add(
+        Document(
+            base_uri="http://localhost:4566",
+            document_id=str(
+                uuid.uuid5(uuid.NAMESPACE_DNS, f"{datasource.uuid}:{self_link}")
+            ),
+            filename="deleted.pdf",
+            rag_metadata={"data": [{"doc_id": str(uuid.uuid4())}]},
+            store_metadata={
+                "bucket_name": "my-test-bucket",
+                "object_name": "deleted.pdf",
+            },
+            last_modified=strptime("2023-07-19 06:40:07"),
+            datasource_id=datasource.uuid,
+        )
+    )
+    session.commit()
+
+    items = []
+    for object_name in ["a.pdf", "b.pdf", "c.pdf"]:
+        item = mock.MagicMock()
+        item.bucket_name = "my-test-bucket"
+        item.object_name = object_name
+        item.last_modified = datetime.datetime(2024, 1, 1, 10, 0, 0)
+        item.size = 1000
+        item.etag = str(uuid.uuid4())
+        item.version_id = "1"
+        items.append(item)
+
+    minio_client = mock.MagicMock()
+    client.return_value = minio_client
+    minio_client.list_objects.return_value = items
+
+    config = copy.deepcopy(tests.config)
+    config["tasks"]["fair_share"] = {"enabled": False}
+    checkpoint = TaskCheckpoint()
+    cancellation = TaskCancellation()
+    http_client = mock.MagicMock()
+
+    def upload(**kwargs):
+        # The run is stopped while the first object is uploaded
+        cancellation.cancel()
+        return json.dumps({})
+
+    http_client.upload.side_effect = upload
+
+    minio.MinioProcessor(
+        config=config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+        checkpoint=checkpoint,
+        cancellation=cancellation,
+    ).run(metadata={"datasource": "documents"})
+
+    assert http_client.upload.call_count == 1
+    assert checkpoint.get("my-test-bucket") == {"start_after": "a.pdf"}
+    minio_client.stat_object.assert_not_called()
+    http_client.delete.assert_not_called()
+
+    # The next run resumes after the checkpoint
+    http_client.upload.side_effect = None
+    http_client.upload.return_value = json.dumps({})
+    minio_client.list_objects.return_value = items[1:]
+    minio.MinioProcessor(
+        config=config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+        checkpoint=checkpoint,
+    ).run(metadata={"datasource": "documents"})
+
+    _, list_kwargs = minio_client.list_objects.call_args
+    assert list_kwargs["start_after"] == "a.pdf"
+    assert http_client.upload.call_count == 3
+    assert checkpoint.get("my-test-bucket") is None
+
+
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_process_events(
+    client: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that bucket notifications sync only the objects they reference.
+    """
+    data = {
+        "name": "s3 documents",
+        "engine": "minio",
+        "connection": {
+            "endpoint": "http://localhost:4566",
+            "dataobjects": "my-test-bucket",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    self_link = "http://localhost:4566/my-test-bucket/deleted file.pdf"
+    document = Document(
+        base_uri="http://localhost:4566",
+        document_id=str(
+            uuid.uuid5(uuid.NAMESPACE_DNS, f"{datasource.uuid}:{self_link}")
+        ),
+        filename="deleted file.pdf",
+        rag_metadata={"data": [{"doc_id": str(uuid.uuid4())}]},
+        store_metadata={
+            "bucket_name": "my-test-bucket",
+            "object_name": "deleted file.pdf",
+            "last_modified": "2023-07-19 06:40:07",
+        },
+        last_modified=strptime("2023-07-19 06:40:07"),
+        datasource_id=datasource.uuid,
+    )
+    session.add(document)
+    session.commit()
+
+    http_client = mock.MagicMock()
+    http_client.upload.return_value = json.dumps({})
+    minio_client = mock.MagicMock()
+    item = mock.MagicMock()
+
+    client.return_value = minio_client
+    type(item).bucket_name = mock.PropertyMock(return_value="my-test-bucket")
+    type(item).object_name = mock.PropertyMock(return_value="new.pdf")
+    type(item).last_modified = mock.PropertyMock(
+        return_value=strptime("2023-07-20 06:40:07")
+    )
+    type(item).size = mock.PropertyMock(return_value=1000)
+    type(item).version_id = mock.PropertyMock(return_value=None)
+    type(item).etag = mock.PropertyMock(return_value="etag")
+    minio_client.stat_object.return_value = item
+
+    minio_ingestor = minio.MinioProcessor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+
+    # The objects are looked up one by one, the datasource's documents are not streamed
+    with mock.patch(
+        "nesis.api.core.document_loaders.index.stream_documents"
+    ) as stream_documents:
+        minio_ingestor.process_events(
+            records=[
+                {
+                    "eventName": "s3:ObjectCreated:Put",
+                    "s3": {
+                        "bucket": {"name": "my-test-bucket"},
+                        "object": {"key": "new.pdf"},
+                    },
+                },
+                {
+                    "eventName": "s3:ObjectRemoved:Delete",
+                    "s3": {
+                        "bucket": {"name": "my-test-bucket"},
+                        "object": {"key": "deleted+file.pdf"},
+                    },
+                },
+                {
+                    "eventName": "s3:ObjectCreated:Put",
+                    "s3": {
+                        "bucket": {"name": "other-bucket"},
+                        "object": {"key": "other.pdf"},
+                    },
+                },
+            ],
+            metadata={"datasource": "documents"},
+        )
+    stream_documents.assert_not_called()
+
+    minio_client.list_objects.assert_not_called()
+    minio_client.stat_object.assert_called_once_with(
+        bucket_name="my-test-bucket", object_name="new.pdf"
+    )
+    _, upload_kwargs = http_client.upload.call_args_list[0]
+    assert upload_kwargs["filepath"] == "new.pdf"
+    assert http_client.upload.call_count == 1
+
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
+    ]
+    remaining = session.query(Document).all()
+    assert [document.filename for document in remaining] == ["new.pdf"]
+
+
+@mock.patch("nesis.api.core.util.sharding.membership")
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_ingest_documents_sharded(
+    minio_instance: mock.MagicMock,
+    membership: mock.MagicMock,
+    cache: mock.MagicMock,
+    session: Session,
+) -> None:
+    """
+    Test that two replicas split the objects of a datasource between them and that neither unsyncs the other's
+    documents
+    """
+    data = {
+        "name": "minio documents",
+        "engine": "minio",
+        "connection": {
+            "endpoint": "https://s3.endpoint",
+            "access_key": "",
+            "secret_key": "",
+            "dataobjects": "buckets",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    items = []
+    for idx in range(20):
+        item = mock.MagicMock()
+        type(item).etag = mock.PropertyMock(return_value=str(uuid.uuid4()))
+        type(item).bucket_name = mock.PropertyMock(return_value="buckets")
+        type(item).object_name = mock.PropertyMock(return_value=f"file-{idx}.pdf")
+        type(item).last_modified = mock.PropertyMock(
+            return_value=datetime.datetime.now()
+        )
+        type(item).size = mock.PropertyMock(return_value=1000)
+        type(item).version_id = mock.PropertyMock(return_value="2")
+        items.append(item)
+    minio_client = mock.MagicMock()
+    minio_client.list_objects.return_value = items
+    minio_instance.return_value = minio_client
+
+    cache_client = memcache.Client(tests.config["memcache"]["hosts"])
+    replicas = [
+        sharding.ShardMembership(cache_client=cache_client, member_id=member_id)
+        for member_id in ["replica-a", "replica-b"]
+    ]
+    uploaded = {}
+    try:
+        for replica in replicas:
+            replica.join()
+        for replica in replicas:
+            membership.return_value = replica
+            http_client = mock.MagicMock()
+            http_client.upload.return_value = json.dumps({})
+
+            minio.MinioProcessor(
+                config=tests.config,
+                http_client=http_client,
+                cache_client=cache,
+                datasource=datasource,
+            ).run(metadata={"datasource": "documents"})
+
+            uploaded[replica.member_id] = {
+                upload_kwargs["metadata"]["self_link"]
+                for _, upload_kwargs in http_client.upload.call_args_list
+            }
+    finally:
+        for replica in replicas:
+            replica.leave()
+
+    ring = sharding.HashRing(members=["replica-a", "replica-b"])
+    for member_id, self_links in uploaded.items():
+        assert self_links == {
+            f"https://s3.endpoint/buckets/file-{idx}.pdf"
+            for idx in range(20)
+            if ring.owner(
+                str(
+                    uuid.uuid5(
+                        uuid.NAMESPACE_DNS,
+                        f"{datasource.uuid}:https://s3.endpoint/buckets/file-{idx}.pdf",
+                    )
+                )
+            )
+            == member_id
+        }
+    assert len(uploaded["replica-a"] | uploaded["replica-b"]) == 20
+
+    # Neither replica unsynced the documents of the other
+    assert 20 == len(session.query(Document).all())
+
+
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_ingest_documents_content_unchanged(
+    minio_instance: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that an object whose timestamp changed but whose content did not is not re-ingested
+    """
+    data = {
+        "name": "minio documents",
+        "engine": "minio",
+        "connection": {
+            "endpoint": "https://s3.endpoint",
+            "access_key": "",
+            "secret_key": "",
+            "dataobjects": "buckets",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    content = {"body": b"some content"}
+    minio_client = mock.MagicMock()
+    minio_client.get_object.side_effect = lambda **kwargs: io.BytesIO(content["body"])
+    minio_instance.return_value = minio_client
+
+    def list_objects(last_modified):
+        item = mock.MagicMock()
+        type(item).etag = mock.PropertyMock(return_value=str(uuid.uuid4()))
+        type(item).bucket_name = mock.PropertyMock(return_value="buckets")
+        type(item).object_name = mock.PropertyMock(return_value="file.pdf")
+        type(item).last_modified = mock.PropertyMock(return_value=last_modified)
+        type(item).size = mock.PropertyMock(return_value=len(content["body"]))
+        type(item).version_id = mock.PropertyMock(return_value="2")
+        minio_client.list_objects.return_value = [item]
+
+    def upload(**kwargs):
+        kwargs["stream"]().read()
+        return json.dumps({"data": [{"doc_id": str(uuid.uuid4())}]})
+
+    processors = []
+
+    def run() -> mock.MagicMock:
+        http_client = mock.MagicMock()
+        http_client.upload.side_effect = upload
+        processors.append(
+            minio.MinioProcessor(
+                config=tests.config,
+                http_client=http_client,
+                cache_client=cache,
+                datasource=datasource,
+            )
+        )
+        processors[-1].run(metadata={"datasource": "documents"})
+        return http_client
+
+    first_modified = datetime.datetime(2024, 1, 1, 10, 0, 0)
+    list_objects(first_modified)
+    http_client = run()
+    assert http_client.upload.call_count == 1
+    document = session.query(Document).one()
+    content_hash = document.store_metadata["content_hash"]
+    assert content_hash is not None
+
+    # Only the timestamp changed
+    second_modified = datetime.datetime(2024, 1, 2, 10, 0, 0)
+    list_objects(second_modified)
+    http_client = run()
+    http_client.upload.assert_not_called()
+    http_client.post.assert_not_called()
+    session.expire_all()
+    document = session.query(Document).one()
+    assert document.last_modified == second_modified
+    assert document.store_metadata["content_hash"] == content_hash
+    # The run's index sees the touched record
+    indexed = processors[-1]._documents.get(document_id=document.uuid)
+    assert indexed.last_modified == second_modified
+
+    # A worker whose lock was taken over does not touch the record
+    with pytest.raises(ConflictException):
+        touch_document(
+            document_id=document.uuid,
+            store_metadata={
+                **document.store_metadata,
+                "lock_token": document.store_metadata["lock_token"] - 1,
+            },
+            last_modified=datetime.datetime(2024, 1, 5, 10, 0, 0),
+        )
+    session.expire_all()
+    assert session.query(Document).one().last_modified == second_modified
+
+    # The content changed
+    content["body"] = b"some other content"
+    list_objects(datetime.datetime(2024, 1, 3, 10, 0, 0))
+    http_client = run()
+    assert http_client.upload.call_count == 1
+    _, post_kwargs = http_client.post.call_args
+    assert post_kwargs["url"].endswith("/v1/ingest/documents/delete")
+    session.expire_all()
+    document = session.query(Document).one()
+    assert document.store_metadata["content_hash"] != content_hash
+
+
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_update_ingest_documents_taken_over(
+    client: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that a file whose record was saved under a newer lock than this worker's is left to its new owner
+    """
+    datasource = Datasource(
+        name="s3 documents",
+        connection={
+            "endpoint": "http://localhost:4566",
+            "region": "us-east-1",
+            "dataobjects": "my-test-bucket",
+        },
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+    session.add(datasource)
+    session.commit()
+
+    self_link = "http://localhost:4566/my-test-bucket/SomeName"
+    document_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{datasource.uuid}:{self_link}"))
+    newer_token = 2**62
+    document = Document(
+        base_uri="http://localhost:4566",
+        document_id=document_id,
+        filename="SomeName",
+        rag_metadata={"data": [{"doc_id": str(uuid.uuid4())}]},
+        store_metadata={
+            "bucket_name": "my-test-bucket",
+            "object_name": "SomeName",
+            "last_modified": "2023-07-18 06:40:07",
+            "lock_token": newer_token,
+        },
+        last_modified=strptime("2023-07-19 06:40:07"),
+        datasource_id=datasource.uuid,
+    )
+    session.add(document)
+    session.commit()
+
+    http_client = mock.MagicMock()
+    http_client.upload.return_value = json.dumps({})
+    minio_client = mock.MagicMock()
+    client.return_value = minio_client
+    bucket = mock.MagicMock()
+    type(bucket).etag = mock.PropertyMock(return_value="etag")
+    type(bucket).bucket_name = mock.PropertyMock(return_value="my-test-bucket")
+    type(bucket).object_name = mock.PropertyMock(return_value="SomeName")
+    type(bucket).last_modified = mock.PropertyMock(return_value=datetime.datetime.now())
+    type(bucket).size = mock.PropertyMock(return_value=1000)
+    type(bucket).version_id = mock.PropertyMock(return_value="2")
+    minio_client.list_objects.return_value = [bucket]
+
+    minio_ingestor = minio.MinioProcessor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+    minio_ingestor.run(metadata={"datasource": "documents"})
+
+    # Neither deleted nor re-ingested
+    http_client.post.assert_not_called()
+    http_client.upload.assert_not_called()
+    documents = session.query(Document).all()
+    assert [document.id for document in documents] == [document.id]
+
+    # Nor saved over
+    with pytest.raises(ConflictException):
+        save_document(
+            document_id=document_id,
+            filename="SomeName",
+            rag_metadata={"data": []},
+            store_metadata={"lock_token": newer_token - 1},
+            base_uri="http://localhost:4566",
+            last_modified=datetime.datetime.now(),
+            datasource_id=datasource.uuid,
+        )
+
+
+@mock.patch("nesis.api.core.document_loaders.minio.Minio")
+def test_ingest_documents_sharded_with_workers(
+    minio_instance: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that a worker syncs all the objects of the run it took, even with sharding enabled and other replicas
+    on the ring
+    """
+    datasource = Datasource(
+        name="minio documents",
+        connection={
+            "endpoint": "https://s3.endpoint",
+            "access_key": "",
+            "secret_key": "",
+            "dataobjects": "buckets",
+        },
+        source_type=DatasourceType.MINIO,
+        status=DatasourceStatus.ONLINE,
+    )
+    session.add(datasource)
+    session.commit()
+
+    items = []
+    for idx in range(20):
+        item = mock.MagicMock()
+        type(item).etag = mock.PropertyMock(return_value=str(uuid.uuid4()))
+        type(item).bucket_name = mock.PropertyMock(return_value="buckets")
+        type(item).object_name = mock.PropertyMock(return_value=f"file-{idx}.pdf")
+        type(item).last_modified = mock.PropertyMock(
+            return_value=datetime.datetime.now()
+        )
+        type(item).size = mock.PropertyMock(return_value=1000)
+        type(item).version_id = mock.PropertyMock(return_value="2")
+        items.append(item)
+    minio_client = mock.MagicMock()
+    minio_client.list_objects.return_value = items
+    minio_instance.return_value = minio_client
+
+    config = copy.deepcopy(tests.config)
+    config["tasks"]["sharding"] = {"enabled": True}
+    config["tasks"]["worker"] = {"enabled": True}
+    assert sharding.membership(config) is None
+
+    other_replica = sharding.ShardMembership(
+        cache_client=memcache.Client(tests.config["memcache"]["hosts"]),
+        member_id="replica-b",
+    )
+    http_client = mock.MagicMock()
+    http_client.upload.return_value = json.dumps({})
+    try:
+        other_replica.join()
+        minio.MinioProcessor(
+            config=config,
+            http_client=http_client,
+            cache_client=cache,
+            datasource=datasource,
+        ).run(metadata={"datasource": "documents"})
+    finally:
+        other_replica.leave()
+
+    assert http_client.upload.call_count == 20
+    assert 20 == len(session.query(Document).all())
@@ -16,14 +16,17 @@ from nesis.api import tests
 from nesis.api.core.document_loaders.stores import SqlDocumentStore
 from nesis.api.core.models import DBSession
 from nesis.api.core.models import initialize_engine
+from nesis.api.core.document_loaders.checkpoint import TaskCheckpoint
 from nesis.api.core.models.entities import (
     Datasource,
     Document,
+    Task,
 )
 
 from nesis.api.core.models.objects import (
     DatasourceType,
     DatasourceStatus,
+    TaskType,
 )
 from nesis.api.core.util import http
 from nesis.api.core.util.dateutil import strptime
@@ -230,11 +233,10 @@ def test_update_sync_documents(
     )
 
     # The document would be deleted from the rag engine
-    _, deletes_kwargs = http_client.deletes.call_args_list[0]
-    url = deletes_kwargs["urls"]
-
-    assert url == [
-        f"http://localhost:8080/v1/ingest/documents/{document.rag_metadata['data'][0]['doc_id']}"
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
     ]
 
     # And then re-ingested
@@ -263,6 +265,109 @@ def test_update_sync_documents(
     assert str(documents[0].last_modified) == "2023-07-20 06:40:07"
 
 
+@mock.patch("nesis.api.core.document_loaders.s3.boto3.client")
+def test_sync_unchanged_documents(
+    client: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that objects whose listing metadata matches the stored metadata are not downloaded.
+    """
+    data = {
+        "name": "s3 documents",
+        "engine": "s3",
+        "connection": {
+            "endpoint": "http://localhost:4566",
+            "region": "us-east-1",
+            "dataobjects": "some-bucket",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.S3,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    self_link = "http://localhost:4566/some-bucket/unchanged.pdf"
+
+    document = Document(
+        base_uri="http://localhost:4566",
+        document_id=str(
+            uuid.uuid5(
+                uuid.NAMESPACE_DNS,
+                f"{datasource.uuid}:{self_link}",
+            )
+        ),
+        filename="unchanged.pdf",
+        rag_metadata={"data": [{"doc_id": str(uuid.uuid4())}]},
+        store_metadata={
+            "bucket_name": "some-bucket",
+            "object_name": "unchanged.pdf",
+            "size": 10,
+            "etag": "d41d8cd98f00b204e9800998ecf8427e",
+            "last_modified": "2023-07-18 06:40:07",
+        },
+        last_modified=strptime("2023-07-18 06:40:07"),
+        datasource_id=datasource.uuid,
+    )
+
+    session.add(document)
+    session.commit()
+
+    http_client = mock.MagicMock()
+    s3_client = mock.MagicMock()
+
+    client.return_value = s3_client
+    paginator = mock.MagicMock()
+    paginator.paginate.return_value = [
+        {
+            "KeyCount": 2,
+            "Contents": [
+                {
+                    "Key": "unchanged.pdf",
+                    "LastModified": strptime("2023-07-18 06:40:07"),
+                    "ETag": "d41d8cd98f00b204e9800998ecf8427e",
+                    "Size": 10,
+                },
+                {
+                    "Key": "new.pdf",
+                    "LastModified": strptime("2023-07-18 06:40:07"),
+                    "ETag": "d41d8cd98f00b204e9800998ecf8427e",
+                    "Size": 12,
+                },
+            ],
+        }
+    ]
+    s3_client.get_paginator.return_value = paginator
+    http_client.upload.return_value = json.dumps({})
+
+    ingestor = s3.Processor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+
+    ingestor.run(
+        metadata={"datasource": "documents"},
+    )
+
+    # Only the new object is uploaded
+    assert http_client.upload.call_count == 1
+    _, upload_kwargs = http_client.upload.call_args_list[0]
+    assert upload_kwargs["filepath"] == "new.pdf"
+
+    # The object body is streamed from the bucket instead of being downloaded to a file
+    s3_client.download_file.assert_not_called()
+    upload_kwargs["stream"]()
+    s3_client.get_object.assert_called_once_with(Bucket="some-bucket", Key="new.pdf")
+    http_client.post.assert_not_called()
+
+
 @mock.patch("nesis.api.core.document_loaders.s3.boto3.client")
 def test_unsync_s3_documents(
     client: mock.MagicMock, cache: mock.MagicMock, session: Session
@@ -323,13 +428,11 @@ def test_unsync_s3_documents(
         metadata={"datasource": "documents"},
     )
 
-    _, upload_kwargs = http_client.deletes.call_args_list[0]
-    urls = upload_kwargs["urls"]
-
-    assert (
-        urls[0]
-        == f"http://localhost:8080/v1/ingest/documents/{document.rag_metadata['data'][0]['doc_id']}"
-    )
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
+    ]
     documents = session.query(Document).all()
     assert len(documents) == 0
 
@@ -518,3 +621,153 @@ def test_unextract_documents(
             minio_ingestor._extract_runner._extraction_store.Store
         ).all()
         assert len(documents) == initial_count - 1
+
+
+def _s3_object(key: str) -> dict:
+    return {
+        "Key": key,
+        "LastModified": strptime("2023-07-18 06:40:07"),
+        "ETag": '"d41d8cd98f00b204e9800998ecf8427e"',
+        "Size": 10,
+    }
+
+
+@mock.patch("nesis.api.core.document_loaders.s3.boto3.client")
+def test_sync_documents_resume_checkpoint(
+    client: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that an interrupted listing resumes after the checkpoint saved on the task and clears it once complete.
+    """
+    data = {
+        "name": "s3 documents",
+        "engine": "s3",
+        "connection": {
+            "endpoint": "http://localhost:4566",
+            "region": "us-east-1",
+            "dataobjects": "some-bucket",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.S3,
+        status=DatasourceStatus.ONLINE,
+    )
+    session.add(datasource)
+    session.commit()
+
+    task = Task(
+        task_type=TaskType.INGEST_DATASOURCE,
+        schedule="",
+        definition={"datasource": {"id": datasource.uuid}},
+        parent_id=datasource.uuid,
+    )
+    task.checkpoint = {"some-bucket/": {"start_after": "b.pdf"}}
+    session.add(task)
+    session.commit()
+    task_uuid = task.uuid
+
+    http_client = mock.MagicMock()
+    http_client.upload.return_value = json.dumps({})
+    s3_client = mock.MagicMock()
+    client.return_value = s3_client
+    paginator = mock.MagicMock()
+    paginator.paginate.return_value = [
+        {"KeyCount": 1, "Contents": [_s3_object("c.pdf")]},
+        {"KeyCount": 1, "Contents": [_s3_object("d.pdf")]},
+    ]
+    s3_client.get_paginator.return_value = paginator
+
+    ingestor = s3.Processor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+        checkpoint=TaskCheckpoint(task_id=task_uuid),
+    )
+    ingestor.run(
+        metadata={"datasource": "documents"},
+    )
+
+    paginator.paginate.assert_called_once_with(
+        Bucket="some-bucket", Prefix="", StartAfter="b.pdf"
+    )
+    assert http_client.upload.call_count == 2
+
+    task = DBSession().query(Task).filter(Task.uuid == task_uuid).first()
+    assert task.checkpoint == {}
+
+
+@mock.patch("nesis.api.core.document_loaders.s3.boto3.client")
+def test_sync_documents_split_prefixes(
+    client: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that a bucket is listed in parallel by its top level prefixes.
+    """
+    data = {
+        "name": "s3 documents",
+        "engine": "s3",
+        "connection": {
+            "endpoint": "http://localhost:4566",
+            "region": "us-east-1",
+            "dataobjects": "some-bucket",
+            "split_prefixes": "true",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.S3,
+        status=DatasourceStatus.ONLINE,
+    )
+    session.add(datasource)
+    session.commit()
+
+    pages = {
+        "": [
+            {
+                "KeyCount": 3,
+                "Contents": [_s3_object("root.pdf")],
+                "CommonPrefixes": [{"Prefix": "a/"}, {"Prefix": "b/"}],
+            }
+        ],
+        "a/": [{"KeyCount": 1, "Contents": [_s3_object("a/one.pdf")]}],
+        "b/": [{"KeyCount": 1, "Contents": [_s3_object("b/two.pdf")]}],
+    }
+
+    http_client = mock.MagicMock()
+    http_client.upload.return_value = json.dumps({})
+    s3_client = mock.MagicMock()
+    client.return_value = s3_client
+    paginator = mock.MagicMock()
+    paginator.paginate.side_effect = lambda **kwargs: pages[kwargs["Prefix"]]
+    s3_client.get_paginator.return_value = paginator
+
+    ingestor = s3.Processor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+    ingestor.run(
+        metadata={"datasource": "documents"},
+    )
+
+    paginator.paginate.assert_has_calls(
+        [
+            mock.call(Bucket="some-bucket", Prefix="", Delimiter="/"),
+            mock.call(Bucket="some-bucket", Prefix="a/"),
+            mock.call(Bucket="some-bucket", Prefix="b/"),
+        ],
+        any_order=True,
+    )
+    uploaded = sorted(
+        upload_kwargs["filepath"]
+        for _, upload_kwargs in http_client.upload.call_args_list
+    )
+    assert uploaded == ["a/one.pdf", "b/two.pdf", "root.pdf"]
+    assert len(session.query(Document).all()) == 3
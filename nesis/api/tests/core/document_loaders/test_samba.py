@@ -1,6 +1,7 @@
 import datetime
 import json
 import os
+import pathlib
 import time
 import unittest as ut
 import unittest.mock as mock
@@ -82,7 +83,7 @@ def test_ingest(shutil, stat, scandir, cache: mock.MagicMock, session: Session)
     scandir.return_value = [share]
 
     file_stat = mock.MagicMock()
-    stat.return_value = file_stat
+    share.stat.return_value = file_stat
     type(file_stat).st_size = mock.PropertyMock(return_value=1)
     type(file_stat).st_chgtime = mock.PropertyMock(return_value=time.time())
 
@@ -108,6 +109,8 @@ def test_ingest(shutil, stat, scandir, cache: mock.MagicMock, session: Session)
     assert url == f"http://localhost:8080/v1/ingest/files"
     assert file_path.endswith("SomeName")
     assert field == "file"
+    # The file's folder and the run's work folder are removed
+    assert not pathlib.Path(file_path).parent.parent.exists()
     ut.TestCase().assertDictEqual(
         metadata,
         {
@@ -184,13 +187,11 @@ def test_uningest(
         metadata={"datasource": "documents"},
     )
 
-    _, upload_kwargs = http_client.deletes.call_args_list[0]
-    urls = upload_kwargs["urls"]
-
-    assert (
-        urls[0]
-        == f"http://localhost:8080/v1/ingest/documents/{document.rag_metadata['data'][0]['doc_id']}"
-    )
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
+    ]
     documents = session.query(Document).all()
     assert len(documents) == 0
 
@@ -258,7 +259,7 @@ def test_update(shutil, stat, scandir, cache: mock.MagicMock, session: Session)
     scandir.return_value = [share]
 
     file_stat = mock.MagicMock()
-    stat.return_value = file_stat
+    share.stat.return_value = file_stat
     type(file_stat).st_size = mock.PropertyMock(return_value=1)
     type(file_stat).st_chgtime = mock.PropertyMock(
         return_value=strptime("2023-07-20 06:40:07").timestamp()
@@ -278,11 +279,10 @@ def test_update(shutil, stat, scandir, cache: mock.MagicMock, session: Session)
     )
 
     # The document would be deleted from the rag engine
-    _, deletes_kwargs = http_client.deletes.call_args_list[0]
-    url = deletes_kwargs["urls"]
-
-    assert url == [
-        f"http://localhost:8080/v1/ingest/documents/{document.rag_metadata['data'][0]['doc_id']}"
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
     ]
 
     # And then re-ingested
@@ -293,3 +293,83 @@ def test_update(shutil, stat, scandir, cache: mock.MagicMock, session: Session)
     assert len(documents) == 1
     assert documents[0].store_metadata["last_modified"] == "2023-07-20 06:40:07"
     assert str(documents[0].last_modified) == "2023-07-20 06:40:07"
+
+
+@mock.patch("nesis.api.core.document_loaders.samba.scandir")
+@mock.patch("nesis.api.core.document_loaders.samba.stat")
+@mock.patch("nesis.api.core.document_loaders.samba.shutil")
+def test_ingest_nested_directories(
+    shutil, stat, scandir, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that subdirectories are walked and that the stats from the directory listing are used.
+    """
+    data = {
+        "name": "samba documents",
+        "engine": "windows_share",
+        "connection": {
+            "endpoint": r"\\Share",
+            "user": "user",
+            "port": "445",
+            "password": "password",
+            "dataobjects": "folder",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.WINDOWS_SHARE,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    def entry(path: str, is_dir: bool) -> mock.MagicMock:
+        dir_entry = mock.MagicMock()
+        dir_entry.is_dir.return_value = is_dir
+        type(dir_entry).name = mock.PropertyMock(return_value=path.split("\\")[-1])
+        type(dir_entry).path = mock.PropertyMock(return_value=path)
+        file_stat = mock.MagicMock()
+        type(file_stat).st_size = mock.PropertyMock(return_value=1)
+        type(file_stat).st_chgtime = mock.PropertyMock(return_value=time.time())
+        dir_entry.stat.return_value = file_stat
+        return dir_entry
+
+    listings = {
+        r"\\Share": [entry(r"\\Share\folder", True)],
+        r"\\Share\folder": [
+            entry(r"\\Share\folder\file.pdf", False),
+            entry(r"\\Share\folder\sub", True),
+        ],
+        r"\\Share\folder\sub": [entry(r"\\Share\folder\sub\file.pdf", False)],
+    }
+    scandir.side_effect = lambda path, **kwargs: listings[path]
+
+    http_client = mock.MagicMock()
+    http_client.upload.return_value = json.dumps({})
+
+    ingestor = samba.Processor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+    )
+    ingestor.run(
+        metadata={"datasource": "documents"},
+    )
+
+    stat.assert_not_called()
+    self_links = sorted(
+        upload_kwargs["metadata"]["self_link"]
+        for _, upload_kwargs in http_client.upload.call_args_list
+    )
+    assert self_links == [
+        r"\\Share\folder\file.pdf",
+        r"\\Share\folder\sub\file.pdf",
+    ]
+    # Files of the same name are copied to different paths
+    copied_paths = {args[1] for args, _ in shutil.copyfile.call_args_list}
+    assert len(copied_paths) == 2
+    assert len(session.query(Document).all()) == 2
@@ -1,6 +1,7 @@
 import json
 import os
 import datetime
+import time
 import uuid
 
 import unittest as ut
@@ -9,6 +10,7 @@ import unittest.mock as mock
 from sqlalchemy.orm.session import Session
 
 import nesis.api.core.document_loaders.sharepoint as sharepoint
+from nesis.api.core.document_loaders.checkpoint import TaskCheckpoint
 from nesis.api import tests
 from nesis.api.core.models import DBSession
 from nesis.api.core.models import initialize_engine
@@ -16,11 +18,13 @@ import nesis.api.core.services as services
 from nesis.api.core.models.entities import (
     Datasource,
     Document,
+    Task,
 )
 
 from nesis.api.core.models.objects import (
     DatasourceType,
     DatasourceStatus,
+    TaskType,
 )
 from nesis.api.core.util.dateutil import strptime
 
@@ -212,11 +216,10 @@ def test_updated(
     )
 
     # The document would be deleted from the rag engine
-    _, upload_kwargs = http_client.deletes.call_args_list[0]
-    urls = upload_kwargs["urls"]
-
-    assert urls == [
-        f"http://localhost:8080/v1/ingest/documents/{document.rag_metadata['data'][0]['doc_id']}"
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
     ]
 
     # And then re-ingested
@@ -335,12 +338,250 @@ def test_uningest(
         metadata={"datasource": "documents"},
     )
 
-    _, upload_kwargs = http_client.deletes.call_args_list[0]
-    urls = upload_kwargs["urls"]
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
+    ]
+    documents = session.query(Document).all()
+    assert len(documents) == 0
+
+
+@mock.patch("nesis.api.core.document_loaders.sharepoint.ClientContext")
+def test_ingest_changes(
+    sharepoint_context: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that, once a change token is saved, only the changed items are synced
+    """
+    data = {
+        "name": "sharepoint documents",
+        "engine": "sharepoint",
+        "connection": {
+            "endpoint": "https://ametnes.sharepoint.com/sites/nesis-test/",
+            "client_id": "<sharepoint_app_client_id>",
+            "tenant_id": "<sharepoint_app_tenant_id>",
+            "thumbprint": "<sharepoint_app_cert_thumbprint>",
+            "certificate": "path_to_private_cert_keyfile",
+            "dataobjects": "Books",
+        },
+    }
+
+    datasource = Datasource(
+        name=data["name"],
+        connection=data["connection"],
+        source_type=DatasourceType.SHAREPOINT,
+        status=DatasourceStatus.ONLINE,
+    )
+
+    session.add(datasource)
+    session.commit()
+
+    self_link = "https://ametnes.sharepoint.com/sites/nesis-test/Shared Documents/Books/deleted.pdf"
+    document = Document(
+        datasource_id=datasource.uuid,
+        base_uri="https://ametnes.sharepoint.com/sites/nesis-test/",
+        document_id=str(
+            uuid.uuid5(uuid.NAMESPACE_DNS, f"{datasource.uuid}:{self_link}")
+        ),
+        filename="deleted.pdf",
+        rag_metadata={"data": [{"doc_id": str(uuid.uuid4())}]},
+        store_metadata={
+            "file_name": "deleted.pdf",
+            "file_url": "/sites/nesis-test/Shared Documents/Books/deleted.pdf",
+            "etag": "deleted-unique-id",
+            "last_modified": "2024-01-10 06:40:07",
+        },
+        last_modified=strptime("2024-01-10 06:40:07"),
+    )
+    session.add(document)
+
+    task = Task(
+        task_type=TaskType.INGEST_DATASOURCE,
+        schedule="",
+        definition={"datasource": {"id": datasource.uuid}},
+        parent_id=datasource.uuid,
+    )
+    listed_at = time.time()
+    task.checkpoint = {
+        "change_token": {"token": "1;3;list-id;1;100", "listed_at": listed_at}
+    }
+    session.add(task)
+    session.commit()
+    task_uuid = task.uuid
+
+    sp_client_context = mock.MagicMock()
+    sharepoint_context().with_client_certificate.return_value = sp_client_context
+    library = sp_client_context.web.default_document_library.return_value
+
+    root_folder = mock.MagicMock()
+    type(root_folder).serverRelativeUrl = mock.PropertyMock(
+        return_value="/sites/nesis-test/Shared Documents"
+    )
+    library.root_folder.get.return_value.execute_query.return_value = root_folder
+
+    def change(change_type: int, unique_id: str, token: str) -> mock.MagicMock:
+        _change = mock.MagicMock()
+        type(_change).change_type = mock.PropertyMock(return_value=change_type)
+        type(_change).properties = mock.PropertyMock(
+            return_value={"ItemId": 5, "UniqueId": unique_id}
+        )
+        _change.change_token.StringValue = token
+        return _change
+
+    library.get_changes.return_value.execute_query.side_effect = [
+        [change(1, "new-unique-id", "t2"), change(3, "deleted-unique-id", "t3")],
+        [],
+    ]
+
+    file_mock = mock.MagicMock()
+    type(file_mock).name = mock.PropertyMock(return_value="new.pdf")
+    type(file_mock).serverRelativeUrl = mock.PropertyMock(
+        return_value="/sites/nesis-test/Shared Documents/Books/new.pdf"
+    )
+    type(file_mock).unique_id = mock.PropertyMock(return_value="new-unique-id")
+    type(file_mock).time_last_modified = mock.PropertyMock(
+        return_value=strptime("2024-04-11 06:40:07")
+    )
+    type(file_mock).length = mock.PropertyMock(return_value=1023)
+    type(file_mock).author = mock.PropertyMock(return_value="file author")
+    library.get_item_by_id.return_value.file.get.return_value.execute_query.return_value = (
+        file_mock
+    )
+
+    http_client = mock.MagicMock()
+    http_client.upload.return_value = json.dumps({})
+
+    ingestor = sharepoint.Processor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+        checkpoint=TaskCheckpoint(task_id=task_uuid),
+    )
+    ingestor.run(
+        metadata={"datasource": "documents"},
+    )
 
-    assert (
-        urls[0]
-        == f"http://localhost:8080/v1/ingest/documents/{document.rag_metadata['data'][0]['doc_id']}"
+    # No full listing of the library
+    library.root_folder.folders.get_by_path.assert_not_called()
+    sp_client_context.web.get_file_by_server_relative_url.assert_called_with(
+        "/sites/nesis-test/Shared Documents/Books/new.pdf"
     )
+
+    _, upload_kwargs = http_client.upload.call_args_list[0]
+    assert upload_kwargs["filepath"].endswith("new.pdf")
+    assert http_client.upload.call_count == 1
+
+    _, post_kwargs = http_client.post.call_args_list[0]
+    assert post_kwargs["url"] == "http://localhost:8080/v1/ingest/documents/delete"
+    assert json.loads(post_kwargs["payload"])["doc_ids"] == [
+        document.rag_metadata["data"][0]["doc_id"]
+    ]
     documents = session.query(Document).all()
-    assert len(documents) == 0
+    assert [document.filename for document in documents] == ["new.pdf"]
+
+    task = DBSession().query(Task).filter(Task.uuid == task_uuid).first()
+    assert task.checkpoint == {"change_token": {"token": "t3", "listed_at": listed_at}}
+
+
+@mock.patch("nesis.api.core.document_loaders.sharepoint.ClientContext")
+def test_ingest_changes_failed(
+    sharepoint_context: mock.MagicMock, cache: mock.MagicMock, session: Session
+) -> None:
+    """
+    Test that the change token is not advanced past a change that failed, and that a library due a reconciliation
+    is fully listed instead of synced from its changes
+    """
+    datasource = Datasource(
+        name="sharepoint documents",
+        connection={
+            "endpoint": "https://ametnes.sharepoint.com/sites/nesis-test/",
+            "client_id": "<sharepoint_app_client_id>",
+            "tenant_id": "<sharepoint_app_tenant_id>",
+            "thumbprint": "<sharepoint_app_cert_thumbprint>",
+            "certificate": "path_to_private_cert_keyfile",
+            "dataobjects": "Books",
+        },
+        source_type=DatasourceType.SHAREPOINT,
+        status=DatasourceStatus.ONLINE,
+    )
+    session.add(datasource)
+    session.commit()
+
+    listed_at = time.time()
+    task = Task(
+        task_type=TaskType.INGEST_DATASOURCE,
+        schedule="",
+        definition={"datasource": {"id": datasource.uuid}},
+        parent_id=datasource.uuid,
+    )
+    task.checkpoint = {
+        "change_token": {"token": "1;3;list-id;1;100", "listed_at": listed_at}
+    }
+    session.add(task)
+    session.commit()
+    task_uuid = task.uuid
+
+    sp_client_context = mock.MagicMock()
+    sharepoint_context().with_client_certificate.return_value = sp_client_context
+    library = sp_client_context.web.default_document_library.return_value
+    root_folder = mock.MagicMock()
+    type(root_folder).serverRelativeUrl = mock.PropertyMock(
+        return_value="/sites/nesis-test/Shared Documents"
+    )
+    library.root_folder.get.return_value.execute_query.return_value = root_folder
+
+    def change(change_type: int, unique_id: str, token: str) -> mock.MagicMock:
+        _change = mock.MagicMock()
+        type(_change).change_type = mock.PropertyMock(return_value=change_type)
+        type(_change).properties = mock.PropertyMock(
+            return_value={"ItemId": 5, "UniqueId": unique_id}
+        )
+        _change.change_token.StringValue = token
+        return _change
+
+    library.get_changes.return_value.execute_query.side_effect = [
+        [change(1, "new-unique-id", "t2"), change(3, "deleted-unique-id", "t3")],
+        [],
+    ]
+    library.get_item_by_id.side_effect = Exception("Service unavailable")
+
+    http_client = mock.MagicMock()
+    ingestor = sharepoint.Processor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+        checkpoint=TaskCheckpoint(task_id=task_uuid),
+    )
+    ingestor.run(metadata={"datasource": "documents"})
+
+    library.root_folder.folders.get_by_path.assert_not_called()
+    task = DBSession().query(Task).filter(Task.uuid == task_uuid).first()
+    assert task.checkpoint == {
+        "change_token": {"token": "1;3;list-id;1;100", "listed_at": listed_at}
+    }
+
+    # Past the reconciliation interval, the library is listed in full
+    task.checkpoint = {"change_token": {"token": "1;3;list-id;1;100", "listed_at": 0}}
+    DBSession().commit()
+    library.get_changes.reset_mock()
+    library.current_change_token.StringValue = "t4"
+
+    ingestor = sharepoint.Processor(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache,
+        datasource=datasource,
+        checkpoint=TaskCheckpoint(task_id=task_uuid),
+    )
+    ingestor.run(metadata={"datasource": "documents"})
+
+    library.get_changes.assert_not_called()
+    sp_client_context.web.default_document_library().root_folder.folders.get_by_path.assert_called_with(
+        "Books"
+    )
+    task = DBSession().query(Task).filter(Task.uuid == task_uuid).first()
+    assert task.checkpoint["change_token"]["token"] == "t4"
+    assert task.checkpoint["change_token"]["listed_at"] > listed_at
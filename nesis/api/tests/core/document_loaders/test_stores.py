@@ -0,0 +1,219 @@
+import datetime
+import unittest.mock as mock
+import uuid
+
+import pytest
+from sqlalchemy.orm.session import Session
+
+from nesis.api import tests
+from nesis.api.core.document_loaders.stores import (
+    SqlDocumentStore,
+    ParquetDocumentStore,
+)
+
+
+def _save(store: SqlDocumentStore, datasource_id: str, document_id: str, **kwargs):
+    return store.save(
+        document_id=document_id,
+        datasource_id=datasource_id,
+        base_uri="http://localhost:4566",
+        filename=f"{document_id}.pdf",
+        extract_metadata=kwargs.get("extract_metadata") or {"data": []},
+        store_metadata={"object_name": f"{document_id}.pdf"},
+        last_modified=kwargs.get("last_modified")
+        or datetime.datetime(2024, 1, 1, 10, 0, 0),
+        rag_metadata=None,
+    )
+
+
+def _records(store: SqlDocumentStore, datasource_id: str) -> list:
+    with Session(store._engine) as session:
+        return (
+            session.query(store.Store)
+            .filter(store.Store.datasource_id == datasource_id)
+            .order_by(store.Store.uuid)
+            .all()
+        )
+
+
+def test_save_batched_upsert() -> None:
+    """
+    Test that saved records are buffered until a batch fills up or is flushed, and that saving a record again
+    updates it in place.
+    """
+    store = SqlDocumentStore(
+        url=tests.config["database"]["url"], batch_size=3, linger=0
+    )
+    datasource_id = str(uuid.uuid4())
+    document_ids = sorted(str(uuid.uuid4()) for _ in range(3))
+
+    _save(store, datasource_id, document_ids[0])
+    _save(store, datasource_id, document_ids[1])
+    assert len(_records(store, datasource_id)) == 0
+
+    # The batch is full
+    _save(store, datasource_id, document_ids[2])
+    assert [record.uuid for record in _records(store, datasource_id)] == document_ids
+
+    _save(
+        store,
+        datasource_id,
+        document_ids[0],
+        extract_metadata={"data": [{"text": "updated"}]},
+        last_modified=datetime.datetime(2024, 2, 1, 10, 0, 0),
+    )
+    store.flush()
+
+    records = _records(store, datasource_id)
+    assert len(records) == 3
+    assert records[0].extract_metadata == {"data": [{"text": "updated"}]}
+    assert records[0].last_modified == datetime.datetime(2024, 2, 1, 10, 0, 0)
+    assert records[1].extract_metadata == {"data": []}
+
+    rows = list(
+        store.stream(datasource_id=datasource_id, base_uri="http://localhost:4566")
+    )
+    assert sorted(row.uuid for row in rows) == document_ids
+
+
+def test_save_failed_batch_retried() -> None:
+    """
+    Test that the records of a batch that failed to write are buffered again and written with the next batch.
+    """
+    store = SqlDocumentStore(
+        url=tests.config["database"]["url"], batch_size=2, linger=0
+    )
+    datasource_id = str(uuid.uuid4())
+    document_ids = sorted(str(uuid.uuid4()) for _ in range(3))
+
+    _save(store, datasource_id, document_ids[0])
+    with mock.patch.object(
+        store, "_upsert", side_effect=Exception("Connection lost")
+    ) as upsert:
+        with pytest.raises(Exception, match="Connection lost"):
+            _save(store, datasource_id, document_ids[1])
+        upsert.assert_called_once()
+    assert _records(store, datasource_id) == []
+
+    _save(store, datasource_id, document_ids[2])
+    assert [record.uuid for record in _records(store, datasource_id)] == document_ids
+
+
+def test_save_buffered_visible() -> None:
+    """
+    Test that buffered records are seen by reads without writing them out, over the written records, and that
+    deleting a buffered record drops it.
+    """
+    store = SqlDocumentStore(
+        url=tests.config["database"]["url"], batch_size=100, linger=0
+    )
+    datasource_id = str(uuid.uuid4())
+    document_id = str(uuid.uuid4())
+    written_document_id = str(uuid.uuid4())
+    deleted_document_id = str(uuid.uuid4())
+
+    _save(store, datasource_id, written_document_id)
+    store.flush()
+    _save(store, datasource_id, document_id)
+    _save(store, datasource_id, deleted_document_id)
+    _save(
+        store,
+        datasource_id,
+        written_document_id,
+        extract_metadata={"data": [{"text": "updated"}]},
+    )
+    store.delete(document_id=deleted_document_id)
+
+    assert [record.uuid for record in store.get(document_id=document_id)] == [
+        document_id
+    ]
+    assert [
+        record.extract_metadata for record in store.get(document_id=written_document_id)
+    ] == [{"data": [{"text": "updated"}]}]
+    rows = list(
+        store.stream(datasource_id=datasource_id, base_uri="http://localhost:4566")
+    )
+    assert sorted(row.uuid for row in rows) == sorted(
+        [document_id, written_document_id]
+    )
+    assert [record.uuid for record in _records(store, datasource_id)] == [
+        written_document_id
+    ]
+
+    store.flush()
+    assert sorted(record.uuid for record in _records(store, datasource_id)) == sorted(
+        [document_id, written_document_id]
+    )
+
+
+def test_parquet_save(tmp_path) -> None:
+    """
+    Test that the elements of extracted files are written as rows of partitioned parquet files and that the store
+    tracks the latest extraction of each file.
+    """
+    import pyarrow.dataset as ds
+
+    store = ParquetDocumentStore(path=str(tmp_path), row_group_size=2)
+    datasource_id = str(uuid.uuid4())
+    document_ids = sorted(str(uuid.uuid4()) for _ in range(3))
+
+    _save(
+        store,
+        datasource_id,
+        document_ids[0],
+        extract_metadata={
+            "data": [
+                {"id_": "e1", "text": "first", "metadata": {"page_label": "1"}},
+                {"id_": "e2", "text": "second", "metadata": {"page_label": "2"}},
+                {"id_": "e3", "text": "third", "metadata": {"page_label": "2"}},
+            ]
+        },
+    )
+    _save(store, datasource_id, document_ids[1])
+    _save(store, datasource_id, document_ids[2])
+    store.delete(document_id=document_ids[2])
+    store.flush()
+
+    assert (tmp_path / f"datasource_id={datasource_id}").is_dir()
+    table = ds.dataset(str(tmp_path), format="parquet", partitioning="hive").to_table(
+        filter=(ds.field("document_id") == document_ids[0])
+    )
+    assert sorted(table.column("text").to_pylist()) == ["first", "second", "third"]
+
+    records = store.get(base_uri="http://localhost:4566")
+    assert sorted(record.uuid for record in records) == document_ids[:2]
+
+    # Extracting a file again supersedes its previous elements
+    _save(
+        store,
+        datasource_id,
+        document_ids[0],
+        last_modified=datetime.datetime(2024, 2, 1, 10, 0, 0),
+    )
+    records = store.get(document_id=document_ids[0])
+    assert len(records) == 1
+    assert records[0].last_modified == datetime.datetime(2024, 2, 1, 10, 0, 0)
+    # Buffered records do not hold on to their elements, as with records read back from the part files
+    assert records[0].extract_metadata is None
+
+    rows = list(
+        store.stream(datasource_id=datasource_id, base_uri="http://localhost:4566")
+    )
+    assert sorted(row[1] for row in rows) == document_ids[:2]
+
+    # Reads leave the part files of the run open, and a delete given the record does not read at all
+    _save(store, datasource_id, document_ids[2])
+    _save(store, datasource_id, str(uuid.uuid4()))
+    assert store._writers
+    records = store.get(document_id=document_ids[2])
+    assert store._writers
+    with mock.patch.object(store, "get") as get:
+        store.delete(document_id=document_ids[2], record=records[0])
+    get.assert_not_called()
+    assert store.get(document_id=document_ids[2]) == []
+    assert store._writers
+    store.flush()
+    assert store.get(document_id=document_ids[2]) == []
+    rows = list(store.stream(datasource_id=datasource_id))
+    assert len(rows) == 3
+    assert document_ids[2] not in {row[1] for row in rows}
@@ -13,13 +13,15 @@ from sqlalchemy.orm.session import Session
 import nesis.api.tests as tests
 import nesis.api.core.services as services
 from nesis.api.core.models import initialize_engine, DBSession
-from nesis.api.core.models.entities import Datasource
+from nesis.api.core.models.entities import Datasource, Action
+from nesis.api.core.models.objects import ResourceType
 from nesis.api.core.services import (
     PermissionException,
     DatasourceService,
     UserSessionService,
     UnauthorizedAccess,
 )
+from nesis.api.core.services.authorization import AuthorizationCache
 from nesis.api.tests.core.services import (
     create_user_session,
     create_role,
@@ -168,3 +170,111 @@ def test_session_expiry(http_client, tc):
     with pytest.raises(UnauthorizedAccess) as ex_info:
         create_datasource(token=admin_user.token)
     assert "Invalid app token supplied" in str(ex_info)
+
+
+def test_authorization_cache(http_client, tc):
+    """
+    Test that authorization decisions are served from the cache and go stale, in this process and in other
+    replicas, once the user's roles change.
+    """
+    admin_user = create_user_session(
+        service=services.user_session_service,
+        email=tests.admin_email,
+        password=tests.admin_password,
+    )
+    a_given_user = {
+        "email": "some.user@somedomain.com",
+        "password": "some.password",
+        "name": "Some Name",
+    }
+    given_user_record = services.user_service.create(
+        user=a_given_user, token=admin_user.token
+    )
+    given_user_session = create_user_session(
+        service=services.user_session_service,
+        email=a_given_user["email"],
+        password=a_given_user["password"],
+    )
+    role_record = create_role(
+        service=services.role_service,
+        role={
+            "name": "datasource-admin",
+            "policy": {"items": [{"action": "create", "resource": "datasources/*"}]},
+        },
+        token=admin_user.token,
+    )
+    assign_role_to_user(
+        service=services.user_service,
+        token=admin_user.token,
+        role=role_record.to_dict(),
+        user_id=given_user_record.uuid,
+    )
+
+    # Another replica sharing memcache, re-reading the version on every check
+    replica_cache = AuthorizationCache(
+        config={
+            **tests.config,
+            "authorization": {"cache": {"version_interval": 0.001}},
+        }
+    )
+    principal = f"users/{given_user_record.uuid}"
+
+    def authorize():
+        session = DBSession()
+        try:
+            services.authorized(
+                session_service=services.user_session_service,
+                session=session,
+                token=given_user_session.token,
+                action=Action.CREATE,
+                resource_type=ResourceType.DATASOURCES,
+            )
+        finally:
+            session.close()
+
+    with mock.patch(
+        "nesis.api.core.services._get_action_query",
+        wraps=services._get_action_query,
+    ) as get_action_query:
+        authorize()
+        authorize()
+        assert get_action_query.call_count == 1
+    assert (
+        replica_cache.get(
+            replica_cache.key(principal, Action.CREATE, ResourceType.DATASOURCES, None)
+        )
+        is True
+    )
+
+    # Removing the user's roles takes effect right away
+    services.user_service.update(
+        token=admin_user.token,
+        user_id=given_user_record.uuid,
+        user={"roles": []},
+    )
+    with pytest.raises(PermissionException):
+        authorize()
+    sleep(0.01)
+    assert (
+        replica_cache.get(
+            replica_cache.key(principal, Action.CREATE, ResourceType.DATASOURCES, None)
+        )
+        is False
+    )
+
+    # A decision made while the roles change is stored under the version it was made under
+    cache_key = services.authorization_cache.key(
+        principal, Action.CREATE, ResourceType.DATASOURCES, None
+    )
+    services.invalidate_authorizations()
+    services.authorization_cache.put(cache_key, True)
+    assert (
+        services.authorization_cache.get(
+            services.authorization_cache.key(
+                principal, Action.CREATE, ResourceType.DATASOURCES, None
+            )
+        )
+        is None
+    )
+    with pytest.raises(PermissionException):
+        authorize()
@@ -18,6 +18,7 @@ from nesis.api.core.models import initialize_engine, DBSession
 from nesis.api.core.models.entities import Datasource, Task
 from nesis.api.core.models.objects import DatasourceStatus
 from nesis.api.core.models.objects import TaskType, TaskStatus
+from nesis.api.core.services.task_service import TaskService
 from nesis.api.core.services.util import ServiceException
 from nesis.api.core.util import http
 from nesis.api.tests.core.services import (
@@ -122,6 +123,38 @@ def test_task_cron_scheduler(tc):
     # TODO - Worth testing that the job was paused but the apscheduler doesn't seem to have an API for that
 
 
+def test_task_id_backfilled(tc):
+    """
+    Test that the jobs of earlier releases, which carry no task id, are given one when the scheduler starts
+    """
+    admin_user = create_user_session(
+        service=services.user_session_service,
+        email=tests.admin_email,
+        password=tests.admin_password,
+    )
+    datasource: Datasource = create_datasource(token=admin_user.token)
+    task: Task = create_task(
+        token=admin_user.token, datasource=datasource, schedule="2 4 * * mon,fri"
+    )
+    job = services.task_service._scheduler.get_job(task.uuid)
+    services.task_service._scheduler.modify_job(
+        task.uuid,
+        kwargs={key: value for key, value in job.kwargs.items() if key != "task_id"},
+    )
+    services.task_service._scheduler.shutdown(wait=False)
+
+    services.task_service = TaskService(
+        config=tests.config,
+        http_client=http.HttpClient(config=tests.config),
+        session_service=services.user_session_service,
+        datasource_service=services.datasource_service,
+    )
+
+    job = services.task_service._scheduler.get_job(task.uuid)
+    assert job.kwargs["task_id"] == task.uuid
+    tc.assertDictEqual(job.kwargs["params"], {"datasource": {"id": datasource.uuid}})
+
+
 def test_task_date_scheduler(tc):
     """
     Test the task happy path
@@ -201,7 +234,10 @@ def test_task_listener(tc, event_code, task_expected, datasource_expected):
     submit_event: JobEvent = JobEvent(code=event_code, job_id=task.uuid, jobstore=None)
 
     services.task_service._scheduler_listener(event=submit_event)
+    services.task_service.flush()
 
+    # The statuses are written on the status writer's own session
+    session.expire_all()
     task = session.query(Task).filter(Task.uuid == task.uuid).first()
     datasource = (
         session.query(Datasource).filter(Datasource.uuid == task.parent_id).first()
@@ -211,12 +247,83 @@ def test_task_listener(tc, event_code, task_expected, datasource_expected):
 
 
 def test_task_listener_invalid_job(tc):
+    """
+    Test that a transition of an unknown task does not hold up the other transitions written in its batch.
+    """
+    admin_user = create_user_session(
+        service=services.user_session_service,
+        email=tests.admin_email,
+        password=tests.admin_password,
+    )
+    datasource: Datasource = create_datasource(token=admin_user.token)
 
-    # Fail with ValueError if job_id is invalid
-    submit_event: JobEvent = JobEvent(
-        code=EVENT_JOB_EXECUTED, job_id=str(uuid.uuid4()), jobstore=None
+    session: Session = DBSession()
+    task = Task(
+        task_type=TaskType.INGEST_DATASOURCE,
+        schedule=str(du.now()),
+        definition={},
+        parent_id=datasource.uuid,
     )
+    session.add(task)
+    session.commit()
 
-    with pytest.raises(ValueError) as ex_info:
-        services.task_service._scheduler_listener(event=submit_event)
-        assert "not found" in str(ex_info)
+    services.task_service._save_statuses(
+        [
+            (str(uuid.uuid4()), EVENT_JOB_EXECUTED),
+            (task.uuid, EVENT_JOB_SUBMITTED),
+            (task.uuid, EVENT_JOB_EXECUTED),
+        ]
+    )
+
+    session.expire_all()
+    task = session.query(Task).filter(Task.uuid == task.uuid).first()
+    assert task.status == TaskStatus.COMPLETED
+
+
+def test_task_listener_single(tc):
+    """
+    Test that creating tasks does not register more scheduler listeners.
+    """
+    admin_user = create_user_session(
+        service=services.user_session_service,
+        email=tests.admin_email,
+        password=tests.admin_password,
+    )
+    datasource: Datasource = create_datasource(token=admin_user.token)
+    listeners = len(services.task_service._scheduler._listeners)
+
+    create_task(token=admin_user.token, datasource=datasource, schedule="0 0 1 1 *")
+
+    assert len(services.task_service._scheduler._listeners) == listeners
+
+
+def test_task_priority(tc):
+    """
+    Test that a task's priority is validated and can be updated
+    """
+    admin_user = create_user_session(
+        service=services.user_session_service,
+        email=tests.admin_email,
+        password=tests.admin_password,
+    )
+    datasource: Datasource = create_datasource(token=admin_user.token)
+    payload = {
+        "type": "ingest_datasource",
+        "schedule": "0 0 1 1 *",
+        "definition": {"datasource": {"id": datasource.uuid}},
+    }
+
+    for priority in [-1, 11, "high", True]:
+        with pytest.raises(ServiceException) as ex_info:
+            services.task_service.create(
+                token=admin_user.token, task={**payload, "priority": priority}
+            )
+        assert "priority" in str(ex_info.value)
+
+    task = services.task_service.create(token=admin_user.token, task=payload)
+    assert task.priority == 0
+
+    task = services.task_service.update(
+        token=admin_user.token, task_id=task.uuid, task={"priority": 7}
+    )
+    assert task.to_dict()["priority"] == 7
@@ -1,3 +1,5 @@
+import copy
+import time
 import unittest as ut
 import uuid
 from unittest import mock
@@ -8,7 +10,8 @@ from sqlalchemy.orm.session import Session
 import nesis.api.core.services as services
 import nesis.api.tests as tests
 from nesis.api.core.models import initialize_engine, DBSession
-from nesis.api.core.models.entities import Datasource
+from nesis.api.core.models.entities import Datasource, TaskRun
+from nesis.api.core.services.util import ServiceException
 from nesis.api.core.tasks.document_management import ingest_datasource
 from nesis.api.core.util import http
 from nesis.api.tests.core.services import (
@@ -200,3 +203,156 @@ def test_ingest_datasource_sharepoint(
     tc.assertDictEqual(
         kwargs_fetch_documents["metadata"], {"datasource": datasource.name}
     )
+
+
+@mock.patch("nesis.api.core.tasks.document_management.minio.MinioProcessor")
+def test_ingest_datasource_task_run(
+    ingestor: mock.MagicMock, tc, cache_client, http_client
+):
+    """
+    Test that a run of a task records the progress reported by the processor
+    """
+
+    admin_user = create_user_session(
+        service=services.user_session_service,
+        email=tests.admin_email,
+        password=tests.admin_password,
+    )
+    datasource: Datasource = create_datasource(
+        token=admin_user.token, datasource_type="minio"
+    )
+    task = services.task_service.create(
+        token=admin_user.token,
+        task={
+            "type": "ingest_datasource",
+            "schedule": "0 0 1 1 *",
+            "definition": {"datasource": {"id": datasource.uuid}},
+        },
+    )
+
+    def run(**kwargs):
+        progress = ingestor.call_args.kwargs["progress"]
+        progress.add("listed", 3)
+        progress.add("skipped")
+        progress.add("uploaded", 2)
+        progress.add("downloaded_bytes", 1024)
+        with progress.stage("upload"):
+            pass
+
+    ingestor.return_value.run.side_effect = run
+
+    ingest_datasource(
+        config=tests.config,
+        http_client=http_client,
+        cache_client=cache_client,
+        params={"datasource": {"id": datasource.uuid}},
+        task_id=task.uuid,
+    )
+
+    task_runs = services.task_service.get_runs(
+        token=admin_user.token, task_id=task.uuid
+    )
+    assert len(task_runs) == 1
+    task_run = task_runs[0].to_dict()
+    assert task_run["status"] == "COMPLETED"
+    assert task_run["end_date"] is not None
+    assert task_run["listed"] == 3
+    assert task_run["skipped"] == 1
+    assert task_run["uploaded"] == 2
+    assert task_run["failed"] == 0
+    assert task_run["downloaded_bytes"] == 1024
+    assert "upload" in task_run["timings"]
+
+    # A failed run is recorded as such
+    ingestor.return_value.run.side_effect = Exception("Listing failed")
+    with pytest.raises(Exception):
+        ingest_datasource(
+            config=tests.config,
+            http_client=http_client,
+            cache_client=cache_client,
+            params={"datasource": {"id": datasource.uuid}},
+            task_id=task.uuid,
+        )
+    task_runs = services.task_service.get_runs(
+        token=admin_user.token, task_id=task.uuid
+    )
+    assert [task_run.status.name for task_run in task_runs] == ["ERROR", "COMPLETED"]
+
+
+@mock.patch("nesis.api.core.tasks.document_management.minio.MinioProcessor")
+def test_ingest_datasource_cancelled(
+    ingestor: mock.MagicMock, tc, cache_client, http_client
+):
+    """
+    Test that a run stops once its time budget runs out or its task is disabled, and is recorded as paused
+    """
+
+    admin_user = create_user_session(
+        service=services.user_session_service,
+        email=tests.admin_email,
+        password=tests.admin_password,
+    )
+    datasource: Datasource = create_datasource(
+        token=admin_user.token, datasource_type="minio"
+    )
+    task = services.task_service.create(
+        token=admin_user.token,
+        task={
+            "type": "ingest_datasource",
+            "schedule": "0 0 1 1 *",
+            "definition": {"datasource": {"id": datasource.uuid}},
+            "time_budget": 60,
+        },
+    )
+    with pytest.raises(ServiceException):
+        services.task_service.update(
+            token=admin_user.token, task_id=task.uuid, task={"time_budget": -1}
+        )
+    config = copy.deepcopy(tests.config)
+    config["tasks"]["cancellation"] = {"interval": 0}
+
+    def run_out_of_time(**kwargs):
+        cancellation = ingestor.call_args.kwargs["cancellation"]
+        assert not cancellation.cancelled
+        # Use up the task's time budget
+        cancellation._deadline = time.monotonic()
+        assert cancellation.cancelled
+        assert cancellation.reason == "time budget exceeded"
+
+    ingestor.return_value.run.side_effect = run_out_of_time
+
+    ingest_datasource(
+        config=config,
+        http_client=http_client,
+        cache_client=cache_client,
+        params={"datasource": {"id": datasource.uuid}},
+        task_id=task.uuid,
+    )
+    task_runs = services.task_service.get_runs(
+        token=admin_user.token, task_id=task.uuid
+    )
+    assert [task_run.status.name for task_run in task_runs] == ["PAUSED"]
+
+    def run_disabled(**kwargs):
+        cancellation = ingestor.call_args.kwargs["cancellation"]
+        assert not cancellation.cancelled
+        services.task_service.update(
+            token=admin_user.token, task_id=task.uuid, task={"enabled": False}
+        )
+        assert cancellation.cancelled
+        assert cancellation.reason == "task disabled"
+
+    ingestor.return_value.run.side_effect = run_disabled
+
+    ingest_datasource(
+        config=config,
+        http_client=http_client,
+        cache_client=cache_client,
+        params={"datasource": {"id": datasource.uuid}},
+        task_id=task.uuid,
+    )
+
+    # Disabled tasks are not accessible through the service
+    session: Session = DBSession()
+    task_runs = session.query(TaskRun).filter(TaskRun.task_id == task.uuid).all()
+    assert [task_run.status.name for task_run in task_runs] == ["PAUSED", "PAUSED"]
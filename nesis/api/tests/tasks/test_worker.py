@@ -0,0 +1,241 @@
+import concurrent.futures
+import copy
+import uuid
+from unittest import mock
+
+import pytest
+from sqlalchemy.orm.session import Session
+
+import nesis.api.core.services as services
+import nesis.api.tests as tests
+from nesis.api.core.document_loaders.cancellation import TaskCancellation
+from nesis.api.core.models import initialize_engine, DBSession
+from nesis.api.core.models.entities import Datasource, Task, QueuedTask
+from nesis.api.core.models.objects import TaskStatus, DatasourceStatus
+from nesis.api.core.services.task_service import TaskService
+from nesis.api.core.tasks.queue import enqueue_task, claim_tasks
+from nesis.api.core.util import http
+from nesis.api.core.worker import Worker
+from nesis.api.tests.core.services import (
+    create_user_session,
+)
+
+
+@pytest.fixture(autouse=True)
+def setup():
+
+    pytest.config = tests.config
+    initialize_engine(tests.config)
+    session: Session = DBSession()
+    tests.clear_database(session)
+
+    services.init_services(
+        config=tests.config, http_client=http.HttpClient(config=tests.config)
+    )
+    # Clear all jobs first
+    services.task_service._scheduler.remove_all_jobs()
+
+
+def create_task() -> Task:
+    admin_user = create_user_session(
+        service=services.user_session_service,
+        email=tests.admin_email,
+        password=tests.admin_password,
+    )
+    datasource: Datasource = services.datasource_service.create(
+        token=admin_user.token,
+        datasource={
+            "type": "minio",
+            "name": str(uuid.uuid4()),
+            "connection": {
+                "user": "caikuodda",
+                "password": "some.password",
+                "endpoint": "localhost",
+                "dataobjects": "initdb",
+            },
+        },
+    )
+    return services.task_service.create(
+        token=admin_user.token,
+        task={
+            "type": "ingest_datasource",
+            "schedule": "0 0 1 1 *",
+            "definition": {"datasource": {"id": datasource.uuid}},
+        },
+    )
+
+
+def _queued(task_id: str) -> list[QueuedTask]:
+    session: Session = DBSession()
+    try:
+        return session.query(QueuedTask).filter(QueuedTask.task_id == task_id).all()
+    finally:
+        session.close()
+
+
+def _worker(worker_id: str) -> Worker:
+    config = copy.deepcopy(tests.config)
+    config["tasks"]["worker"] = {"concurrency": 2, "lease": 60, "poll_interval": 0}
+    return Worker(
+        config=config,
+        worker_id=worker_id,
+        executor=concurrent.futures.ThreadPoolExecutor(max_workers=2),
+    )
+
+
+@mock.patch("nesis.api.core.worker.ingest_datasource")
+def test_worker_runs_queued_task(ingest_datasource: mock.MagicMock) -> None:
+    """
+    Test that a queued run is taken by a single worker, run and removed from the queue
+    """
+    task = create_task()
+    params = {"datasource": {"id": task.parent_id}}
+
+    enqueue_task(config=tests.config, params=params, task_id=task.uuid)
+    # A task is only queued once
+    enqueue_task(config=tests.config, params=params, task_id=task.uuid)
+    assert len(_queued(task.uuid)) == 1
+
+    worker = _worker("worker-1")
+    other_worker = _worker("worker-2")
+    assert worker.poll() == 1
+    assert other_worker.poll() == 0
+    worker._running[_queued(task.uuid)[0].uuid][1].result()
+
+    worker.poll()
+
+    _, kwargs = ingest_datasource.call_args
+    assert kwargs["task_id"] == task.uuid
+    assert kwargs["params"] == params
+    assert kwargs["worker_id"] == "worker-1"
+    assert _queued(task.uuid) == []
+
+    session: Session = DBSession()
+    task = session.query(Task).filter(Task.uuid == task.uuid).first()
+    datasource = (
+        session.query(Datasource).filter(Datasource.uuid == task.parent_id).first()
+    )
+    assert task.status == TaskStatus.COMPLETED
+    assert datasource.status == DatasourceStatus.ONLINE
+
+
+def test_worker_reclaims_expired_lease() -> None:
+    """
+    Test that the run of a worker that stopped renewing its lease is claimed by another worker
+    """
+    task = create_task()
+    enqueue_task(
+        config=tests.config,
+        params={"datasource": {"id": task.parent_id}},
+        task_id=task.uuid,
+    )
+
+    assert len(claim_tasks(worker_id="worker-1", count=1, lease=-1)) == 1
+    claimed = claim_tasks(worker_id="worker-2", count=1, lease=60)
+    assert len(claimed) == 1
+    assert claimed[0].attempts == 2
+    assert claim_tasks(worker_id="worker-3", count=1, lease=60) == []
+
+
+def test_worker_stops_run_on_lost_lease() -> None:
+    """
+    Test that a run whose lease was reclaimed by another worker stops on its next check
+    """
+    task = create_task()
+    enqueue_task(
+        config=tests.config,
+        params={"datasource": {"id": task.parent_id}},
+        task_id=task.uuid,
+    )
+
+    queued_task = claim_tasks(worker_id="worker-1", count=1, lease=-1)[0]
+    lost = TaskCancellation(
+        task_id=task.uuid,
+        interval=0,
+        queued_task_id=queued_task.uuid,
+        worker_id="worker-1",
+    )
+    assert not lost.cancelled
+
+    claim_tasks(worker_id="worker-2", count=1, lease=60)
+    held = TaskCancellation(
+        task_id=task.uuid,
+        interval=0,
+        queued_task_id=queued_task.uuid,
+        worker_id="worker-2",
+    )
+    assert lost.cancelled
+    assert lost.reason == "lease lost"
+    assert not held.cancelled
+
+
+def test_task_service_enqueues_with_workers() -> None:
+    """
+    Test that with workers, the API's scheduler only queues the runs
+    """
+    config = copy.deepcopy(tests.config)
+    config["tasks"]["worker"] = {"enabled": True}
+    services.task_service._scheduler.shutdown(wait=False)
+    services.task_service = TaskService(
+        config=config,
+        http_client=http.HttpClient(config=config),
+        session_service=services.user_session_service,
+        datasource_service=services.datasource_service,
+    )
+    services.datasource_service.task_service = services.task_service
+
+    task = create_task()
+
+    job = services.task_service._scheduler.get_job(task.uuid)
+    assert job.func is enqueue_task
+
+
+def test_task_service_enqueues_existing_jobs_with_workers() -> None:
+    """
+    Test that jobs scheduled before workers were turned on queue their runs once they are
+    """
+    task = create_task()
+    job = services.task_service._scheduler.get_job(task.uuid)
+    # Jobs of earlier releases carry no task id
+    services.task_service._scheduler.modify_job(
+        task.uuid,
+        kwargs={key: value for key, value in job.kwargs.items() if key != "task_id"},
+    )
+    services.task_service._scheduler.shutdown(wait=False)
+
+    config = copy.deepcopy(tests.config)
+    config["tasks"]["worker"] = {"enabled": True}
+    services.task_service = TaskService(
+        config=config,
+        http_client=http.HttpClient(config=config),
+        session_service=services.user_session_service,
+        datasource_service=services.datasource_service,
+    )
+
+    job = services.task_service._scheduler.get_job(task.uuid)
+    assert job.func is enqueue_task
+    assert job.kwargs["task_id"] == task.uuid
+
+    job.func(**job.kwargs)
+    assert [queued_task.task_id for queued_task in _queued(task.uuid)] == [task.uuid]
+
+
+def test_worker_claims_by_priority() -> None:
+    """
+    Test that queued runs of higher priority tasks are claimed first
+    """
+    low_task = create_task()
+    high_task = create_task()
+    session: Session = DBSession()
+    session.query(Task).filter(Task.uuid == high_task.uuid).update({Task.priority: 5})
+    session.commit()
+
+    for task in [low_task, high_task]:
+        enqueue_task(
+            config=tests.config,
+            params={"datasource": {"id": task.parent_id}},
+            task_id=task.uuid,
+        )
+
+    claimed = claim_tasks(worker_id="worker-1", count=1, lease=60)
+    assert [queued_task.task_id for queued_task in claimed] == [high_task.uuid]
@@ -0,0 +1,176 @@
+import threading
+import time
+import unittest.mock as mock
+
+from nesis.api.core.util.concurrency import (
+    BlockingThreadPoolExecutor,
+    AdaptiveLimiter,
+    FairShareExecutor,
+)
+
+
+def test_blocking_thread_pool_executor_bounds_queue() -> None:
+    """
+    Submitting to a full BlockingThreadPoolExecutor should block until a worker frees up
+    """
+    release = threading.Event()
+    work_queue = BlockingThreadPoolExecutor(max_workers=1, queue_size=1)
+
+    # One item running, one item queued
+    work_queue.submit(release.wait)
+    work_queue.submit(release.wait)
+
+    submitted = threading.Event()
+
+    def producer():
+        work_queue.submit(lambda: None)
+        submitted.set()
+
+    threading.Thread(target=producer, daemon=True).start()
+
+    time.sleep(0.5)
+    assert not submitted.is_set()
+
+    release.set()
+    assert submitted.wait(timeout=5)
+    work_queue.shutdown(wait=True)
+
+
+def test_adaptive_limiter_aimd() -> None:
+    """
+    The limit grows by about one per limit's worth of successes and halves on a failure
+    """
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1, max_limit=8)
+
+    for _ in range(4):
+        limiter.release(limiter.acquire(), ok=True)
+    assert limiter.limit == 4
+    for _ in range(2):
+        limiter.release(limiter.acquire(), ok=True)
+    assert limiter.limit == 5
+
+    limiter.release(limiter.acquire(), ok=False)
+    assert limiter.limit == 2
+
+    metrics = limiter.metrics()
+    assert metrics["successes"] == 6
+    assert metrics["failures"] == 1
+    assert metrics["in_flight"] == 0
+
+
+@mock.patch("nesis.api.core.util.concurrency.time")
+def test_adaptive_limiter_large_body(time: mock.MagicMock) -> None:
+    """
+    A call that takes long because it sent a large body is not taken as a slow one
+    """
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1, max_limit=8)
+    time.monotonic.side_effect = [0.0, 0.0, 1.0]
+    limiter.release(limiter.acquire(), ok=True)
+    assert limiter.metrics()["latency"] == 1.0
+
+    # 50 times the latency for 100 times the bytes
+    time.monotonic.side_effect = [10.0, 10.0, 60.0]
+    limiter.release(limiter.acquire(), ok=True, size=100 * 1024 * 1024)
+    assert limiter.limit == 4
+    assert limiter.metrics()["latency"] < 1.0
+
+    # The same time for a small body is slow
+    time.monotonic.side_effect = [100.0, 100.0, 150.0]
+    limiter.release(limiter.acquire(), ok=True, size=1024)
+    assert limiter.limit == 2
+
+
+def test_adaptive_limiter_bounds_concurrency() -> None:
+    """
+    Calls over the limit wait for a slot and are counted as waiting
+    """
+    limiter = AdaptiveLimiter(initial_limit=1, min_limit=1, max_limit=1)
+    started = limiter.acquire()
+
+    acquired = threading.Event()
+
+    def caller():
+        limiter.release(limiter.acquire(), ok=True)
+        acquired.set()
+
+    threading.Thread(target=caller, daemon=True).start()
+
+    time.sleep(0.5)
+    assert not acquired.is_set()
+    assert limiter.metrics()["waiting"] == 1
+
+    limiter.release(started, ok=True)
+    assert acquired.wait(timeout=5)
+    assert limiter.metrics()["waiting"] == 0
+
+
+def _run_in_order(executor: FairShareExecutor, flows: dict) -> list:
+    """
+    Queue items on the flows while the single worker is held up and return the order they ran in
+    """
+    release = threading.Event()
+    order = []
+    blocker = executor.queue(key="blocker")
+    blocker.submit(release.wait)
+    time.sleep(0.1)
+
+    queues = []
+    for key, (count, weight) in flows.items():
+        work_queue = executor.queue(key=key, weight=weight)
+        queues.append(work_queue)
+        for _ in range(count):
+            work_queue.submit(order.append, key)
+
+    release.set()
+    for work_queue in queues + [blocker]:
+        work_queue.shutdown(wait=True)
+    return order
+
+
+def test_fair_share_executor_interleaves() -> None:
+    """
+    A small datasource queued behind a large backlog gets an equal share of the workers
+    """
+    order = _run_in_order(
+        FairShareExecutor(max_workers=1), {"bulk": (50, 1.0), "small": (3, 1.0)}
+    )
+
+    assert len(order) == 53
+    assert order[:6].count("small") == 3
+
+
+def test_fair_share_executor_weights() -> None:
+    """
+    A datasource of higher weight gets a proportionally larger share
+    """
+    order = _run_in_order(
+        FairShareExecutor(max_workers=1), {"low": (40, 1.0), "high": (40, 3.0)}
+    )
+
+    assert order[:20].count("high") == 15
+
+
+def test_fair_share_executor_quota() -> None:
+    """
+    A datasource runs at most its quota of items at once and submit blocks once its queue is full
+    """
+    executor = FairShareExecutor(max_workers=4)
+    work_queue = executor.queue(key="datasource", quota=1, queue_size=2)
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def work():
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    for _ in range(6):
+        work_queue.submit(work)
+    assert executor.metrics()["datasource"]["queued"] <= 2
+    work_queue.shutdown(wait=True)
+
+    assert running[1] == 1
+    assert executor.metrics() == {}
@@ -1,12 +1,16 @@
+import concurrent.futures
+import http.server
 import json
 import pathlib
+import threading
 import unittest
 import unittest.mock as mock
 
 import pytest
+import requests
 
 from nesis.api import tests
-import nesis.api.core.util.http as http
+import nesis.api.core.util.http as http_util
 
 
 @pytest.fixture
@@ -14,12 +18,13 @@ def ut():
     return unittest.TestCase()
 
 
-@mock.patch("nesis.api.core.util.http.req")
-def test_upload(requests: mock.MagicMock, ut: unittest.TestCase) -> None:
+@mock.patch("nesis.api.core.util.http._session")
+def test_upload(session: mock.MagicMock, ut: unittest.TestCase) -> None:
     file_path = (
         pathlib.Path(tests.__file__).parent.absolute() / "resources/samplepptx.pptx"
     )
-    client = http.HttpClient(config=tests.config)
+    client = http_util.HttpClient(config=tests.config)
+    session.return_value.post.return_value.status_code = 200
 
     url = "http://localhost:8080/v1/ingest/files"
     metadata = {
@@ -29,8 +34,265 @@ def test_upload(requests: mock.MagicMock, ut: unittest.TestCase) -> None:
     }
 
     client.upload(url=url, filepath=file_path, field="file", metadata=metadata)
-    _, post_kwargs = requests.post.call_args_list[0]
+    _, post_kwargs = session.return_value.post.call_args_list[0]
 
     assert post_kwargs["url"] == url
     ut.assertDictEqual(json.loads(post_kwargs["params"]["metadata"]), metadata)
     ut.assertDictEqual(json.loads(post_kwargs["data"]["metadata"]), metadata)
+
+
+@mock.patch("nesis.api.core.util.http._session")
+def test_upload_stream(session: mock.MagicMock, ut: unittest.TestCase) -> None:
+    file_path = (
+        pathlib.Path(tests.__file__).parent.absolute() / "resources/samplepptx.pptx"
+    )
+    client = http_util.HttpClient(config=tests.config)
+    session.return_value.post.return_value.status_code = 200
+
+    url = "http://localhost:8080/v1/ingest/files"
+    metadata = {
+        "datasource": "datasource",
+        "file_name": "bucket/samplepptx.pptx",
+        "self_link": "http://localhost:9000/bucket/samplepptx.pptx",
+    }
+    stream = open(file_path, "rb")
+
+    client.upload(
+        url=url,
+        filepath="bucket/samplepptx.pptx",
+        field="file",
+        metadata=metadata,
+        stream=lambda: stream,
+    )
+    _, post_kwargs = session.return_value.post.call_args_list[0]
+
+    assert post_kwargs["url"] == url
+    ut.assertDictEqual(json.loads(post_kwargs["params"]["metadata"]), metadata)
+    assert "files" not in post_kwargs
+    assert post_kwargs["headers"]["Content-Type"].startswith("multipart/form-data")
+    # The stream is closed once the upload completes
+    assert stream.closed
+
+
+@mock.patch("nesis.api.core.util.http.time")
+@mock.patch("nesis.api.core.util.http._session")
+def test_upload_stream_retry(
+    session: mock.MagicMock, time: mock.MagicMock, ut: unittest.TestCase
+) -> None:
+    """
+    Test that an upload answered with a 429 is retried with a freshly opened stream
+    """
+    client = http_util.HttpClient(config=tests.config)
+
+    throttled = mock.MagicMock()
+    throttled.status_code = 429
+    throttled.headers = {"Retry-After": "2"}
+    ok = mock.MagicMock()
+    ok.status_code = 200
+    ok.text = "{}"
+    session.return_value.post.side_effect = [throttled, ok]
+
+    stream = mock.MagicMock()
+
+    response = client.upload(
+        url="http://localhost:8080/v1/ingest/files",
+        filepath="bucket/samplepptx.pptx",
+        field="file",
+        metadata={
+            "datasource": "datasource",
+            "self_link": "http://localhost:9000/bucket/samplepptx.pptx",
+        },
+        stream=stream,
+    )
+
+    assert response == "{}"
+    assert session.return_value.post.call_count == 2
+    assert stream.call_count == 2
+    time.sleep.assert_called_once_with(2.0)
+
+
+@mock.patch("nesis.api.core.util.http.time")
+@mock.patch("nesis.api.core.util.http._session")
+def test_upload_not_retried_once_sent(
+    session: mock.MagicMock, time: mock.MagicMock
+) -> None:
+    """
+    Test that an upload is retried when it failed to connect but not once it may have reached the server, since
+    ingestion is not idempotent
+    """
+    client = http_util.HttpClient(config=tests.config)
+    metadata = {
+        "datasource": "datasource",
+        "self_link": "http://localhost:9000/bucket/samplepptx.pptx",
+    }
+
+    unavailable = mock.MagicMock()
+    unavailable.status_code = 503
+    unavailable.headers = {}
+    unavailable.raise_for_status.side_effect = requests.HTTPError("503")
+    session.return_value.post.side_effect = [
+        requests.exceptions.ConnectTimeout(),
+        unavailable,
+    ]
+    with pytest.raises(requests.HTTPError):
+        client.upload(
+            url="http://localhost:8080/v1/ingest/files",
+            filepath="bucket/samplepptx.pptx",
+            field="file",
+            metadata=metadata,
+            stream=mock.MagicMock(),
+        )
+    assert session.return_value.post.call_count == 2
+
+    session.return_value.post.reset_mock()
+    session.return_value.post.side_effect = [
+        requests.exceptions.ConnectionError("Connection aborted")
+    ]
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.upload(
+            url="http://localhost:8080/v1/ingest/files",
+            filepath="bucket/samplepptx.pptx",
+            field="file",
+            metadata=metadata,
+            stream=mock.MagicMock(),
+        )
+    assert session.return_value.post.call_count == 1
+
+
+def test_keep_alive(ut: unittest.TestCase) -> None:
+    """
+    Test that requests reuse pooled connections and that the pool is reported in the metrics
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = http_util.HttpClient(config=tests.config)
+        url = f"http://127.0.0.1:{server.server_port}/"
+        assert client.get(url) == "ok"
+        assert client.get(url) == "ok"
+
+        metrics = client.pool_metrics()[f"http://127.0.0.1:{server.server_port}"]
+        assert metrics["connections"] == 1
+        assert metrics["requests"] == 2
+        assert metrics["idle"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@mock.patch("nesis.api.core.util.http._session")
+def test_upload_batched(session: mock.MagicMock, ut: unittest.TestCase) -> None:
+    """
+    Test that small uploads are sent together to the bulk endpoint and that each caller gets its own file's result
+    """
+    client = http_util.HttpClient(config=tests.config)
+    url = "http://localhost:8080/v1/ingest/files/bulk"
+
+    response = mock.MagicMock()
+    response.status_code = 200
+    response.json.return_value = {
+        "data": [
+            {"file_name": "file-0.txt", "data": [{"doc_id": "doc-0"}], "error": None},
+            {"file_name": "file-1.txt", "data": [], "error": "Unsupported file"},
+        ]
+    }
+    session.return_value.post.return_value = response
+
+    def upload(idx):
+        return client.upload_batched(
+            url=url,
+            filepath=f"bucket/file-{idx}.txt",
+            field="files",
+            metadata={
+                "datasource": "datasource",
+                "self_link": f"http://localhost:9000/bucket/file-{idx}.txt",
+            },
+            size=4,
+            max_files=2,
+            max_bytes=1024,
+            linger=30,
+            stream=lambda: mock.MagicMock(read=mock.MagicMock(return_value=b"data")),
+        )
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    futures = [pool.submit(upload, idx) for idx in range(2)]
+    results = [future.exception() or future.result() for future in futures]
+    pool.shutdown()
+
+    # Both files go out in one request, well before the linger expires
+    assert session.return_value.post.call_count == 1
+    _, post_kwargs = session.return_value.post.call_args
+    assert post_kwargs["url"] == url
+    assert [name for name, _ in post_kwargs["files"]] == ["files", "files"]
+    ut.assertListEqual(
+        sorted(
+            item["self_link"] for item in json.loads(post_kwargs["data"]["metadata"])
+        ),
+        [
+            "http://localhost:9000/bucket/file-0.txt",
+            "http://localhost:9000/bucket/file-1.txt",
+        ],
+    )
+
+    # The first file of the batch succeeded and the second failed
+    ok = [result for result in results if isinstance(result, str)]
+    failed = [result for result in results if isinstance(result, Exception)]
+    assert len(ok) == 1 and len(failed) == 1
+    assert isinstance(failed[0], ValueError)
+    assert json.loads(ok[0])["data"] == [{"doc_id": "doc-0"}]
+
+
+@mock.patch.dict("nesis.api.core.util.http._limiters", clear=True)
+@mock.patch("nesis.api.core.util.http.time")
+@mock.patch("nesis.api.core.util.http._session")
+def test_upload_limiter(
+    session: mock.MagicMock, time: mock.MagicMock, ut: unittest.TestCase
+) -> None:
+    """
+    Test that an overloaded endpoint cuts the upload concurrency limit and that it shows in the metrics
+    """
+    config = {
+        **tests.config,
+        "http": {"client": {"limiter": {"initial": 8, "max": 16}}},
+    }
+    client = http_util.HttpClient(config=config)
+
+    unavailable = mock.MagicMock()
+    unavailable.status_code = 503
+    unavailable.headers = {}
+    ok = mock.MagicMock()
+    ok.status_code = 200
+    ok.text = "{}"
+    session.return_value.post.side_effect = [unavailable, ok]
+
+    for _ in range(2):
+        client.upload(
+            url="http://localhost:8080/v1/ingest/files",
+            filepath="bucket/samplepptx.pptx",
+            field="file",
+            metadata={
+                "datasource": "datasource",
+                "self_link": "http://localhost:9000/bucket/samplepptx.pptx",
+            },
+            stream=mock.MagicMock(),
+        )
+
+    metrics = client.limiter_metrics()["http://localhost:8080"]
+    assert metrics["limit"] == 4
+    assert metrics["failures"] == 1
+    assert metrics["successes"] == 1
+    assert metrics["in_flight"] == 0
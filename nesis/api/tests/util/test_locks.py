@@ -0,0 +1,109 @@
+import unittest.mock as mock
+import uuid
+
+import memcache
+import pytest
+
+from nesis.api import tests
+from nesis.api.core.util.locks import (
+    LockManager,
+    MemcacheLockBackend,
+    PostgresLockBackend,
+)
+
+
+@pytest.fixture
+def keys() -> list:
+    return [f"http://localhost:9000/bucket/{uuid.uuid4()}" for _ in range(3)]
+
+
+@pytest.fixture(params=["memcache", "postgres"])
+def backends(request) -> list:
+    """
+    Two backends, standing for two processes
+    """
+    if request.param == "memcache":
+        cache_client = memcache.Client(tests.config["memcache"]["hosts"])
+        return [MemcacheLockBackend(cache_client) for _ in range(2)]
+    return [PostgresLockBackend(url=tests.config["database"]["url"]) for _ in range(2)]
+
+
+def test_acquire_release(backends, keys) -> None:
+    first = LockManager(backend=backends[0], ttl=30)
+    second = LockManager(backend=backends[1], ttl=30)
+
+    leases = first.acquire(keys)
+    assert set(leases.keys()) == set(keys)
+    assert all(lease.held for lease in leases.values())
+
+    # The keys are held elsewhere, apart from the new one
+    other_key = f"{keys[0]}/other"
+    assert set(second.acquire(keys + [other_key]).keys()) == {other_key}
+    # Nor can the same process lock them twice
+    assert first.acquire(keys) == {}
+
+    first.release(list(leases.values()))
+    second_leases = second.acquire(keys)
+    assert set(second_leases.keys()) == set(keys)
+    # Fencing tokens grow with every lease
+    assert min(lease.token for lease in second_leases.values()) > max(
+        lease.token for lease in leases.values()
+    )
+    second.release(list(second_leases.values()))
+
+
+def test_lock_context(backends, keys) -> None:
+    first = LockManager(backend=backends[0], ttl=30)
+    second = LockManager(backend=backends[1], ttl=30)
+
+    with first.lock(keys[0]) as lease:
+        assert lease is not None
+        with second.lock(keys[0]) as other_lease:
+            assert other_lease is None
+    with second.lock(keys[0]) as other_lease:
+        assert other_lease is not None
+
+
+def test_memcache_lease_lost(keys) -> None:
+    """
+    A lease taken over by another holder is marked lost on the next renewal
+    """
+    cache_client = memcache.Client(tests.config["memcache"]["hosts"])
+    backend = MemcacheLockBackend(cache_client)
+    manager = LockManager(backend=backend, ttl=30)
+
+    lease = manager.acquire([keys[0]])[keys[0]]
+    cache_client.set(backend._key(keys[0]), "someone-else:0", time=30)
+    manager._renew()
+
+    assert not lease.held
+    manager.release([lease])
+    # The release leaves the other holder's lock alone
+    assert cache_client.get(backend._key(keys[0])) == "someone-else:0"
+    cache_client.delete(backend._key(keys[0]))
+
+
+def test_memcache_round_trips(keys) -> None:
+    """
+    Locking a file costs an add and a delete, the fencing tokens being drawn from a block reserved at once
+    """
+    cache_client = mock.Mock(wraps=memcache.Client(tests.config["memcache"]["hosts"]))
+    backend = MemcacheLockBackend(cache_client)
+    manager = LockManager(backend=backend, ttl=30)
+    # The counter may not exist yet
+    backend._reserve(1)
+    cache_client.reset_mock()
+
+    tokens = []
+    for key in keys:
+        with manager.lock(key) as lease:
+            assert lease is not None
+            tokens.append(lease.token)
+
+    assert tokens == sorted(set(tokens))
+    assert cache_client.incr.call_count == 1
+    assert cache_client.add.call_count == len(keys)
+    assert cache_client.delete_multi.call_count == len(keys)
+    cache_client.get_multi.assert_not_called()
+    # The locks were released
+    assert manager.acquire(keys).keys() == set(keys)
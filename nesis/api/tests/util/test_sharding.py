@@ -0,0 +1,46 @@
+import uuid
+
+import memcache
+
+from nesis.api import tests
+from nesis.api.core.util.sharding import HashRing, ShardMembership
+
+
+def test_hash_ring_rebalance() -> None:
+    """
+    When a member joins, it takes a share of the keys and only keys it takes change owner
+    """
+    keys = [str(uuid.uuid4()) for _ in range(2000)]
+    ring = HashRing(members=["a", "b", "c"])
+    owners = {key: ring.owner(key) for key in keys}
+    assert set(owners.values()) == {"a", "b", "c"}
+
+    grown = HashRing(members=["a", "b", "c", "d"])
+    moved = [key for key in keys if grown.owner(key) != owners[key]]
+    assert all(grown.owner(key) == "d" for key in moved)
+    assert 0 < len(moved) < len(keys) / 2
+
+
+def test_hash_ring_empty() -> None:
+    assert HashRing(members=[]).owner("key") is None
+
+
+def test_membership() -> None:
+    """
+    Replicas see each other once joined and drop out of the ring when they leave
+    """
+    cache_client = memcache.Client(tests.config["memcache"]["hosts"])
+    first = ShardMembership(cache_client=cache_client, member_id="first")
+    second = ShardMembership(cache_client=cache_client, member_id="second")
+    try:
+        first.join()
+        second.join()
+        assert first.members() == ["first", "second"]
+        assert len(first.ring()) == 2
+
+        second.leave()
+        assert first.members() == ["first"]
+        assert {first.ring().owner(str(idx)) for idx in range(100)} == {"first"}
+    finally:
+        first.leave()
+        second.leave()
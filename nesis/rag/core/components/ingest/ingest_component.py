@@ -5,6 +5,7 @@ import multiprocessing
 import multiprocessing.pool
 import os
 import threading
+import uuid
 from pathlib import Path
 from typing import Any
 
@@ -18,6 +19,7 @@ from llama_index.core import (
 from llama_index.core.data_structs import IndexDict
 from llama_index.core.indices.base import BaseIndex
 from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo
 
 from nesis.rag.core.components.ingest.ingest_helper import IngestionHelper
 from nesis.rag.core.paths import local_data_path
@@ -25,6 +27,23 @@ from nesis.rag.core.settings.settings import Settings
 
 logger = logging.getLogger(__name__)
 
+BulkIngestResult = list[Document] | Exception
+
+
+def _transform_file(
+    file_name: str, file_data: Path, metadata: dict | None
+) -> BulkIngestResult:
+    """Transform one file of a bulk ingest, returning the failure instead of raising it so that one bad file
+    does not fail the whole batch. The error is flattened to a plain Exception so it can cross a process boundary.
+    """
+    try:
+        return IngestionHelper.transform_file_into_documents(
+            file_name, file_data, metadata
+        )
+    except Exception as ex:
+        logger.warning("Failed to transform file=%s", file_name, exc_info=True)
+        return Exception(str(ex))
+
 
 class BaseIngestComponent(abc.ABC):
     def __init__(
@@ -45,13 +64,35 @@ class BaseIngestComponent(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[Document]:
+    def bulk_ingest(
+        self, files: list[tuple[str, Path, dict | None]]
+    ) -> list[BulkIngestResult]:
+        """Ingest several files at once. The result holds, for each file in order, either its documents or
+        the exception that made it fail.
+        """
         pass
 
     @abc.abstractmethod
     def delete(self, doc_id: str) -> None:
         pass
 
+    @abc.abstractmethod
+    def bulk_delete(self, doc_ids: list[str]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def relink(
+        self,
+        doc_ids: list[str],
+        new_doc_ids: list[str],
+        metadata: dict,
+        new_metadata: dict,
+    ) -> None:
+        """Move the nodes of the documents doc_ids over to new_doc_ids, swapping their link metadata for
+        new_metadata.
+        """
+        pass
+
 
 class BaseIngestComponentWithIndex(BaseIngestComponent, abc.ABC):
     def __init__(
@@ -92,6 +133,16 @@ class BaseIngestComponentWithIndex(BaseIngestComponent, abc.ABC):
             index.storage_context.persist(persist_dir=local_data_path)
         return index
 
+    def _save_bulk_docs(self, results: list[BulkIngestResult]) -> None:
+        """Save the documents of all the successfully transformed files with a single index write."""
+        documents = list(
+            itertools.chain.from_iterable(
+                result for result in results if not isinstance(result, Exception)
+            )
+        )
+        if documents:
+            self._save_docs(documents)
+
     def _save_index(self) -> None:
         self._index.storage_context.persist(persist_dir=local_data_path)
 
@@ -103,6 +154,70 @@ class BaseIngestComponentWithIndex(BaseIngestComponent, abc.ABC):
             # Save the index
             self._save_index()
 
+    def bulk_delete(self, doc_ids: list[str]) -> None:
+        with self._index_thread_lock:
+            for doc_id in doc_ids:
+                self._index.delete_ref_doc(doc_id, delete_from_docstore=True)
+
+            # Persisting rewrites the stores so we only do it once for all the documents
+            self._save_index()
+
+    def relink(
+        self,
+        doc_ids: list[str],
+        new_doc_ids: list[str],
+        metadata: dict,
+        new_metadata: dict,
+    ) -> None:
+        with self._index_thread_lock:
+            docstore = self._index.docstore
+            nodes = []
+            for doc_id, new_doc_id in zip(doc_ids, new_doc_ids):
+                ref_doc_info = docstore.get_ref_doc_info(doc_id)
+                if ref_doc_info is None:
+                    continue
+                for node in docstore.get_nodes(ref_doc_info.node_ids):
+                    node = node.copy()
+                    node.metadata = {
+                        **{
+                            key: value
+                            for key, value in node.metadata.items()
+                            if key not in metadata
+                        },
+                        **new_metadata,
+                        "doc_id": new_doc_id,
+                    }
+                    node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(
+                        node_id=new_doc_id
+                    )
+                    nodes.append(node)
+
+            # Give the nodes new ids and point their siblings at them
+            node_ids = {node.node_id: str(uuid.uuid4()) for node in nodes}
+            for node in nodes:
+                node.id_ = node_ids[node.node_id]
+                for relationship, related in list(node.relationships.items()):
+                    if (
+                        isinstance(related, RelatedNodeInfo)
+                        and related.node_id in node_ids
+                    ):
+                        node.relationships[relationship] = RelatedNodeInfo(
+                            node_id=node_ids[related.node_id]
+                        )
+
+            # The vector store does not hand the embeddings back, and the link metadata is embedded with the
+            # text, so the nodes are embedded again. They are not parsed again.
+            logger.info("Re-embedding count=%s relinked nodes", len(nodes))
+            nodes = run_transformations(
+                nodes,  # type: ignore[arg-type]
+                [self.service_context.embed_model],
+                show_progress=self.show_progress,
+            )
+            self._index.insert_nodes(nodes, show_progress=True)
+            for doc_id in doc_ids:
+                self._index.delete_ref_doc(doc_id, delete_from_docstore=True)
+            self._save_index()
+
 
 class SimpleIngestComponent(BaseIngestComponentWithIndex):
     def __init__(
@@ -127,14 +242,12 @@ class SimpleIngestComponent(BaseIngestComponentWithIndex):
         logger.debug("Saving the documents in the index and doc store")
         return self._save_docs(documents)
 
-    def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[Document]:
-        saved_documents = []
-        for file_name, file_data in files:
-            documents = IngestionHelper.transform_file_into_documents(
-                file_name, file_data
-            )
-            saved_documents.extend(self._save_docs(documents))
-        return saved_documents
+    def bulk_ingest(
+        self, files: list[tuple[str, Path, dict | None]]
+    ) -> list[BulkIngestResult]:
+        results = [_transform_file(*file) for file in files]
+        self._save_bulk_docs(results)
+        return results
 
     def _save_docs(self, documents: list[Document]) -> list[Document]:
         logger.debug("Transforming count=%s documents into nodes", len(documents))
@@ -188,20 +301,13 @@ class BatchIngestComponent(BaseIngestComponentWithIndex):
         logger.debug("Saving the documents in the index and doc store")
         return self._save_docs(documents)
 
-    def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[Document]:
-        documents = list(
-            itertools.chain.from_iterable(
-                self._file_to_documents_work_pool.starmap(
-                    IngestionHelper.transform_file_into_documents, files
-                )
-            )
-        )
-        logger.info(
-            "Transformed count=%s files into count=%s documents",
-            len(files),
-            len(documents),
-        )
-        return self._save_docs(documents)
+    def bulk_ingest(
+        self, files: list[tuple[str, Path, dict | None]]
+    ) -> list[BulkIngestResult]:
+        results = self._file_to_documents_work_pool.starmap(_transform_file, files)
+        logger.info("Transformed count=%s files", len(files))
+        self._save_bulk_docs(results)
+        return results
 
     def _save_docs(self, documents: list[Document]) -> list[Document]:
         logger.debug("Transforming count=%s documents into nodes", len(documents))
@@ -276,16 +382,21 @@ class ParallelizedIngestComponent(BaseIngestComponentWithIndex):
         logger.debug("Saving the documents in the index and doc store")
         return self._save_docs(documents)
 
-    def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[Document]:
+    def bulk_ingest(
+        self, files: list[tuple[str, Path, dict | None]]
+    ) -> list[BulkIngestResult]:
         # Lightweight threads, used for parallelize the
         # underlying IO calls made in the ingestion
+        return self._ingest_work_pool.starmap(self._ingest_one, files)
 
-        documents = list(
-            itertools.chain.from_iterable(
-                self._ingest_work_pool.starmap(self.ingest, files)
-            )
-        )
-        return documents
+    def _ingest_one(
+        self, file_name: str, file_data: Path, metadata: dict | None
+    ) -> BulkIngestResult:
+        try:
+            return self.ingest(file_name, file_data, metadata)
+        except Exception as ex:
+            logger.warning("Failed to ingest file=%s", file_name, exc_info=True)
+            return ex
 
     def _save_docs(self, documents: list[Document]) -> list[Document]:
         logger.debug("Transforming count=%s documents into nodes", len(documents))
@@ -0,0 +1,196 @@
+import contextlib
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Iterator
+
+logger = logging.getLogger(__name__)
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS content_link (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content_hash TEXT NOT NULL,
+    doc_ids TEXT NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS content_link_content_hash ON content_link (content_hash, id);
+CREATE TABLE IF NOT EXISTS content_document (
+    doc_id TEXT PRIMARY KEY,
+    link_id INTEGER NOT NULL
+);
+"""
+
+
+def hash_file(file_data: Path) -> str:
+    """The sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(file_data, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_filter_key(key: str, value: Any) -> str:
+    """The metadata key flagging the nodes of a content linked to an upload whose metadata has key set to value.
+    Values are free text, so they are hashed into a key every vector store accepts.
+    """
+    digest = hashlib.sha256(str(value).encode("utf-8")).hexdigest()[:16]
+    return f"link_{key}_{digest}"
+
+
+def link_filters(links: list[dict], keys: list[str]) -> set[str]:
+    """The link filter keys of the given links for the metadata keys."""
+    return {
+        link_filter_key(key, link["metadata"][key])
+        for link in links
+        for key in keys
+        if isinstance(link["metadata"].get(key), (str, int, float))
+    }
+
+
+class ContentStore:
+    """Content addressed registry of the ingested files.
+
+    The nodes and embeddings of a file are stored once per content hash. Every upload of that content, from
+    whichever datasource, is a link holding its own doc ids and metadata. The first link owns the nodes, which
+    carry its metadata and the content hash, and the other links point at them. The nodes are flagged with the
+    `link_filter_key` of the other links, so that a metadata filter matches them, and retrieved nodes are given
+    the metadata of the link matching the filter.
+
+    An entry looks like `{"doc_ids": [...], "links": [{"doc_ids": [...], "metadata": {...}}, ...]}` where
+    `links[0]` is the link owning the nodes. Links are rows of a sqlite database, so each change writes only the
+    link it touches.
+    """
+
+    def __init__(self, persist_path: str = ":memory:"):
+        self._connection = sqlite3.connect(persist_path, check_same_thread=False)
+        if persist_path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._content_locks: dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "ContentStore":
+        content_store = cls(str(Path(persist_dir) / "content_store.db"))
+        json_path = Path(persist_dir) / "content_store.json"
+        if json_path.exists():
+            content_store._import_json(json_path)
+        return content_store
+
+    @contextlib.contextmanager
+    def lock(self, content_hash: str) -> Iterator[None]:
+        """Serialize the ingestion and deletion of a content so that it is only ever ingested once."""
+        with self._lock:
+            content_lock = self._content_locks[content_hash]
+        with content_lock:
+            yield
+
+    def get(self, content_hash: str) -> dict | None:
+        with self._lock:
+            links = [
+                {"doc_ids": json.loads(doc_ids), "metadata": json.loads(metadata)}
+                for doc_ids, metadata in self._connection.execute(
+                    "SELECT doc_ids, metadata FROM content_link WHERE content_hash = ? ORDER BY id",
+                    (content_hash,),
+                )
+            ]
+        if not links:
+            return None
+        return {"doc_ids": links[0]["doc_ids"], "links": links}
+
+    def content_hash(self, doc_id: str) -> str | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT l.content_hash FROM content_document d JOIN content_link l ON l.id = d.link_id "
+                "WHERE d.doc_id = ?",
+                (doc_id,),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def register(self, content_hash: str, doc_ids: list[str], metadata: dict) -> None:
+        """Record a newly ingested content, owned by the link of doc_ids."""
+        with self._lock, self._connection:
+            self._insert(content_hash, doc_ids, metadata)
+
+    def link(self, content_hash: str, metadata: dict) -> list[str] | None:
+        """Link metadata to an already ingested content. Returns the doc ids of the new link, one for each of the
+        content's documents, or None if the content is not known.
+        """
+        entry = self.get(content_hash)
+        if entry is None:
+            return None
+        doc_ids = [str(uuid.uuid4()) for _ in entry["doc_ids"]]
+        with self._lock, self._connection:
+            self._insert(content_hash, doc_ids, metadata)
+        return doc_ids
+
+    def unlink(self, doc_id: str) -> dict | None:
+        """Remove the link holding doc_id and return it, or None if doc_id is not linked to any content. When the
+        removed link owned the nodes, the next link takes them over, so the caller moves the nodes over to it first.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT l.id, l.doc_ids, l.metadata FROM content_document d JOIN content_link l "
+                "ON l.id = d.link_id WHERE d.doc_id = ?",
+                (doc_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            link_id, doc_ids, metadata = row
+            self._connection.execute(
+                "DELETE FROM content_document WHERE link_id = ?", (link_id,)
+            )
+            self._connection.execute(
+                "DELETE FROM content_link WHERE id = ?", (link_id,)
+            )
+        return {"doc_ids": json.loads(doc_ids), "metadata": json.loads(metadata)}
+
+    def links(self) -> Iterator[tuple[str, dict]]:
+        """The content hash and link of every link that does not own its nodes."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT l.content_hash, l.doc_ids, l.metadata FROM content_link l "
+                "WHERE l.id > (SELECT min(o.id) FROM content_link o WHERE o.content_hash = l.content_hash) "
+                "ORDER BY l.id"
+            ).fetchall()
+        for content_hash, doc_ids, metadata in rows:
+            yield content_hash, {
+                "doc_ids": json.loads(doc_ids),
+                "metadata": json.loads(metadata),
+            }
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _insert(self, content_hash: str, doc_ids: list[str], metadata: dict) -> None:
+        link_id = self._connection.execute(
+            "INSERT INTO content_link (content_hash, doc_ids, metadata) VALUES (?, ?, ?)",
+            (content_hash, json.dumps(doc_ids), json.dumps(metadata)),
+        ).lastrowid
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO content_document (doc_id, link_id) VALUES (?, ?)",
+            [(doc_id, link_id) for doc_id in doc_ids],
+        )
+
+    def _import_json(self, json_path: Path) -> None:
+        """Import the registry of an earlier release, persisted as one json file, and set the file aside."""
+        with self._lock:
+            imported = self._connection.execute(
+                "SELECT count(*) FROM content_link"
+            ).fetchone()[0]
+        if not imported:
+            data = json.loads(json_path.read_text())
+            entries = data.get("content") or {}
+            logger.info("Importing count=%s contents from %s", len(entries), json_path)
+            with self._lock, self._connection:
+                for content_hash, entry in entries.items():
+                    for link in entry["links"]:
+                        self._insert(content_hash, link["doc_ids"], link["metadata"])
+        json_path.rename(json_path.with_suffix(".json.imported"))
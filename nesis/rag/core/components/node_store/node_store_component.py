@@ -5,7 +5,9 @@ from llama_index.core.storage.docstore import BaseDocumentStore, SimpleDocumentS
 from llama_index.core.storage.index_store import SimpleIndexStore
 from llama_index.core.storage.index_store.types import BaseIndexStore
 
+from nesis.rag.core.components.node_store.content_store import ContentStore
 from nesis.rag.core.paths import local_data_path
+from nesis.rag.core.settings.settings import Settings
 
 logger = logging.getLogger(__name__)
 
@@ -14,9 +16,10 @@ logger = logging.getLogger(__name__)
 class NodeStoreComponent:
     index_store: BaseIndexStore
     doc_store: BaseDocumentStore
+    content_store: ContentStore | None
 
     @inject
-    def __init__(self) -> None:
+    def __init__(self, settings: Settings) -> None:
         try:
             self.index_store = SimpleIndexStore.from_persist_dir(
                 persist_dir=str(local_data_path)
@@ -32,3 +35,10 @@ class NodeStoreComponent:
         except FileNotFoundError:
             logger.debug("Local document store not found, creating a new one")
             self.doc_store = SimpleDocumentStore()
+
+        # Only deduplicated embeddings are tracked by content hash
+        self.content_store = (
+            ContentStore.from_persist_dir(persist_dir=str(local_data_path))
+            if settings.embedding.deduplicate
+            else None
+        )
@@ -1,15 +1,26 @@
+import json
 import logging
 import typing
 
 from injector import inject, singleton
 from llama_index.core import VectorStoreIndex
 from llama_index.core.indices.vector_store import VectorIndexRetriever
+from llama_index.core.schema import (
+    NodeRelationship,
+    NodeWithScore,
+    QueryBundle,
+    RelatedNodeInfo,
+)
 from llama_index.core.vector_stores.types import (
     VectorStore,
     MetadataFilters,
     MetadataFilter,
 )
 
+from nesis.rag.core.components.node_store.content_store import (
+    ContentStore,
+    link_filter_key,
+)
 from nesis.rag.core.open_ai.extensions.context_filter import ContextFilter
 from nesis.rag.core.paths import local_data_path
 from nesis.rag.core.settings.settings import Settings
@@ -70,6 +81,7 @@ class VectorStoreComponent:
 
     @inject
     def __init__(self, settings: Settings) -> None:
+        self.database = settings.vectorstore.database
         match settings.vectorstore.database:
             case "chroma":
                 try:
@@ -161,20 +173,75 @@ class VectorStoreComponent:
                     f"Vectorstore database {settings.vectorstore.database} not supported"
                 )
 
+    def update_metadata(self, node_ids: list[str], metadata: dict) -> None:
+        """Merge metadata into the stored metadata of the nodes, leaving their text and embeddings as they are."""
+        if not node_ids or not metadata:
+            return
+        store = self.vector_store
+        match self.database:
+            case "chroma":
+                # chroma merges the given keys into the nodes' metadata
+                store._collection.update(
+                    ids=node_ids, metadatas=[metadata for _ in node_ids]
+                )
+            case "qdrant":
+                store.client.set_payload(
+                    collection_name=store.collection_name,
+                    payload=metadata,
+                    points=node_ids,
+                )
+            case "pgvector":
+                from sqlalchemy import text
+
+                store._initialize()
+                with store._session() as session, session.begin():
+                    session.execute(
+                        text(
+                            f"UPDATE {store._table_class.__tablename__} "
+                            "SET metadata_ = metadata_ || CAST(:metadata AS jsonb) "
+                            "WHERE node_id = ANY(:node_ids)"
+                        ),
+                        {"metadata": json.dumps(metadata), "node_ids": node_ids},
+                    )
+            case _:
+                raise ValueError(f"Vectorstore database {self.database} not supported")
+
     @staticmethod
     def get_retriever(
         index: VectorStoreIndex,
         context_filter: ContextFilter | None = None,
         similarity_top_k: int = 2,
+        content_store: ContentStore | None = None,
     ) -> VectorIndexRetriever:
+        """The nodes of a content shared by several uploads carry the metadata of only one of them. With a
+        content_store, the filters also match the link filter keys the nodes are flagged with, see
+        `ContentStore`, and the retrieved nodes are given the metadata of the upload matching the filters.
+        """
         metadata_filters = None
         if context_filter is not None and context_filter.filters is not None:
-            metadata_filters = MetadataFilters(
-                filters=[
-                    MetadataFilter(key=key, value=value, operator="==")
+            filters = [
+                MetadataFilter(key=key, value=value, operator="==")
+                for key, value_list in context_filter.filters.items()
+                for value in value_list
+            ]
+            if content_store is not None:
+                filters.extend(
+                    MetadataFilter(
+                        key=link_filter_key(key, value), value="1", operator="=="
+                    )
                     for key, value_list in context_filter.filters.items()
                     for value in value_list
-                ],
+                )
+                metadata_filters = MetadataFilters(filters=filters, condition="or")
+                return _LinkedContentRetriever(
+                    index=index,
+                    similarity_top_k=similarity_top_k,
+                    filters=metadata_filters,
+                    content_store=content_store,
+                    context_filter=context_filter,
+                )
+            metadata_filters = MetadataFilters(
+                filters=filters,
                 condition="or",
             )
         return VectorIndexRetriever(
@@ -186,3 +253,71 @@ class VectorStoreComponent:
     def close(self) -> None:
         if hasattr(self.vector_store.client, "close"):
             self.vector_store.client.close()
+
+
+class _LinkedContentRetriever(VectorIndexRetriever):
+    """Gives the retrieved nodes of a shared content the doc ids and metadata of the upload matching the filters,
+    rather than those of the upload owning the nodes, which the filters may not allow.
+    """
+
+    def __init__(
+        self,
+        content_store: ContentStore,
+        context_filter: ContextFilter,
+        **kwargs: typing.Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self._content_store = content_store
+        self._filters = context_filter.filters
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        return self._relink(super()._retrieve(query_bundle))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        return self._relink(await super()._aretrieve(query_bundle))
+
+    def _matches(self, metadata: dict) -> bool:
+        return any(metadata.get(key) in values for key, values in self._filters.items())
+
+    def _relink(self, nodes: list[NodeWithScore]) -> list[NodeWithScore]:
+        relinked = []
+        for node in nodes:
+            metadata = node.node.metadata
+            if self._matches(metadata):
+                relinked.append(node)
+                continue
+            entry = (
+                self._content_store.get(metadata["content_hash"])
+                if "content_hash" in metadata
+                else None
+            )
+            link = next(
+                (
+                    link
+                    for link in (entry or {}).get("links", [])[1:]
+                    if self._matches(link["metadata"])
+                ),
+                None,
+            )
+            if link is None or node.node.ref_doc_id not in entry["doc_ids"]:
+                # Flagged for an upload that is gone, none of its metadata can be handed out
+                logger.debug("Dropping node=%s not matching the filters", node.node_id)
+                continue
+            doc_id = link["doc_ids"][entry["doc_ids"].index(node.node.ref_doc_id)]
+            owner_metadata = entry["links"][0]["metadata"]
+            node.node = node.node.copy()
+            node.node.metadata = {
+                **{
+                    key: value
+                    for key, value in metadata.items()
+                    if key not in owner_metadata
+                },
+                **link["metadata"],
+                "doc_id": doc_id,
+            }
+            node.node.relationships = {
+                **node.node.relationships,
+                NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc_id),
+            }
+            relinked.append(node)
+        return relinked
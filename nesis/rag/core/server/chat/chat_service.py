@@ -90,6 +90,11 @@ class ChatService:
             docstore=node_store_component.doc_store,
             index_store=node_store_component.index_store,
         )
+        self.content_store = (
+            node_store_component.content_store
+            if settings.embedding.deduplicate
+            else None
+        )
         self.service_context = ServiceContext.from_defaults(
             llm=llm_component.llm, embed_model=embedding_component.embedding_model
         )
@@ -111,6 +116,7 @@ class ChatService:
                 index=self.index,
                 context_filter=context_filter,
                 similarity_top_k=self.settings.vectorstore.similarity_top_k,
+                content_store=self.content_store,
             )
             memory = ChatMemoryBuffer.from_defaults(
                 token_limit=self.settings.llm.token_limit
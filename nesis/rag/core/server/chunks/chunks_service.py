@@ -17,6 +17,7 @@ from nesis.rag.core.components.vector_store.vector_store_component import (
 )
 from nesis.rag.core.open_ai.extensions.context_filter import ContextFilter
 from nesis.rag.core.server.ingest.model import IngestedDoc
+from nesis.rag.core.settings.settings import Settings
 
 if TYPE_CHECKING:
     from llama_index.schema import RelatedNodeInfo
@@ -65,6 +66,7 @@ class ChunksService:
         vector_store_component: VectorStoreComponent,
         embedding_component: EmbeddingComponent,
         node_store_component: NodeStoreComponent,
+        settings: Settings,
     ) -> None:
         self.vector_store_component = vector_store_component
         self.storage_context = StorageContext.from_defaults(
@@ -72,6 +74,11 @@ class ChunksService:
             docstore=node_store_component.doc_store,
             index_store=node_store_component.index_store,
         )
+        self.content_store = (
+            node_store_component.content_store
+            if settings.embedding.deduplicate
+            else None
+        )
         self.query_service_context = ServiceContext.from_defaults(
             llm=llm_component.llm, embed_model=embedding_component.embedding_model
         )
@@ -111,7 +118,10 @@ class ChunksService:
             show_progress=True,
         )
         vector_index_retriever = self.vector_store_component.get_retriever(
-            index=index, context_filter=context_filter, similarity_top_k=limit
+            index=index,
+            context_filter=context_filter,
+            similarity_top_k=limit,
+            content_store=self.content_store,
         )
         nodes = vector_index_retriever.retrieve(text)
         nodes.sort(key=lambda n: n.score or 0.0, reverse=True)
@@ -1,6 +1,7 @@
 import json
 import logging
 import pathlib
+import shutil
 import tempfile
 from typing import Literal
 from nesis.rag.core.utils.strings import file_encoding
@@ -11,7 +12,7 @@ from pydantic import BaseModel, Field
 
 from nesis.rag.core.server import ServiceException
 from nesis.rag.core.server.ingest.ingest_service import IngestService
-from nesis.rag.core.server.ingest.model import IngestedDoc
+from nesis.rag.core.server.ingest.model import IngestedDoc, IngestedFile
 
 ingest_router = APIRouter(prefix="/v1")
 
@@ -30,6 +31,10 @@ class IngestTextBody(BaseModel):
     )
 
 
+class DeleteDocumentsBody(BaseModel):
+    doc_ids: list[str] = Field(examples=[["c202d5e6-7b69-4869-81cc-dd574ee8ee11"]])
+
+
 class IngestResponse(BaseModel):
     object: Literal["list"]
     model: Literal["rag"]
@@ -70,8 +75,8 @@ def ingest_file(
         if file.content_type is not None and file.content_type.startswith("text"):
             with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
                 try:
-                    with open(tmp_file.name, "wb") as file_descriptor:
-                        file_descriptor.write(file.file.read())
+                    shutil.copyfileobj(file.file, tmp_file)
+                    tmp_file.close()
 
                     encoding = file_encoding(tmp_file.name)
                     text = pathlib.Path(tmp_file.name).read_text(
@@ -83,6 +88,7 @@ def ingest_file(
 
                 finally:
                     tmp_file.close()
+                    pathlib.Path(tmp_file.name).unlink()
 
         else:
             ingested_documents = service.ingest_bin_data(
@@ -95,6 +101,68 @@ def ingest_file(
     return IngestResponse(object="list", model="rag", data=ingested_documents)
 
 
+class BulkIngestResponse(BaseModel):
+    object: Literal["list"]
+    model: Literal["rag"]
+    data: list[IngestedFile]
+
+
+def _spool_upload(file: UploadFile) -> pathlib.Path:
+    """Copy an uploaded file to a temporary file. Text files are re-encoded as utf-8 the same way the single
+    file endpoint reads them."""
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+        shutil.copyfileobj(file.file, tmp_file)
+    path = pathlib.Path(tmp_file.name)
+    if file.content_type is not None and file.content_type.startswith("text"):
+        encoding = file_encoding(tmp_file.name)
+        text = path.read_text(encoding=encoding, errors="replace")
+        path.write_text(text, encoding="utf-8")
+    return path
+
+
+@ingest_router.post("/ingest/files/bulk", tags=["Ingestion"])
+def ingest_files(
+    request: Request, files: list[UploadFile], metadata: str = Form(...)
+) -> BulkIngestResponse:
+    """Ingests and processes several files in one request.
+
+    `metadata` is a JSON list holding the metadata of each file, in the same order as `files`.
+    The files are transformed together and their documents saved to the index in one write. The response
+    holds one entry per file, in order, with either its Documents or the error that made it fail, so a bad
+    file does not fail the rest of the batch.
+    """
+
+    service = request.state.injector.get(IngestService)
+    if any(file.filename is None for file in files):
+        raise HTTPException(400, "No file name provided")
+    try:
+        _metadata = json.loads(metadata)
+    except ValueError:
+        error = "Invalid of missing metadata field"
+        _logger.exception(error)
+        raise HTTPException(400, error)
+    if not isinstance(_metadata, list) or len(_metadata) != len(files):
+        raise HTTPException(400, "Expected one metadata entry per file")
+
+    paths: list[pathlib.Path] = []
+    try:
+        for file in files:
+            paths.append(_spool_upload(file))
+        ingested_files = service.bulk_ingest(
+            [
+                (file.filename, path, file_metadata)
+                for file, path, file_metadata in zip(files, paths, _metadata)
+            ]
+        )
+    except ServiceException as se:
+        _logger.exception("Error ingesting files")
+        raise HTTPException(400, str(se))
+    finally:
+        for path in paths:
+            path.unlink(missing_ok=True)
+    return BulkIngestResponse(object="list", model="rag", data=ingested_files)
+
+
 @ingest_router.post("/ingest/texts", tags=["Ingestion"])
 def ingest_text(request: Request, body: IngestTextBody) -> IngestResponse:
     """Ingests and processes a text, storing its chunks to be used as context.
@@ -127,6 +195,17 @@ def list_ingested(request: Request) -> IngestResponse:
     return IngestResponse(object="list", model="rag", data=ingested_documents)
 
 
+@ingest_router.post("/ingest/documents/delete", tags=["Ingestion"])
+def delete_ingested_documents(request: Request, body: DeleteDocumentsBody) -> None:
+    """Delete many ingested Documents at once.
+
+    The documents are deleted under a single index lock and the storage context is persisted
+    once, rather than once per document.
+    """
+    service = request.state.injector.get(IngestService)
+    service.bulk_delete(body.doc_ids)
+
+
 @ingest_router.delete("/ingest/documents/{doc_id}", tags=["Ingestion"])
 def delete_ingested(request: Request, doc_id: str) -> None:
     """Delete the specified ingested Document.
@@ -1,4 +1,6 @@
+import contextlib
 import logging
+import shutil
 import tempfile
 from pathlib import Path
 from typing import AnyStr, BinaryIO
@@ -16,18 +18,27 @@ from nesis.rag.core.components.embedding.embedding_component import (
 )
 from nesis.rag.core.components.ingest.ingest_component import get_ingestion_component
 from nesis.rag.core.components.llm.llm_component import LLMComponent
+from nesis.rag.core.components.node_store.content_store import (
+    hash_file,
+    link_filters,
+)
 from nesis.rag.core.components.node_store.node_store_component import (
     NodeStoreComponent,
 )
 from nesis.rag.core.components.vector_store.vector_store_component import (
     VectorStoreComponent,
 )
-from nesis.rag.core.server.ingest.model import IngestedDoc
+from nesis.rag.core.server.ingest.model import IngestedDoc, IngestedFile
 from nesis.rag.core.settings.settings import Settings
 
 logger = logging.getLogger(__name__)
 
 
+def _link_metadata(file_name: str, metadata: dict | None) -> dict:
+    # The metadata an upload sets on its documents, see IngestionHelper.transform_file_into_documents
+    return {"file_name": file_name, **(metadata or {})}
+
+
 @singleton
 class IngestService:
     @inject
@@ -40,6 +51,7 @@ class IngestService:
         settings: Settings,
     ) -> None:
         self.llm_service = llm_component
+        self.vector_store_component = vector_store_component
         self.storage_context = StorageContext.from_defaults(
             vector_store=vector_store_component.vector_store,
             docstore=node_store_component.doc_store,
@@ -58,6 +70,12 @@ class IngestService:
         self.ingest_component = get_ingestion_component(
             self.storage_context, self.ingest_service_context, settings=settings
         )
+        self.content_store = (
+            node_store_component.content_store
+            if settings.embedding.deduplicate
+            else None
+        )
+        self.link_filter_keys = settings.embedding.deduplicate_filter_keys
 
     def _ingest_data(
         self, file_name: str, file_data: AnyStr, metadata: dict | None
@@ -83,11 +101,97 @@ class IngestService:
     ) -> list[IngestedDoc]:
         logger.info("Ingesting file_name=%s", file_name)
         try:
-            documents = self.ingest_component.ingest(file_name, file_data, metadata)
+            if self.content_store is None:
+                documents = self.ingest_component.ingest(file_name, file_data, metadata)
+                ingested_docs = [
+                    IngestedDoc.from_document(document) for document in documents
+                ]
+            else:
+                content_hash = hash_file(file_data)
+                with self.content_store.lock(content_hash):
+                    ingested_docs = self._link(content_hash, file_name, metadata)
+                    if ingested_docs is None:
+                        documents = self.ingest_component.ingest(
+                            file_name,
+                            file_data,
+                            {**(metadata or {}), "content_hash": content_hash},
+                        )
+                        self.content_store.register(
+                            content_hash,
+                            doc_ids=[document.doc_id for document in documents],
+                            metadata=_link_metadata(file_name, metadata),
+                        )
+                        ingested_docs = [
+                            IngestedDoc.from_document(document)
+                            for document in documents
+                        ]
         except Exception as ex:
             raise ServiceException(ex)
         logger.info("Finished ingestion file_name=%s", file_name)
-        return [IngestedDoc.from_document(document) for document in documents]
+        return ingested_docs
+
+    def _link(
+        self, content_hash: str, file_name: str, metadata: dict | None
+    ) -> list[IngestedDoc] | None:
+        """Link a file to its already ingested content, skipping the parsing and embedding. Returns None if the
+        content has not been ingested yet. The caller holds the content's lock.
+        """
+        entry = self.content_store.get(content_hash)
+        if entry is None:
+            return None
+        link_metadata = _link_metadata(file_name, metadata)
+        doc_ids = self.content_store.link(content_hash, link_metadata)
+        self._flag_nodes(
+            entry,
+            link_filters([{"metadata": link_metadata}], self.link_filter_keys),
+        )
+        logger.info(
+            "File file_name=%s is already ingested, linking it to count=%s documents",
+            file_name,
+            len(doc_ids),
+        )
+        return self._linked_docs(entry, {"doc_ids": doc_ids, "metadata": link_metadata})
+
+    def _flag_nodes(self, entry: dict, flags: set[str], flag: str = "1") -> None:
+        """Set the link filter keys flags on the nodes of a content, "1" for the filters of its links to match the
+        nodes and "0" once no link needs them, see `ContentStore`.
+        """
+        if not flags:
+            return
+        docstore = self.storage_context.docstore
+        node_ids = []
+        for doc_id in entry["doc_ids"]:
+            ref_doc_info = docstore.get_ref_doc_info(ref_doc_id=doc_id)
+            if ref_doc_info is not None:
+                node_ids.extend(ref_doc_info.node_ids)
+        self.vector_store_component.update_metadata(
+            node_ids, {key: flag for key in flags}
+        )
+
+    def _linked_docs(self, entry: dict, link: dict) -> list[IngestedDoc]:
+        """The documents of a link: those of the nodes' owner with the link's doc ids and metadata."""
+        owner_metadata = entry["links"][0]["metadata"]
+        docstore = self.storage_context.docstore
+        ingested_docs = []
+        for owner_doc_id, doc_id in zip(entry["doc_ids"], link["doc_ids"]):
+            ref_doc_info = docstore.get_ref_doc_info(ref_doc_id=owner_doc_id)
+            doc_metadata = {
+                key: value
+                for key, value in (
+                    (ref_doc_info.metadata if ref_doc_info is not None else None) or {}
+                ).items()
+                if key not in owner_metadata
+            }
+            ingested_docs.append(
+                IngestedDoc(
+                    object="ingest.document",
+                    doc_id=doc_id,
+                    doc_metadata=IngestedDoc.curate_metadata(
+                        {**doc_metadata, **link["metadata"]}
+                    ),
+                )
+            )
+        return ingested_docs
 
     def ingest_text(
         self, file_name: str, text: str, metadata: dict | None
@@ -99,14 +203,109 @@ class IngestService:
         self, file_name: str, raw_file_data: BinaryIO, metadata: dict | None
     ) -> list[IngestedDoc]:
         logger.debug("Ingesting binary data with file_name=%s", file_name)
-        file_data = raw_file_data.read()
-        return self._ingest_data(file_name, file_data, metadata)
+        # Spool the stream to disk in chunks, rather than reading it all into memory
+        # and writing it out again.
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            path_to_tmp = Path(tmp.name)
+            try:
+                shutil.copyfileobj(raw_file_data, tmp)
+                tmp.close()
+                return self.ingest_file(file_name, path_to_tmp, metadata)
+            finally:
+                tmp.close()
+                path_to_tmp.unlink()
 
-    def bulk_ingest(self, files: list[tuple[str, Path]]) -> list[IngestedDoc]:
+    def bulk_ingest(
+        self, files: list[tuple[str, Path, dict | None]]
+    ) -> list[IngestedFile]:
         logger.info("Ingesting file_names=%s", [f[0] for f in files])
-        documents = self.ingest_component.bulk_ingest(files)
+        if self.content_store is None:
+            results = [
+                (
+                    result
+                    if isinstance(result, Exception)
+                    else [IngestedDoc.from_document(document) for document in result]
+                )
+                for result in self.ingest_component.bulk_ingest(files)
+            ]
+        else:
+            results = self._bulk_ingest_content(files)
         logger.info("Finished ingestion file_name=%s", [f[0] for f in files])
-        return [IngestedDoc.from_document(document) for document in documents]
+        ingested_files = []
+        for (file_name, _, _), result in zip(files, results):
+            if isinstance(result, Exception):
+                ingested_files.append(
+                    IngestedFile(
+                        object="ingest.file", file_name=file_name, error=str(result)
+                    )
+                )
+            else:
+                ingested_files.append(
+                    IngestedFile(
+                        object="ingest.file",
+                        file_name=file_name,
+                        data=result,
+                    )
+                )
+        return ingested_files
+
+    def _bulk_ingest_content(
+        self, files: list[tuple[str, Path, dict | None]]
+    ) -> list[list[IngestedDoc] | Exception]:
+        """Bulk ingest only the files whose content is new, the first of each content. The others are linked to
+        their content once it is ingested.
+        """
+        content_hashes = [hash_file(file_data) for _, file_data, _ in files]
+        results: list[list[IngestedDoc] | Exception | None] = [None] * len(files)
+        with contextlib.ExitStack() as stack:
+            # Sorted, so that concurrent batches take the locks in the same order
+            for content_hash in sorted(set(content_hashes)):
+                stack.enter_context(self.content_store.lock(content_hash))
+
+            new_content: dict[str, int] = {}
+            for idx, ((file_name, _, metadata), content_hash) in enumerate(
+                zip(files, content_hashes)
+            ):
+                if content_hash not in new_content:
+                    results[idx] = self._link(content_hash, file_name, metadata)
+                    if results[idx] is None:
+                        new_content[content_hash] = idx
+
+            ingest_results = self.ingest_component.bulk_ingest(
+                [
+                    (
+                        files[idx][0],
+                        files[idx][1],
+                        {**(files[idx][2] or {}), "content_hash": content_hash},
+                    )
+                    for content_hash, idx in new_content.items()
+                ]
+            )
+            for (content_hash, idx), result in zip(new_content.items(), ingest_results):
+                if isinstance(result, Exception):
+                    results[idx] = result
+                    continue
+                file_name, _, metadata = files[idx]
+                self.content_store.register(
+                    content_hash,
+                    doc_ids=[document.doc_id for document in result],
+                    metadata=_link_metadata(file_name, metadata),
+                )
+                results[idx] = [
+                    IngestedDoc.from_document(document) for document in result
+                ]
+
+            for idx, ((file_name, _, metadata), content_hash) in enumerate(
+                zip(files, content_hashes)
+            ):
+                if results[idx] is None:
+                    first = results[new_content[content_hash]]
+                    results[idx] = (
+                        first
+                        if isinstance(first, Exception)
+                        else self._link(content_hash, file_name, metadata)
+                    )
+        return results
 
     def list_ingested(self) -> list[IngestedDoc]:
         ingested_docs = []
@@ -130,6 +329,12 @@ class IngestService:
                         doc_metadata=doc_metadata,
                     )
                 )
+
+            if self.content_store is not None:
+                for content_hash, link in self.content_store.links():
+                    ingested_docs.extend(
+                        self._linked_docs(self.content_store.get(content_hash), link)
+                    )
         except ValueError:
             logger.warning("Got an exception when getting list of docs", exc_info=True)
             pass
@@ -144,4 +349,72 @@ class IngestService:
         logger.info(
             "Deleting the ingested document=%s in the doc and index store", doc_id
         )
-        self.ingest_component.delete(doc_id)
+        doc_ids = self._unlink([doc_id])
+        if doc_ids == [doc_id]:
+            self.ingest_component.delete(doc_id)
+        elif doc_ids:
+            self.ingest_component.bulk_delete(doc_ids)
+
+    def bulk_delete(self, doc_ids: list[str]) -> None:
+        """Delete many ingested documents, persisting the index once."""
+        logger.info(
+            "Deleting %s ingested documents in the doc and index store", len(doc_ids)
+        )
+        doc_ids = self._unlink(doc_ids)
+        if doc_ids:
+            self.ingest_component.bulk_delete(doc_ids)
+
+    def _unlink(self, doc_ids: list[str]) -> list[str]:
+        """Unlink the documents from their content. Returns the doc ids whose nodes are to be deleted: those of
+        a content's last link and those ingested before content addressing. When the link owning a content's nodes
+        goes while other links remain, the nodes are moved over to the next link instead.
+        """
+        if self.content_store is None:
+            return doc_ids
+        deleted = []
+        unlinked = set()
+        for doc_id in doc_ids:
+            if doc_id in unlinked:
+                continue
+            content_hash = self.content_store.content_hash(doc_id)
+            if content_hash is None:
+                deleted.append(doc_id)
+                continue
+            with self.content_store.lock(content_hash):
+                entry = self.content_store.get(content_hash)
+                if entry is None:
+                    continue
+                links = entry["links"]
+                link = next((link for link in links if doc_id in link["doc_ids"]), None)
+                if link is None:
+                    continue
+                if link is links[0] and len(links) > 1:
+                    logger.info(
+                        "Moving the nodes of content=%s over to its next link",
+                        content_hash,
+                    )
+                    self.ingest_component.relink(
+                        doc_ids=link["doc_ids"],
+                        new_doc_ids=links[1]["doc_ids"],
+                        metadata=link["metadata"],
+                        new_metadata=links[1]["metadata"],
+                    )
+                elif len(links) == 1:
+                    deleted.extend(link["doc_ids"])
+                else:
+                    others = [other for other in links[1:] if other is not link]
+                    self._flag_nodes(
+                        entry,
+                        link_filters([link], self.link_filter_keys)
+                        - link_filters(others, self.link_filter_keys),
+                        flag="0",
+                    )
+                self.content_store.unlink(doc_id)
+                unlinked.update(link["doc_ids"])
+                if link is links[0] and len(links) > 2:
+                    # The moved nodes are new nodes, flagged for the links left
+                    self._flag_nodes(
+                        self.content_store.get(content_hash),
+                        link_filters(links[2:], self.link_filter_keys),
+                    )
+        return deleted
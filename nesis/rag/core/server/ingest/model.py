@@ -30,3 +30,12 @@ class IngestedDoc(BaseModel):
             doc_id=document.doc_id,
             doc_metadata=IngestedDoc.curate_metadata(document.metadata),
         )
+
+
+class IngestedFile(BaseModel):
+    """The outcome of one file of a bulk ingest. Either `data` holds its documents or `error` says why it failed."""
+
+    object: Literal["ingest.file"]
+    file_name: str = Field(examples=["Sales Report Q3 2023.pdf"])
+    data: list[IngestedDoc] = Field(default_factory=list)
+    error: str | None = None
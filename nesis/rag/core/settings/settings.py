@@ -161,6 +161,20 @@ class EmbeddingSettings(BaseModel):
             "Do not set it higher than your number of threads of your CPU."
         ),
     )
+    deduplicate: bool = Field(
+        False,
+        description=(
+            "If true, files with identical content are parsed and embedded once. Every further upload of the "
+            "content, from any datasource, is linked to the stored nodes with its own metadata and doc ids."
+        ),
+    )
+    deduplicate_filter_keys: list[str] = Field(
+        ["datasource"],
+        description=(
+            "The metadata keys that retrieval filters match on when `deduplicate` is true. The shared nodes "
+            "are flagged for the values of these keys of every upload linked to them."
+        ),
+    )
 
 
 class SagemakerSettings(BaseModel):
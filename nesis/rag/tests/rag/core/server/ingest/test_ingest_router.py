@@ -111,3 +111,78 @@ def test_ingest_unsupported(injector, client):
 def test_list_ingested(injector, client):
     response = client.get("/v1/ingest/files")
     assert response.status_code == HTTPStatus.OK
+
+
+def test_delete_ingested_documents(injector, client):
+    """
+    Tests deleting all the documents of an ingested file in one request
+    """
+    file_path: pathlib.Path = (
+        pathlib.Path(tests.__file__).parent.absolute()
+        / "resources/file-sample_150kB.pdf"
+    )
+
+    metadata = {"datasource": "documents"}
+
+    with open(file_path.absolute(), "rb") as f:
+        response = client.post(
+            "/v1/ingest/files",
+            files={"file": (file_path.name, f)},
+            params={"metadata": json.dumps(metadata)},
+            data={"metadata": json.dumps(metadata)},
+        )
+    assert response.status_code == HTTPStatus.OK, response.text
+    doc_ids = [item["doc_id"] for item in response.json()["data"]]
+    assert len(doc_ids) > 1
+
+    response = client.post("/v1/ingest/documents/delete", json={"doc_ids": doc_ids})
+    assert response.status_code == HTTPStatus.OK, response.text
+
+    response = client.get("/v1/ingest/files")
+    assert response.status_code == HTTPStatus.OK
+    ingested_doc_ids = {item["doc_id"] for item in response.json()["data"]}
+    assert ingested_doc_ids.isdisjoint(doc_ids)
+
+
+def test_ingest_files_bulk(injector, client):
+    """
+    Tests ingesting several files in one request, with a per file result for a failing file
+    """
+    resources = pathlib.Path(tests.__file__).parent.absolute() / "resources"
+    file_names = ["rfc791.txt", "file-sample_150kB.pdf", "file-sample_100kB.doc"]
+    metadata = [{"datasource": "documents", "index": idx} for idx in range(3)]
+
+    handles = [open(resources / file_name, "rb") for file_name in file_names]
+    try:
+        response = client.post(
+            "/v1/ingest/files/bulk",
+            files=[("files", (f.name.split("/")[-1], f)) for f in handles],
+            data={"metadata": json.dumps(metadata)},
+        )
+    finally:
+        for f in handles:
+            f.close()
+    assert response.status_code == HTTPStatus.OK, response.text
+    result = response.json()["data"]
+    assert [item["file_name"] for item in result] == file_names
+    for idx, item in enumerate(result[:2]):
+        assert item["error"] is None
+        assert len(item["data"]) > 0
+        for document in item["data"]:
+            assert document["doc_metadata"]["index"] == idx
+    assert result[2]["error"] is not None
+    assert result[2]["data"] == []
+
+
+def test_ingest_files_bulk_mismatched_metadata(injector, client):
+    file_path: pathlib.Path = (
+        pathlib.Path(tests.__file__).parent.absolute() / "resources/rfc791.txt"
+    )
+
+    with open(file_path.absolute(), "rb") as f:
+        response = client.post(
+            "/v1/ingest/files/bulk",
+            files=[("files", (file_path.name, f))],
+            data={"metadata": json.dumps([{}, {}])},
+        )
+    assert response.status_code == HTTPStatus.BAD_REQUEST
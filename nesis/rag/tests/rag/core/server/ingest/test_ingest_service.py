@@ -20,7 +20,9 @@ def injector(settings) -> Injector:
 def settings() -> Settings:
     from nesis.rag.core.settings.settings import settings
 
-    return settings(overrides={"llm": {"mode": "mock"}})
+    return settings(
+        overrides={"llm": {"mode": "mock"}, "embedding": {"deduplicate": True}}
+    )
 
 
 @pytest.mark.parametrize(
@@ -62,3 +64,64 @@ def test_ingestion_supported(injector, file_name):
     )
 
     assert len(ingested_list) > 0
+
+
+def test_ingestion_shared_content(injector):
+    """
+    Test to ensure a file ingested from several datasources is parsed and embedded once and found through
+    each datasource's filter, even after the datasource that first ingested it lets it go.
+    """
+    from nesis.rag.core.open_ai.extensions.context_filter import ContextFilter
+    from nesis.rag.core.server.chunks.chunks_service import ChunksService
+
+    file_path: pathlib.Path = (
+        pathlib.Path(tests.__file__).parent.absolute() / "resources" / "rfc791.txt"
+    )
+
+    ingest_service = injector.get(IngestService)
+    chunks_service = injector.get(ChunksService)
+    docstore = ingest_service.storage_context.docstore
+
+    minio_docs = ingest_service.ingest_file(
+        file_name=file_path.name,
+        file_data=file_path,
+        metadata={"datasource": "minio-documents"},
+    )
+    node_count = len(docstore.docs)
+
+    samba_docs = ingest_service.ingest_file(
+        file_name=file_path.name,
+        file_data=file_path,
+        metadata={"datasource": "samba-documents"},
+    )
+
+    assert len(docstore.docs) == node_count
+    assert len(samba_docs) == len(minio_docs)
+    assert {doc.doc_id for doc in samba_docs}.isdisjoint(
+        {doc.doc_id for doc in minio_docs}
+    )
+    for doc in samba_docs:
+        assert doc.doc_metadata["datasource"] == "samba-documents"
+
+    samba_filter = ContextFilter(filters={"datasource": ["samba-documents"]})
+    chunks = chunks_service.retrieve_relevant(
+        text="internet protocol", context_filter=samba_filter
+    )
+    assert len(chunks) > 0
+    for chunk in chunks:
+        # The owner's metadata is not handed out through another datasource's filter
+        assert chunk.document.doc_metadata["datasource"] == "samba-documents"
+        assert chunk.document.doc_id in {doc.doc_id for doc in samba_docs}
+
+    ingest_service.bulk_delete([doc.doc_id for doc in minio_docs])
+
+    chunks = chunks_service.retrieve_relevant(
+        text="internet protocol", context_filter=samba_filter
+    )
+    assert len(chunks) > 0
+    for chunk in chunks:
+        assert chunk.document.doc_metadata["datasource"] == "samba-documents"
+        assert chunk.document.doc_id in {doc.doc_id for doc in samba_docs}
+
+    ingest_service.bulk_delete([doc.doc_id for doc in samba_docs])
+    assert ingest_service.content_store.content_hash(samba_docs[0].doc_id) is None